@@ -1,4 +1,4 @@
-import sys, os, subprocess, shutil
+import sys, os, subprocess, shutil, threading
 from time import sleep
 
 import logging, idscam.common.syslogger
@@ -12,6 +12,183 @@ NUM_DAEMON_START_TRIES = 3
 
 skip_compression = False
 
+# Compresses a folder of raw frames into an h264 clip. '-c' cleans up the raw files.
+COMPRESSION_COMMAND = "raw2h264 -c "
+
+class CompressionPool():
+        '''CompressionPool(num_workers = 1,
+                        max_outstanding = 4,
+                        min_free_space = 1024,
+                        compression_command = COMPRESSION_COMMAND)
+
+        Compresses folders of raw frames into h264 clips on background worker
+        threads, so that the stages and camera can go on to the next clip while
+        the last ones compress.
+
+        num_workers:    Number of clips compressed at once.
+
+        max_outstanding:  Number of clips waiting for or being compressed at
+                        most. submit() waits for one to finish before adding
+                        another.
+
+        min_free_space: Megabytes of disk space to keep free where the raw
+                        frames are. While there is less, submit() waits for
+                        clips to finish compressing, which deletes their raw
+                        frames.
+        '''
+
+        def __init__(self,
+                     num_workers = 1,
+                     max_outstanding = 4,
+                     min_free_space = 1024,
+                     compression_command = COMPRESSION_COMMAND):
+
+                self.max_outstanding = max(max_outstanding, 1)
+                self.min_free_space = min_free_space
+                self.compression_command = compression_command
+
+                # Folders waiting for a worker, and the number waiting or being
+                # compressed. Both are guarded by condition.
+                self.condition = threading.Condition()
+                self.queue = []
+                self.outstanding = 0
+                self.closed = False
+
+                # (folder, return value or error) of every compression that failed,
+                # and how many of them drain() has reported
+                self.failures = []
+                self.failures_reported = 0
+
+                self.workers = []
+                for i in range(max(num_workers, 1)):
+                        worker = threading.Thread( target = self.work, name = "compression-%d" % (i + 1) )
+                        worker.daemon = True
+                        worker.start()
+                        self.workers.append(worker)
+
+        def free_space(self, path):
+                '''CompressionPool.free_space(path)
+
+                Returns the megabytes of disk space free for use on the disk
+                holding path.
+                '''
+                stats = os.statvfs(path)
+                return stats.f_bavail * stats.f_frsize / (1024.0 * 1024.0)
+
+        def is_full(self, folder):
+                if self.outstanding >= self.max_outstanding:
+                        return True
+
+                # With nothing compressing, waiting won't free any space
+                return self.outstanding > 0 and \
+                        self.free_space(os.path.dirname(folder)) < self.min_free_space
+
+        def submit(self, folder):
+                '''CompressionPool.submit(folder)
+
+                Queue the folder of raw frames to be compressed, first waiting
+                while the pool is full (see max_outstanding and min_free_space).
+                '''
+                # The scan may change directory before the folder is compressed
+                folder = os.path.abspath(folder)
+
+                self.condition.acquire()
+                try:
+                        if self.is_full(folder):
+                                log.info( "Waiting for compression: %d clips outstanding" % self.outstanding )
+                                # Wait in steps so that a KeyboardInterrupt gets through
+                                while self.is_full(folder):
+                                        self.condition.wait(1.0)
+
+                        if self.free_space(os.path.dirname(folder)) < self.min_free_space:
+                                log.warning( "Less than %d MB of disk space free for video" % self.min_free_space )
+
+                        self.queue.append(folder)
+                        self.outstanding += 1
+                        self.condition.notifyAll()
+                finally:
+                        self.condition.release()
+
+        def work(self):
+                '''CompressionPool.work()
+
+                Compress queued folders until the pool is closed. Run by each
+                worker thread.
+                '''
+                while True:
+                        self.condition.acquire()
+                        try:
+                                while not self.queue and not self.closed:
+                                        self.condition.wait()
+                                if not self.queue:
+                                        return
+                                folder = self.queue.pop(0)
+                        finally:
+                                self.condition.release()
+
+                        # Whatever happens, the folder is no longer outstanding, or
+                        # drain() would wait for it for ever
+                        ret_val = None
+                        try:
+                                try:
+                                        log.debug( "Starting video compression of " + folder )
+                                        ret_val = os.system( self.compression_command + folder )
+                                        log.debug( "Return val from compression was " + str(ret_val))
+                                except Exception, errmsg:
+                                        ret_val = errmsg
+                        finally:
+                                self.condition.acquire()
+                                try:
+                                        if ret_val != 0:
+                                                log.warning( "Compression of %s returned %s" % (folder, str(ret_val)) )
+                                                self.failures.append( (folder, ret_val) )
+                                        self.outstanding -= 1
+                                        self.condition.notifyAll()
+                                finally:
+                                        self.condition.release()
+
+        def drain(self):
+                '''CompressionPool.drain()
+
+                Wait until every folder submitted has been compressed, and log the
+                compressions that have failed since the last drain().
+                '''
+                self.condition.acquire()
+                try:
+                        if self.outstanding:
+                                log.info( "Waiting for %d clips to finish compressing" % self.outstanding )
+                        while self.outstanding:
+                                self.condition.wait(1.0)
+
+                        failures = self.failures[self.failures_reported:]
+                        self.failures_reported = len(self.failures)
+                finally:
+                        self.condition.release()
+
+                if failures:
+                        log.warning( "%d clip(s) failed to compress, so their raw frames may be left: %s"
+                                     % (len(failures), ", ".join([ folder for folder, ret_val in failures ])) )
+
+        def close(self):
+                '''CompressionPool.close()
+
+                Drain the pool and stop the workers.
+                '''
+                self.drain()
+
+                self.condition.acquire()
+                try:
+                        self.closed = True
+                        self.condition.notifyAll()
+                finally:
+                        self.condition.release()
+
+                for worker in self.workers:
+                        worker.join()
+
+                if self.failures:
+                        log.warning( "%d clip(s) failed to compress in all" % len(self.failures) )
+
 class CameraBase():
         '''CameraBase(   )
 
@@ -30,6 +207,14 @@ class CameraBase():
                 Not very interesting. Intended as prototype for derived classes.
                 '''
                 pass                 
+
+        def flush(self):
+                '''CameraBase.flush()
+
+                Wait until every clip recorded has been written out. Prototype for
+                derived classes that finish clips in the background.
+                '''
+                pass
                                                  
         def get_sensor_resoultion(self):
                 '''get_sensor_resolution()
@@ -66,6 +251,7 @@ class UeyeCamera(CameraBase):
                      cam_device_id = None,
                      num_camera_calls_between_ueye_daemon_restarts = 50,
                      ueye_daemon_control_script = "/etc/init.d/ueyeusbdrc",
+                     compression_pool = None,
                      verbosity = False)
 
         Class representing the uEye family of cameras from IDS. Uses system
@@ -80,6 +266,10 @@ class UeyeCamera(CameraBase):
         num_camera_calls_between_ueye_daemon_restarts:  Number of system calls
                         to ueye camera before restarting its flakey daemon
 
+        compression_pool:  CompressionPool to compress clips in the background.
+                        Without one, record_video() compresses each clip before
+                        returning.
+
         verbosity:      Verbosity
         '''
 
@@ -89,6 +279,7 @@ class UeyeCamera(CameraBase):
                      cam_device_id = None,
                      num_camera_calls_between_ueye_daemon_restarts = 50,
                      ueye_daemon_control_script = "/etc/init.d/ueyeusbdrc",
+                     compression_pool = None,
                      log_level = logging.INFO):
 
                 log.setLevel(log_level)
@@ -99,6 +290,7 @@ class UeyeCamera(CameraBase):
                 self.cam_serial_number = cam_serial_number
                 self.cam_device_id = cam_device_id
                 self.ueye_daemon_control_script = ueye_daemon_control_script
+                self.compression_pool = compression_pool
 
                 # Query status of ueye camera daemon
                 daemon_is_running = self.daemon_call('status')
@@ -272,7 +464,9 @@ class UeyeCamera(CameraBase):
         def record_video(self, filename_base, clip_duration, video_format_params = None ):
                 '''UeyeCamera.record_video(filename_base, clip_duration, video_format_params = None)
 
-                Record a video clip and compress to h264 file.
+                Record a video clip and compress to h264 file. With a compression
+                pool the clip is compressed in the background, and this returns
+                once the raw frames are captured (see flush()).
 
                 filename_base:  Name of video clip file to create. It is appended
                                 with ".h226" on actual file.
@@ -418,9 +612,13 @@ class UeyeCamera(CameraBase):
 
                 if skip_compression: return
 
+                if self.compression_pool != None:
+                        self.compression_pool.submit( filename_base )
+                        return
+
                 # Create video clip from raw frames, '-c' arg specs clean up of raw files
                 log.debug( "Starting video compression." )
-                comp_command = "raw2h264 -c " + filename_base
+                comp_command = COMPRESSION_COMMAND + filename_base
 
                 try:
                         ret_val = os.system( comp_command )
@@ -429,6 +627,14 @@ class UeyeCamera(CameraBase):
                 log.debug( "Return val from compression was " + str(ret_val))
 
 
+        def flush(self):
+                '''UeyeCamera.flush()
+
+                Wait until every clip recorded has been compressed.
+                '''
+                if self.compression_pool != None:
+                        self.compression_pool.drain()
+
 
         def set_light(self, state):
                 '''set_lights(state)
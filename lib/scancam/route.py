@@ -0,0 +1,571 @@
+'''Scan point route optimization
+
+The scan builders visit targets in the order they are listed and run a
+serpentine over each. That is a sensible order, but not necessarily the
+quickest one for an X-theta scancam, where a short step in y can be a long
+swing of the arm. optimize_scan() reorders the points of a scan to cut the
+predicted travel time between them, and optimize_scans() does the same for a
+list of scans, choosing the order of the scans too when the scancam doesn't
+home between them.
+
+Routes are built by nearest neighbour and improved with 2-opt and Or-opt moves.
+The cost of a move is the predicted time of the stage moves, from the
+kinematic models of the stages (see ScanCamBase.target_move_cost()), taking
+the quicker X-theta branch for each point. Once the order is chosen the
+branches are planned over the whole route as the scancam does when it runs it.
+
+Options:
+
+    group_areas:    Keep the points of each area-id together, routing the areas
+                    and then the points within each area.
+
+    alternate_z:    Start the points that move from z0 to z1 during their clip
+                    at whichever of the two the camera is nearer, as the scan
+                    builders do by alternating them. Off by default, so every
+                    point keeps its z0 and z1. Even with it, scans that don't
+                    already alternate, such as those built with
+                    always_start_z0 for depth calibration, are never flipped
+                    (see may_alternate_z()).
+
+Points without a clip ('t') are waypoints that steer the arm clear of the
+walls between targets, so they are never moved: only the stretches of points
+between them are reordered, each from the waypoint before it to the one after.
+
+Only travel between points is counted, not the clips themselves. A scan is
+only reordered if the new route is predicted to be quicker.
+'''
+import logging, idscam.common.syslogger
+
+from scancam import empty_scanpoints
+
+log = idscam.common.syslogger.get_syslogger('scancam')
+
+# Improvements smaller than this (in seconds) are taken as no improvement
+min_improvement = 1e-6
+
+
+def start_z(point):
+        '''start_z(point)
+
+        Return the z the scan point is started at, or None if it doesn't move z.
+        '''
+        return point.get('z0')
+
+
+def end_z(point):
+        '''end_z(point)
+
+        Return the z the scan point is left at: z1 if it records a clip through
+        the depth, otherwise its start. None if it doesn't move z.
+        '''
+        if point.has_key('z1') and point.has_key('t'):
+                return point['z1']
+        return start_z(point)
+
+
+def z_orientations(point, alternate_z):
+        '''z_orientations(point, alternate_z)
+
+        Return the list of (start z, end z) the scan point may be run with.
+        '''
+        orientations = [ (start_z(point), end_z(point)) ]
+        if alternate_z and point.has_key('z1') and point.has_key('t'):
+                orientations.append( (point['z1'], point['z0']) )
+        return orientations
+
+
+def alternates_z(points):
+        '''alternates_z(points)
+
+        Return whether the scan points that record a clip through the depth go
+        both ways through it, some from the lower z and some from the higher.
+        '''
+        directions = set()
+        for point in points:
+                if point.has_key('z0') and point.has_key('z1') and point.has_key('t') and \
+                                not point['z0'] == point['z1']:
+                        directions.add(point['z0'] < point['z1'])
+        return len(directions) > 1
+
+
+def may_alternate_z(scan, points):
+        '''may_alternate_z(scan, points)
+
+        Return whether the z0 and z1 of the scan points of scan may be swapped:
+        only if the scan wasn't built with always_start_z0 and already
+        alternates (see alternates_z()). Swapping those of a scan that goes one
+        way through the depth would change what it records.
+        '''
+        if getattr(scan, 'always_start_z0', False):
+                return False
+        return alternates_z(points)
+
+
+def start_point(position):
+        '''start_point(position)
+
+        Return a scan point for a position in scan coordinates (as returned by
+        ScanCamBase.current_position()), for starting a route from.
+        '''
+        point = {'x': position['x'], 'y': position['y']}
+        if not position.get('z') == None:
+                point['z0'] = position['z']
+        return point
+
+
+def predicted_route_time(scancam, points, start = None):
+        '''predicted_route_time(scancam, points, start = None)
+
+        Return the predicted seconds of stage moves to run through the list of
+        scan points in order, from the point start (from the first point if
+        None). The X-theta branches are planned over the route as the scancam
+        plans them.
+        '''
+        if start == None:
+                route = list(points)
+        else:
+                route = [ start ] + list(points)
+
+        if not route:
+                return 0.0
+
+        targets = scancam.plan_xy(route)
+        cost = scancam.target_move_cost()
+
+        total = 0.0
+        position = dict(targets[0])
+        if not start_z(route[0]) == None:
+                position['z'] = end_z(route[0])
+
+        for point, target in zip(route[1:], targets[1:]):
+                target = dict(target)
+                if not start_z(point) == None:
+                        target['z'] = start_z(point)
+                total = total + cost(position, target)
+
+                position.update(target)
+                if not start_z(point) == None:
+                        position['z'] = end_z(point)
+
+        return total
+
+
+class RouteCosts():
+        '''RouteCosts(scancam, points, alternate_z = False)
+
+        Symmetric costs of moving between the scan points in the list points
+        for route search, worked out as they are asked for. The cost between two
+        points is the time of the quickest of the moves between their X-theta
+        branches and z orientations.
+        '''
+
+        def __init__(self, scancam, points, alternate_z = False):
+                self.points = points
+                self.cost = scancam.target_move_cost()
+
+                self.candidates = []
+                for point in points:
+                        candidates = scancam.xy_candidates(point)
+                        if not candidates:
+                                log.critical("Unable to reach (%f, %f) for routing." % (point['x'], point['y']))
+                                raise ValueError
+                        self.candidates.append(candidates)
+
+                self.orientations = [ z_orientations(point, alternate_z) for point in points ]
+                self.known = {}
+
+        def z_cost(self, start, end):
+                if start == None or end == None:
+                        return 0.0
+                return self.cost( {'z': start}, {'z': end} )
+
+        def __call__(self, i, j):
+                if i == j:
+                        return 0.0
+                if i > j:
+                        i, j = j, i
+
+                pair_cost = self.known.get( (i, j) )
+                if pair_cost == None:
+                        xy_cost = min([ self.cost(a, b) for a in self.candidates[i] for b in self.candidates[j] ])
+
+                        # Whichever way round the two points are visited
+                        z_cost = None
+                        for i_start, i_end in self.orientations[i]:
+                                for j_start, j_end in self.orientations[j]:
+                                        each_cost = min( self.z_cost(i_end, j_start), self.z_cost(j_end, i_start) )
+                                        if z_cost == None or each_cost < z_cost:
+                                                z_cost = each_cost
+
+                        pair_cost = max(xy_cost, z_cost)
+                        self.known[ (i, j) ] = pair_cost
+
+                return pair_cost
+
+        def matrix(self, nodes):
+                '''RouteCosts.matrix(nodes)
+
+                Return the costs between the points with the indices in the list
+                nodes as a list of lists, indexed by position in nodes.
+                '''
+                return [ [ self(i, j) for j in nodes ] for i in nodes ]
+
+
+def nearest_neighbour(cost, fixed_end = False):
+        '''nearest_neighbour(cost, fixed_end = False)
+
+        Return a route through all of the nodes of the cost matrix from node 0,
+        going to the nearest node not yet visited each time. With fixed_end the
+        last node of the matrix is left until last.
+        '''
+        route = [ 0 ]
+        remaining = set(range(1, len(cost)))
+        if fixed_end and len(cost) > 1:
+                remaining.remove(len(cost) - 1)
+        while remaining:
+                last = cost[route[-1]]
+                node = min(remaining, key = lambda node: (last[node], node))
+                route.append(node)
+                remaining.remove(node)
+        if fixed_end and len(cost) > 1:
+                route.append(len(cost) - 1)
+        return route
+
+
+def two_opt(route, cost, fixed_end = False):
+        '''two_opt(route, cost, fixed_end = False)
+
+        Improve the open route in place by reversing stretches of it wherever
+        that makes it shorter. The first node stays first, and with fixed_end
+        the last stays last. Returns True if anything was changed.
+        '''
+        improved = False
+        last = len(route) - 1
+        if fixed_end:
+                last = last - 1
+        for i in range(1, last):
+                for j in range(i + 1, last + 1):
+                        before, first, final = route[i - 1], route[i], route[j]
+                        delta = cost[before][final] - cost[before][first]
+                        if j + 1 < len(route):
+                                after = route[j + 1]
+                                delta = delta + cost[first][after] - cost[final][after]
+
+                        if delta < -min_improvement:
+                                route[i:j + 1] = route[i:j + 1][::-1]
+                                improved = True
+        return improved
+
+
+def or_opt(route, cost, max_segment = 3, fixed_end = False):
+        '''or_opt(route, cost, max_segment = 3, fixed_end = False)
+
+        Improve the open route in place by moving stretches of up to max_segment
+        nodes, either way round, to wherever they make it shortest. The first
+        node stays first, and with fixed_end the last stays last. Returns True
+        if anything was changed.
+        '''
+        improved = False
+        movable = len(route)
+        if fixed_end:
+                movable = movable - 1
+        for length in range(1, max_segment + 1):
+                i = 1
+                while i + length <= movable:
+                        segment = route[i:i + length]
+                        before = route[i - 1]
+
+                        # Saved by taking the segment out
+                        removed = cost[before][segment[0]]
+                        if i + length < len(route):
+                                after = route[i + length]
+                                removed = removed + cost[segment[-1]][after] - cost[before][after]
+
+                        rest = route[:i] + route[i + length:]
+                        best = None
+                        for p in range(len(rest)):
+                                if p == i - 1 or (fixed_end and p == len(rest) - 1):
+                                        continue
+                                for each_segment in (segment, segment[::-1]):
+                                        added = cost[rest[p]][each_segment[0]]
+                                        if p + 1 < len(rest):
+                                                added = added + cost[each_segment[-1]][rest[p + 1]] - cost[rest[p]][rest[p + 1]]
+                                        delta = added - removed
+                                        if delta < -min_improvement and (best == None or delta < best[0]):
+                                                best = (delta, p, each_segment)
+
+                        if best == None:
+                                i += 1
+                                continue
+
+                        delta, p, each_segment = best
+                        route[:] = rest[:p + 1] + each_segment + rest[p + 1:]
+                        improved = True
+        return improved
+
+
+def solve(cost, max_passes = 10, fixed_end = False):
+        '''solve(cost, max_passes = 10, fixed_end = False)
+
+        Return a short open route through all of the nodes of the cost matrix
+        from node 0 (to the last node, with fixed_end): nearest neighbour, then
+        2-opt and Or-opt passes until neither finds an improvement or
+        max_passes have been made.
+        '''
+        route = nearest_neighbour(cost, fixed_end)
+        for each_pass in range(max_passes):
+                improved = two_opt(route, cost, fixed_end)
+                improved = or_opt(route, cost, fixed_end = fixed_end) or improved
+                if not improved:
+                        break
+        return route
+
+
+def area_groups(points):
+        '''area_groups(points)
+
+        Return the indices of the scan points grouped by area-id, as a list of
+        lists in the order the areas first appear. Points without an area-id
+        are each a group of their own.
+        '''
+        groups = []
+        by_area = {}
+        for index, point in enumerate(points):
+                if not point.has_key('area-id'):
+                        groups.append( [ index ] )
+                        continue
+                area_id = point['area-id']
+                if not by_area.has_key(area_id):
+                        by_area[area_id] = []
+                        groups.append( by_area[area_id] )
+                by_area[area_id].append( index )
+        return groups
+
+
+def central_point(points, group):
+        '''central_point(points, group)
+
+        Return the index in group of the point nearest the center of the group.
+        '''
+        x = sum([ points[index]['x'] for index in group ])/float(len(group))
+        y = sum([ points[index]['y'] for index in group ])/float(len(group))
+        return min(group, key = lambda index: ((points[index]['x'] - x)**2 + (points[index]['y'] - y)**2, index))
+
+
+def is_waypoint(point):
+        '''is_waypoint(point)
+
+        Return whether the scan point is a waypoint: a point without a clip,
+        there to steer the arm clear of walls, which routing mustn't move.
+        '''
+        return not point.has_key('t')
+
+
+def stretch_order(costs, nodes, begin, stretch, end, group_areas, max_passes):
+        '''stretch_order(costs, nodes, begin, stretch, end, group_areas, max_passes)
+
+        Return the node indices in the list stretch in a quick order to run
+        them in from the node begin to the node end (or anywhere, if None).
+        nodes are the points the indices are of, and costs their RouteCosts.
+        '''
+        if not stretch:
+                return []
+
+        fixed_end = not end == None
+        if fixed_end:
+                ends = [ end ]
+        else:
+                ends = []
+
+        if not group_areas:
+                local = [ begin ] + stretch + ends
+                order = solve(costs.matrix(local), max_passes, fixed_end)
+                return [ local[node] for node in order[1:len(stretch) + 1] ]
+
+        # The areas in order, by the points nearest their centers
+        groups = [ [ stretch[index] for index in group ]
+                   for group in area_groups([ nodes[node] for node in stretch ]) ]
+        centers = [ begin ] + [ central_point(nodes, group) for group in groups ] + ends
+        area_route = solve(costs.matrix(centers), max_passes, fixed_end)
+
+        # Then the points of each area, from where the last area was left
+        route = [ begin ]
+        for area in area_route[1:len(groups) + 1]:
+                area_nodes = [ route[-1] ] + groups[area - 1]
+                area_order = solve(costs.matrix(area_nodes), max_passes)
+                route.extend([ area_nodes[node] for node in area_order[1:] ])
+
+        return route[1:]
+
+
+def route_order(scancam, points, start = None, group_areas = False, alternate_z = False, max_passes = 10):
+        '''route_order(scancam, points, start = None, group_areas = False, alternate_z = False, max_passes = 10)
+
+        Return the indices of the list of scan points in a quick order to run
+        them in from the point start (or from the first point, which then stays
+        first). Waypoints (see is_waypoint()) keep their places. See the module
+        documentation for the options.
+        '''
+        if not points:
+                return []
+
+        if start == None:
+                nodes = list(points)
+                first = 0
+        else:
+                nodes = [ start ] + list(points)
+                first = 1
+        costs = RouteCosts(scancam, nodes, alternate_z)
+
+        # Node 0 is where the route starts from. The stretches between it and
+        # the waypoints are each reordered on their own.
+        route = [ 0 ]
+        stretch = []
+        for node in range(1, len(nodes)):
+                if is_waypoint(nodes[node]):
+                        route.extend( stretch_order(costs, nodes, route[-1], stretch, node, group_areas, max_passes) )
+                        route.append( node )
+                        stretch = []
+                else:
+                        stretch.append( node )
+        route.extend( stretch_order(costs, nodes, route[-1], stretch, None, group_areas, max_passes) )
+
+        return [ node - first for node in route if node >= first ]
+
+
+def orient_z(points, z = None):
+        '''orient_z(points, z = None)
+
+        Swap z0 and z1 of the scan points that record a clip through the depth
+        where that starts them at the end nearer the camera, following the
+        camera along the list from z. Changes the points in place.
+        '''
+        for point in points:
+                if point.has_key('z0') and point.has_key('z1') and point.has_key('t'):
+                        if not z == None and abs(z - point['z1']) < abs(z - point['z0']):
+                                point['z0'], point['z1'] = point['z1'], point['z0']
+                if not start_z(point) == None:
+                        z = end_z(point)
+        return points
+
+
+def optimize_scan(scancam, scan, start = None, group_areas = False, alternate_z = False, max_passes = 10):
+        '''optimize_scan(scancam, scan, start = None, group_areas = False, alternate_z = False, max_passes = 10)
+
+        Reorder the scan points of scan for scancam to run them quickly from
+        the position start in scan coordinates (from its first point if None),
+        if the new order is predicted to be quicker than the one it has.
+
+        Returns a dictionary report of the predicted travel time with keys
+        'id', 'points', 'original_time', 'optimized_time' and 'saved' (seconds).
+        '''
+        points = [ dict(point.items()) for point in scan.scanpoints ]
+        route_start = None
+        if not start == None:
+                route_start = start_point(start)
+
+        original_time = predicted_route_time(scancam, points, route_start)
+
+        if alternate_z and not may_alternate_z(scan, points):
+                log.info("Scan %s goes one way through the depth, so its z0 and z1 are kept" % scan.get_id())
+                alternate_z = False
+
+        order = route_order(scancam, points, route_start, group_areas, alternate_z, max_passes)
+        routed = [ points[index] for index in order ]
+        if alternate_z:
+                z = None
+                if not route_start == None:
+                        z = start_z(route_start)
+                routed = orient_z([ dict(point) for point in routed ], z)
+        optimized_time = predicted_route_time(scancam, routed, route_start)
+
+        if optimized_time < original_time - min_improvement:
+                scanpoints = empty_scanpoints()
+                for point in routed:
+                        scanpoints.append(point)
+                scan.scanpoints = scanpoints
+        else:
+                optimized_time = original_time
+
+        report = { 'id': scan.get_id(),
+                   'points': len(points),
+                   'original_time': original_time,
+                   'optimized_time': optimized_time,
+                   'saved': original_time - optimized_time }
+        log.info("Route for scan %s: %i points, predicted travel %.1f s instead of %.1f s (%.1f s saved)"
+                 % (report['id'], report['points'], optimized_time, original_time, report['saved']))
+        return report
+
+
+def entry_cost(scancam, scan, position):
+        '''entry_cost(scancam, scan, position)
+
+        Return the predicted seconds to move from the position in scan
+        coordinates to the nearest point of scan.
+        '''
+        if position == None or not len(scan.scanpoints):
+                return 0.0
+        points = [ start_point(position) ] + [ dict(point.items()) for point in scan.scanpoints ]
+        costs = RouteCosts(scancam, points)
+        return min([ costs(0, index) for index in range(1, len(points)) ])
+
+
+def route_end(scan, default):
+        '''route_end(scan, default)
+
+        Return the position in scan coordinates that running scan leaves the
+        camera at, or default if it has no points.
+        '''
+        if not len(scan.scanpoints):
+                return default
+        last = scan.scanpoints[-1]
+        position = {'x': last['x'], 'y': last['y'], 'z': None}
+        if not start_z(last) == None:
+                position['z'] = end_z(last)
+        elif not default == None:
+                position['z'] = default.get('z')
+        return position
+
+
+def optimize_scans(scancam, scans, start, home_between = True, reorder_scans = False, **options):
+        '''optimize_scans(scancam, scans, start, home_between = True, reorder_scans = False, **options)
+
+        Reorder the points of each of the list of scans with optimize_scan()
+        for scancam, starting from the position start in scan coordinates (such
+        as ScanCamBase.home_position()), or from the first point if None. Other
+        keyword arguments are options for optimize_scan().
+
+        With home_between, each scan starts from start, as when the scancam
+        homes between scans. Otherwise each starts where the one before it
+        finished, and with reorder_scans the scans themselves are reordered in
+        place, each next one being the one nearest to hand.
+
+        Returns the list of reports of optimize_scan(), in the order the scans
+        are run, and logs the total saved.
+        '''
+        reports = []
+        if home_between:
+                for scan in scans:
+                        reports.append( optimize_scan(scancam, scan, start, **options) )
+        else:
+                remaining = list(scans)
+                ordered = []
+                position = start
+                while remaining:
+                        scan = remaining[0]
+                        if reorder_scans:
+                                scan = min(remaining, key = lambda scan: entry_cost(scancam, scan, position))
+                        remaining.remove(scan)
+                        ordered.append(scan)
+
+                        reports.append( optimize_scan(scancam, scan, position, **options) )
+                        position = route_end(scan, position)
+
+                if reorder_scans:
+                        scans[:] = ordered
+
+        original_time = sum([ report['original_time'] for report in reports ])
+        saved = sum([ report['saved'] for report in reports ])
+        log.info("Routes of %i scans: predicted travel %.1f s instead of %.1f s (%.1f s saved)"
+                 % (len(reports), original_time - saved, original_time, saved))
+        return reports
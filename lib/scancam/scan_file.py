@@ -0,0 +1,750 @@
+'''Compact scan files
+
+A versioned binary format for lists of scans, used in place of pickled scan
+lists. Loading a pickle builds every scan point up front and ties the file to
+the classes that wrote it. A scan file is opened with mmap instead, and points
+are only read from it as they are used, so opening one takes the same time
+whatever the size of its scans. Scans are loaded as the class that built them
+when it is a ScanBase class that can still be imported, and as plain ScanBase
+otherwise, so files keep loading as the classes change.
+
+Layout, all little-endian:
+
+    prefix:     magic 'SCANCAM\\0', format version (uint16), reserved (uint16)
+                and the length of the header (uint32)
+    header:     repr() of a dictionary of literals (read with literal_eval)
+                describing each scan: its class and module, id,
+                video_format_params, other simple attributes, the point count,
+                the row dtype, and where its rows, ids and extras are
+    data:       from the first multiple of 8 after the header. For each scan,
+                its rows as a packed array of the row dtype (a ScanTable row),
+                then its ids: a uint32 count, count + 1 uint32 offsets into the
+                id text, a uint8 kind per id and the id text, then its extras
+                (the keys outside the columns): a uint32 count of rows with
+                extras, their uint32 row indices in order, count + 1 uint32
+                offsets into the extras text and the repr() of each row's.
+
+Version 1 files, with the extras of every row in the header, still load.
+
+Offsets in the header are from the start of the data. Columns are matched by
+name, so files with a different set of columns than ScanTable still load.
+
+dump() and load() are used like pickle.dump() and pickle.load(), and load()
+still loads pickled scan lists. With numpy, the points of a loaded scan are a
+ScanTable over the mapped rows (changes are kept in memory, not written to the
+file). Without numpy they are a read-only list of dictionaries unpacked as
+they are read.
+'''
+import mmap
+import pickle
+import struct
+from ast import literal_eval
+
+import logging, idscam.common.syslogger
+
+log = idscam.common.syslogger.get_syslogger('scancam')
+
+try:
+        import numpy
+        from scan_table import ScanTable, scan_point_dtype, FLOAT_COLUMNS, NULLABLE_COLUMNS, \
+                ID_COLUMNS, column_keys, present_bits
+except ImportError:
+        numpy = None
+        ScanTable = None
+        FLOAT_COLUMNS = ('x', 'y', 'z0', 'z1', 't')
+        NULLABLE_COLUMNS = ('z0', 'z1', 't')
+        ID_COLUMNS = ('point-id', 'area-id')
+        column_keys = set(FLOAT_COLUMNS + ID_COLUMNS)
+        present_bits = dict([ (column, 1 << bit) for bit, column in enumerate(NULLABLE_COLUMNS) ])
+
+MAGIC = 'SCANCAM\0'
+FORMAT_VERSION = 2
+
+prefix_format = struct.Struct('<8sHHI')
+count_format = struct.Struct('<I')
+
+# Rows as written by this version, the same as a ScanTable row
+row_descr = [ (column, '<f8') for column in FLOAT_COLUMNS ] + \
+            [ (column, '<i4') for column in ID_COLUMNS ] + \
+            [ ('present', '|u1') ]
+
+# struct codes for the row dtype type strings, to read rows without numpy
+struct_codes = { '<f8': 'd', '<f4': 'f', '<i4': 'i', '<u4': 'I', '<i2': 'h', '<u2': 'H',
+                 '|u1': 'B', '|i1': 'b', '<i8': 'q', '<u8': 'Q' }
+
+# Kinds of id
+ID_STRING = 0
+ID_INTEGER = 1
+ID_LITERAL = 2
+
+# ScanBase attributes that aren't written as attributes. stage_plans are
+# planned again by the scancam when needed.
+scan_fields = ('id', 'video_format_params', 'scanpoints', 'stage_plans')
+
+
+def is_literal(value):
+        '''is_literal(value)
+
+        Return True if value is written by repr() in a form literal_eval() reads
+        back as an equal value.
+        '''
+        try:
+                return literal_eval(repr(value)) == value
+        except (ValueError, SyntaxError):
+                return False
+
+
+def align(offset, boundary = 8):
+        return (offset + boundary - 1) // boundary * boundary
+
+
+def encode_id(value):
+        '''encode_id(value)
+
+        Return the tuple (kind, text) that value is written to the id table as.
+        '''
+        if isinstance(value, str):
+                return ID_STRING, value
+        if isinstance(value, (int, long)) and not isinstance(value, bool):
+                return ID_INTEGER, str(value)
+        if is_literal(value):
+                return ID_LITERAL, repr(value)
+        raise ValueError('Scan point id %r can not be written to a scan file' % (value,))
+
+
+def decode_id(kind, text):
+        if kind == ID_STRING:
+                return text
+        if kind == ID_INTEGER:
+                return int(text)
+        return literal_eval(text)
+
+
+def pack_ids(ids):
+        '''pack_ids(ids)
+
+        Return the id table of the list of ids as a string.
+        '''
+        kinds = []
+        texts = []
+        offsets = [0]
+        for value in ids:
+                kind, text = encode_id(value)
+                kinds.append(kind)
+                texts.append(text)
+                offsets.append(offsets[-1] + len(text))
+
+        return count_format.pack(len(ids)) + \
+               struct.pack('<%iI' % len(offsets), *offsets) + \
+               struct.pack('<%iB' % len(kinds), *kinds) + \
+               ''.join(texts)
+
+
+class FileIds():
+        '''FileIds(buffer, offset)
+
+        The ids of the id table at offset in buffer, as a read-only sequence.
+        Each id is read from the buffer when it is asked for.
+        '''
+
+        def __init__(self, buffer, offset):
+                self.buffer = buffer
+                self.count = count_format.unpack_from(buffer, offset)[0]
+                self.offsets = offset + count_format.size
+                self.kinds = self.offsets + 4*(self.count + 1)
+                self.text = self.kinds + self.count
+
+        def __len__(self):
+                return self.count
+
+        def __getitem__(self, index):
+                if index < 0:
+                        index = index + self.count
+                if index < 0 or index >= self.count:
+                        raise IndexError('scan file id index out of range')
+
+                start, end = struct.unpack_from('<2I', self.buffer, self.offsets + 4*index)
+                kind = struct.unpack_from('<B', self.buffer, self.kinds + index)[0]
+                return decode_id(kind, self.buffer[self.text + start:self.text + end])
+
+        def __iter__(self):
+                for index in xrange(self.count):
+                        yield self[index]
+
+
+def pack_extras(extras):
+        '''pack_extras(extras)
+
+        Return the extras table of the dictionary of keys outside the columns
+        by row index as a string. Raises ValueError if any can't be written as
+        literals.
+        '''
+        rows = sorted(extras)
+        texts = []
+        offsets = [0]
+        for index in rows:
+                if not is_literal(extras[index]):
+                        raise ValueError('Scan point %i has values that can not be written to a scan file: %r'
+                                         % (index, extras[index]))
+                texts.append(repr(extras[index]))
+                offsets.append(offsets[-1] + len(texts[-1]))
+
+        return count_format.pack(len(rows)) + \
+               struct.pack('<%iI' % len(rows), *rows) + \
+               struct.pack('<%iI' % len(offsets), *offsets) + \
+               ''.join(texts)
+
+
+class FileExtras():
+        '''FileExtras(buffer, offset)
+
+        The keys outside the columns of a scan's rows, by row index, from the
+        extras table at offset in buffer, as a dictionary. The extras of a row
+        are only read from the buffer when they are asked for, and are then
+        kept in memory along with any changes.
+        '''
+
+        def __init__(self, buffer, offset):
+                self.buffer = buffer
+                self.count = count_format.unpack_from(buffer, offset)[0]
+                self.rows = offset + count_format.size
+                self.offsets = self.rows + 4*self.count
+                self.text = self.offsets + 4*(self.count + 1)
+
+                # Extras read from the buffer or set since, by row index
+                self.loaded = {}
+
+        def row(self, position):
+                return struct.unpack_from('<I', self.buffer, self.rows + 4*position)[0]
+
+        def find(self, index):
+                '''FileExtras.find(index)
+
+                Return the position of row index in the table, or None if it has
+                no extras there.
+                '''
+                low = 0
+                high = self.count
+                while low < high:
+                        middle = (low + high) // 2
+                        if self.row(middle) < index:
+                                low = middle + 1
+                        else:
+                                high = middle
+                if low < self.count and self.row(low) == index:
+                        return low
+                return None
+
+        def get(self, index, default = None):
+                if not self.loaded.has_key(index):
+                        position = self.find(index)
+                        if position == None:
+                                return default
+
+                        start, end = struct.unpack_from('<2I', self.buffer, self.offsets + 4*position)
+                        self.loaded[index] = literal_eval(self.buffer[self.text + start:self.text + end])
+                return self.loaded[index]
+
+        def __getitem__(self, index):
+                extras = self.get(index)
+                if extras == None:
+                        raise KeyError(index)
+                return extras
+
+        def __setitem__(self, index, extras):
+                self.loaded[index] = extras
+
+        def setdefault(self, index, default = None):
+                extras = self.get(index)
+                if extras == None:
+                        self.loaded[index] = default
+                        return default
+                return extras
+
+        def has_key(self, index):
+                return not self.get(index) == None
+
+        __contains__ = has_key
+
+        def keys(self):
+                rows = set([ self.row(position) for position in xrange(self.count) ])
+                return sorted(rows | set(self.loaded))
+
+        def __iter__(self):
+                return iter(self.keys())
+
+        def __len__(self):
+                return len(self.keys())
+
+        def items(self):
+                return [ (index, self[index]) for index in self.keys() ]
+
+
+class FilePoints():
+        '''FilePoints(buffer, offset, count, descr, ids, extras)
+
+        The count scan points of rows of descr at offset in buffer, as a
+        read-only sequence of point dictionaries. Used when numpy isn't
+        available: each point is unpacked from the buffer as it is read.
+        '''
+
+        def __init__(self, buffer, offset, count, descr, ids, extras):
+                self.buffer = buffer
+                self.offset = offset
+                self.count = count
+                self.columns = [ name for name, type_string in descr ]
+                self.row_format = struct.Struct('<' + ''.join([ struct_codes[type_string]
+                                                                for name, type_string in descr ]))
+                self.ids = ids
+                self.extras = extras
+
+        def __len__(self):
+                return self.count
+
+        def point(self, index):
+                row = dict(zip(self.columns, self.row_format.unpack_from(self.buffer,
+                                                self.offset + index*self.row_format.size)))
+                present = row.get('present', 0)
+
+                point = {}
+                for column in FLOAT_COLUMNS:
+                        if row.has_key(column) and (not column in present_bits or present & present_bits[column]):
+                                point[column] = row[column]
+                for column in ID_COLUMNS:
+                        if row.get(column, -1) >= 0:
+                                point[column] = self.ids[row[column]]
+                point.update(self.extras.get(index, {}))
+                return point
+
+        def __getitem__(self, index):
+                if isinstance(index, slice):
+                        return [ self.point(each_index) for each_index in range(*index.indices(self.count)) ]
+
+                if index < 0:
+                        index = index + self.count
+                if index < 0 or index >= self.count:
+                        raise IndexError('scan point index out of range')
+
+                return self.point(index)
+
+        def __iter__(self):
+                for index in xrange(self.count):
+                        yield self.point(index)
+
+
+def point_rows(points):
+        '''point_rows(points)
+
+        Return the tuple (rows, ids, extras) to write for a list of scan point
+        dictionaries: the rows packed as a string, the list of ids the rows
+        index, and the keys outside the columns by row.
+        '''
+        row_format = struct.Struct('<' + ''.join([ struct_codes[type_string]
+                                                   for name, type_string in row_descr ]))
+        ids = []
+        id_index = {}
+        extras = {}
+        rows = []
+        for index, point in enumerate(points):
+                row = [ point['x'], point['y'] ]
+
+                present = 0
+                for column in NULLABLE_COLUMNS:
+                        if point.has_key(column):
+                                row.append(point[column])
+                                present = present | present_bits[column]
+                        else:
+                                row.append(0.0)
+
+                for column in ID_COLUMNS:
+                        if point.has_key(column):
+                                value = point[column]
+                                if not id_index.has_key(value):
+                                        id_index[value] = len(ids)
+                                        ids.append(value)
+                                row.append(id_index[value])
+                        else:
+                                row.append(-1)
+
+                row.append(present)
+                rows.append(row_format.pack(*row))
+
+                for key in point.keys():
+                        if not key in column_keys:
+                                extras.setdefault(index, {})[key] = point[key]
+
+        return ''.join(rows), ids, extras
+
+
+def table_rows(table):
+        '''table_rows(table)
+
+        Return the tuple (rows, ids, extras) to write for a ScanTable, as
+        point_rows() does for a list.
+        '''
+        table.flush()
+
+        # Column by column, by name
+        rows = numpy.zeros(table.count, dtype = numpy.dtype(row_descr))
+        for name in rows.dtype.names:
+                rows[name] = table.rows[name][:table.count]
+        return rows.tostring(), list(table.ids), dict(table.extras)
+
+
+def scan_attributes(scan):
+        '''scan_attributes(scan)
+
+        Return the attributes of the scan to write besides its id, video format
+        parameters and points: those that can be written as literals.
+        '''
+        attributes = {}
+        for name, value in vars(scan).items():
+                if not name in scan_fields and is_literal(value):
+                        attributes[name] = value
+        return attributes
+
+
+def dump(scans, scanfile):
+        '''dump(scans, scanfile)
+
+        Write the list of scans to the file object scanfile, opened for binary
+        writing, as pickle.dump() would. Raises ValueError if a scan's id,
+        video format parameters or point values can't be written as literals.
+        '''
+        descriptions = []
+        sections = []
+        offset = 0
+        for scan in scans:
+                if not ScanTable == None and isinstance(scan.scanpoints, ScanTable):
+                        rows, ids, extras = table_rows(scan.scanpoints)
+                else:
+                        rows, ids, extras = point_rows(scan.scanpoints)
+
+                for field in ('id', 'video_format_params'):
+                        if not is_literal(getattr(scan, field)):
+                                raise ValueError('Scan %s %r can not be written to a scan file'
+                                                 % (field, getattr(scan, field)))
+                try:
+                        extras_table = pack_extras(extras)
+                except ValueError, errmsg:
+                        raise ValueError('Scan %s: %s' % (scan.id, errmsg))
+
+                id_table = pack_ids(ids)
+                rows_offset = offset
+                ids_offset = align(rows_offset + len(rows))
+                extras_offset = align(ids_offset + len(id_table))
+                offset = align(extras_offset + len(extras_table))
+
+                descriptions.append( { 'class': scan.__class__.__name__,
+                                       'module': scan.__class__.__module__,
+                                       'id': scan.id,
+                                       'video_format_params': scan.video_format_params,
+                                       'attributes': scan_attributes(scan),
+                                       'count': len(scan.scanpoints),
+                                       'dtype': row_descr,
+                                       'rows_offset': rows_offset,
+                                       'ids_offset': ids_offset,
+                                       'extras_offset': extras_offset } )
+                sections.append( (rows_offset, rows) )
+                sections.append( (ids_offset, id_table) )
+                sections.append( (extras_offset, extras_table) )
+
+        header = repr( {'scans': descriptions} )
+        data_start = align(prefix_format.size + len(header))
+
+        scanfile.write(prefix_format.pack(MAGIC, FORMAT_VERSION, 0, len(header)))
+        scanfile.write(header)
+        position = prefix_format.size + len(header)
+        for section_offset, section in sections:
+                scanfile.write('\0' * (data_start + section_offset - position))
+                scanfile.write(section)
+                position = data_start + section_offset + len(section)
+        scanfile.write('\0' * (align(position) - position))
+
+
+def is_scan_file(scanfile):
+        '''is_scan_file(scanfile)
+
+        Return True if the open file scanfile is a scan file rather than a
+        pickle. Leaves the file at its start.
+        '''
+        scanfile.seek(0)
+        magic = scanfile.read(len(MAGIC))
+        scanfile.seek(0)
+        return magic == MAGIC
+
+
+def read_header(buffer):
+        '''read_header(buffer)
+
+        Return the tuple (version, header, data_start) of the scan file mapped
+        in buffer. Raises ValueError if it isn't a scan file, or was written by
+        a later version than this one reads.
+        '''
+        if len(buffer) < prefix_format.size:
+                raise ValueError('Scan file is too short')
+
+        magic, version, reserved, header_length = prefix_format.unpack_from(buffer, 0)
+        if not magic == MAGIC:
+                raise ValueError('Not a scan file')
+        if version > FORMAT_VERSION:
+                raise ValueError('Scan file version %i is newer than this version (%i) reads'
+                                 % (version, FORMAT_VERSION))
+
+        header = literal_eval(buffer[prefix_format.size:prefix_format.size + header_length])
+        return version, header, align(prefix_format.size + header_length)
+
+
+def file_table(buffer, offset, count, descr, ids, extras):
+        '''file_table(buffer, offset, count, descr, ids, extras)
+
+        Return a ScanTable of the count rows of descr at offset in buffer. Rows
+        written as ScanTable rows are used where they are in the buffer;
+        others are copied column by column into new rows.
+        '''
+        dtype = numpy.dtype([ (str(name), type_string) for name, type_string in descr ])
+        file_rows = numpy.frombuffer(buffer, dtype = dtype, count = count, offset = offset)
+
+        table = ScanTable()
+        if dtype == scan_point_dtype:
+                table.rows = file_rows
+        else:
+                table.reserve(count)
+                table.add_rows(count)
+                for name in dtype.names:
+                        if name in scan_point_dtype.names:
+                                table.rows[name][:count] = file_rows[name]
+
+                # Columns the file doesn't have are absent from every row
+                for name in NULLABLE_COLUMNS:
+                        if not name in dtype.names:
+                                table.rows['present'][:count] &= 0xff ^ present_bits[name]
+        table.count = count
+
+        # Indexed if ids are added
+        table.ids = ids
+        table.id_index = None
+
+        table.extras = extras
+        return table
+
+
+def scan_class(description):
+        '''scan_class(description)
+
+        Return the class of the scan described in a scan file header: the one
+        that wrote it if it is a ScanBase class that can still be imported, or
+        else ScanBase.
+        '''
+        from scancam import ScanBase
+
+        name = description.get('class')
+        module_name = description.get('module')
+        if name == None or module_name == None:
+                return ScanBase
+
+        try:
+                module = __import__(module_name, fromlist = [name])
+                is_scan = issubclass(getattr(module, name), ScanBase)
+        except (ImportError, AttributeError, TypeError):
+                is_scan = False
+
+        if not is_scan:
+                log.warning("Scan %s was written by %s.%s, which isn't available, so it is loaded as a ScanBase"
+                            % (description['id'], module_name, name))
+                return ScanBase
+        return getattr(module, name)
+
+
+def read_scans(scanfile):
+        '''read_scans(scanfile)
+
+        Return the list of scans in the scan file open as scanfile. The file is
+        mapped and its points are read as they are used. It can be closed once
+        the scans are read.
+        '''
+        from scancam import ScanBase
+
+        scanfile.seek(0)
+        buffer = mmap.mmap(scanfile.fileno(), 0, access = mmap.ACCESS_COPY)
+        version, header, data_start = read_header(buffer)
+
+        scans = []
+        for description in header['scans']:
+                # The class's own constructor builds the scan, so the scan is
+                # made as a ScanBase and then given its class
+                scan = ScanBase(description['id'], description['video_format_params'])
+                scan.__class__ = scan_class(description)
+                for name, value in description.get('attributes', {}).items():
+                        setattr(scan, name, value)
+
+                ids = FileIds(buffer, data_start + description['ids_offset'])
+                if description.has_key('extras_offset'):
+                        extras = FileExtras(buffer, data_start + description['extras_offset'])
+                else:
+                        extras = description.get('extras', {})
+                args = (buffer, data_start + description['rows_offset'], description['count'],
+                        description['dtype'], ids, extras)
+                if ScanTable == None:
+                        scan.scanpoints = FilePoints(*args)
+                else:
+                        scan.scanpoints = file_table(*args)
+                scans.append(scan)
+
+        return scans
+
+
+def load(scanfile):
+        '''load(scanfile)
+
+        Return the list of scans in the file object scanfile, opened for binary
+        reading: a scan file, or a pickled list of scans.
+        '''
+        if is_scan_file(scanfile):
+                return read_scans(scanfile)
+        return pickle.load(scanfile)
+
+
+def convert(pickle_path, scan_path):
+        '''convert(pickle_path, scan_path)
+
+        Write the scans pickled in the file pickle_path to the scan file
+        scan_path, check that it reads back the same and return the scans.
+        '''
+        pickle_file = open(pickle_path, 'rb')
+        scans = pickle.load(pickle_file)
+        pickle_file.close()
+
+        scan_file = open(scan_path, 'wb')
+        dump(scans, scan_file)
+        scan_file.close()
+
+        check_scans(scans, scan_path)
+        return scans
+
+
+def check_scans(scans, scan_path):
+        '''check_scans(scans, scan_path)
+
+        Check that the scan file scan_path holds the list of scans: the same
+        ids, video format parameters and points. Raises AssertionError at the
+        first difference.
+        '''
+        scan_file = open(scan_path, 'rb')
+        loaded = load(scan_file)
+        scan_file.close()
+
+        assert len(loaded) == len(scans), (len(loaded), len(scans))
+        for scan, loaded_scan in zip(scans, loaded):
+                assert loaded_scan.id == scan.id, (loaded_scan.id, scan.id)
+                assert loaded_scan.__class__ == scan.__class__, (scan.id, loaded_scan.__class__, scan.__class__)
+                assert loaded_scan.video_format_params == scan.video_format_params, \
+                        (scan.id, loaded_scan.video_format_params, scan.video_format_params)
+                assert len(loaded_scan.scanpoints) == len(scan.scanpoints), \
+                        (scan.id, len(loaded_scan.scanpoints), len(scan.scanpoints))
+                for index, (point, loaded_point) in enumerate(zip(scan.scanpoints, loaded_scan.scanpoints)):
+                        assert dict(loaded_point.items()) == dict(point.items()), \
+                                (scan.id, index, dict(loaded_point.items()), dict(point.items()))
+
+
+def example_scans(num_h_scan_points = 3, num_v_scan_points = 4):
+        '''example_scans(num_h_scan_points = 3, num_v_scan_points = 4)
+
+        Return a list of scans like those of the scan builders, with extra
+        point keys and ids of each kind, for checking round trips.
+        '''
+        from scancam import ScanBase, SixWellBioCellScan
+
+        module = SixWellBioCellScan( {'x': 124.1, 'y': -47.3},
+                                     rotation_orientation_id = '1',
+                                     scan_id = 'module1',
+                                     num_h_scan_points = num_h_scan_points,
+                                     num_v_scan_points = num_v_scan_points,
+                                     clip_duration = 20.0,
+                                     video_format_params = { 'subsampling': 3,
+                                                             'cropping': (320, 2240, 0, 1920) } )
+
+        mixed = ScanBase('mixed')
+        mixed.build_scan_from_target_origins( [ {'x': 0.0, 'y': -47.3, 'z0': 0.0, 'z1': 7.0, 't': 7},
+                                                {'x': 28.1, 'y': -9.0, 'area-id': 7, 'note': 'edge'},
+                                                {'x': 12.3, 'y': 29.3, 'z0': 1.5, 'area-id': u'B\xe9'} ],
+                                              num_h_scan_points = 2, num_v_scan_points = 2 )
+        mixed.scanpoints.append( {'x': 1.0, 'y': 2.0, 'point-id': ('corner', 1)} )
+
+        return [ module, mixed, ScanBase('empty') ]
+
+
+def check_round_trip(scan_path = '/tmp/scan_file_check.scan'):
+        '''check_round_trip(scan_path = '/tmp/scan_file_check.scan')
+
+        Write example_scans() to scan_path, and check that they read back the
+        same and still load when pickled.
+        '''
+        scans = example_scans()
+
+        scan_file = open(scan_path, 'wb')
+        dump(scans, scan_file)
+        scan_file.close()
+        check_scans(scans, scan_path)
+
+        # The same scans as dictionaries
+        for scan in scans:
+                scan.scanpoints = [ dict(point.items()) for point in scan.scanpoints ]
+        scan_file = open(scan_path, 'wb')
+        dump(scans, scan_file)
+        scan_file.close()
+        check_scans(scans, scan_path)
+
+        # Pickles still load
+        pickle_file = open(scan_path, 'wb')
+        pickle.dump(scans, pickle_file)
+        pickle_file.close()
+        check_scans(scans, scan_path)
+
+        print 'Scan files read back the same as the %i scans written' % len(scans)
+
+
+def benchmark(scan_path = '/tmp/scan_file_benchmark', tiles = (3, 30, 100)):
+        '''benchmark(scan_path = '/tmp/scan_file_benchmark', tiles = (3, 30, 100))
+
+        Time loading six-well scans of tiles by tiles points per well from a
+        pickle and from a scan file, and reading their points.
+        '''
+        from time import time
+
+        for num_tiles in tiles:
+                scans = example_scans(num_tiles, num_tiles)[:1]
+
+                pickle_file = open(scan_path + '.pickle', 'wb')
+                pickle.dump(scans, pickle_file, pickle.HIGHEST_PROTOCOL)
+                pickle_file.close()
+                scan_file = open(scan_path + '.scan', 'wb')
+                dump(scans, scan_file)
+                scan_file.close()
+
+                times = []
+                for path in (scan_path + '.pickle', scan_path + '.scan'):
+                        # Best of three
+                        load_time = None
+                        for repeat in range(3):
+                                start = time()
+                                each_file = open(path, 'rb')
+                                loaded = load(each_file)
+                                each_file.close()
+                                load_time = min(load_time or 1e9, time() - start)
+
+                        start = time()
+                        for point in loaded[0].scanpoints:
+                                point['x'], point['y']
+                        times.append( (load_time, time() - start) )
+
+                print '%6i points: load %.4f s pickled, %.4f s scan file; read points %.3f s, %.3f s' \
+                        % (len(scans[0].scanpoints), times[0][0], times[1][0], times[0][1], times[1][1])
+
+
+if __name__ == '__main__':
+        import sys
+        if sys.argv[1:2] == ['benchmark']:
+                benchmark()
+        else:
+                check_round_trip()
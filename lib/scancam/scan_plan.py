@@ -0,0 +1,338 @@
+'''Compiled scan plans
+
+ScanCamBase.compile_scan() works out everything scan_action() needs to run a
+scan before any stage moves: the X-theta (or other) targets of each point as
+microstep move commands for each stage, the z running starts, the target speed
+changes, the clip of each point with the start of its file name, and how long
+each step is expected to take. ScanCamBase.run_plan() then runs the plan,
+sending what it says with no geometry, unit conversion or name building
+between points.
+
+Plans are made of tuples and refer to stages by id, so they can't be changed
+once compiled and can be kept, compared or pickled. A plan is only good for
+the stage settings it was compiled with (see ScanPlan.unit_scales).
+
+Expected times are in seconds from the start of the scan, and are None where
+they can't be predicted because the stage settings haven't been read. They
+count the compression of clips compressed before the scan moves on (see
+ScanCamBase compression_ratio), but not camera daemon restarts or waits for
+background compression to catch up, which depend on the camera rather than
+the scan.
+
+An OverlapPolicy says how much of one step ScanCamBase.run_plan_pipelined()
+may overlap with the next.
+
+What is sent and waited for while a plan runs, and when a scancam homes, scans
+and stows between scan sets, is decided here once, by plan_actions() and
+scan_loop(). They yield actions for an executor to carry out: ScanCamBase and
+bin/scancam on the hardware, or simulation.SimulatedRun on a virtual clock.
+'''
+from collections import namedtuple
+from time import time
+
+import logging, idscam.common.syslogger
+
+log = idscam.common.syslogger.get_syslogger('scancam')
+
+# scan_id:              Id of the scan the plan was compiled from
+# video_format_params:  Camera parameters for every clip of the scan
+# unit_scales:          (stage id, unit scale) of each stage the moves were
+#                       converted to microsteps with
+# steps:                PlanStep for each scan point, in order
+# end_positions:        (stage id, position) of each stage at the end of the scan
+ScanPlan = namedtuple('ScanPlan', ['scan_id', 'video_format_params', 'unit_scales', 'steps',
+                                   'end_positions'])
+
+# number:               Scan point number, from 1
+# speeds:               (stage id, target_speed setting) to set before the move
+# moves:                (stage id, command number, data) to send together
+# move_time:            Predicted seconds for the moves
+# clip_speeds:          (stage id, target_speed setting) to set before the clip
+# clip_moves:           (stage id, command number, data) to send as the clip starts
+#                       (the move through the depth), not waited for until it ends
+# clip_move_time:       Predicted seconds for the clip moves
+# clip_duration:        Seconds of video to record, or None for no clip
+# filename_base:        Clip file name up to the time string
+# start_time:           Expected start of the clip (arrival at the point)
+# end_time:             Expected end of the step
+PlanStep = namedtuple('PlanStep', ['number', 'speeds', 'moves', 'move_time',
+                                   'clip_speeds', 'clip_moves', 'clip_move_time',
+                                   'clip_duration', 'filename_base', 'start_time', 'end_time'])
+
+# Kinds of PlanAction
+SEND = 'send'                   # Set the speeds, then send the moves together
+WAIT_MOVE = 'wait move'         # Wait for the stages to reach the scan point
+WAIT_DEPTH = 'wait depth'       # Wait for the move through the depth
+RECORD = 'record'               # Record the clip of the step
+
+# kind:                 SEND, WAIT_MOVE, WAIT_DEPTH or RECORD
+# step:                 PlanStep the action is for
+# speeds:               (stage id, target_speed setting) to set, for SEND
+# moves:                (stage id, command number, data) to send, for SEND
+# move_time:            Predicted seconds for the moves, for SEND
+# stage_ids:            Stages to wait for, or None for all, for WAIT_DEPTH
+PlanAction = namedtuple('PlanAction', ['kind', 'step', 'speeds', 'moves', 'move_time', 'stage_ids'])
+
+# Kinds of LoopAction, with their values
+HOME = 'home'                   # Home the stages
+PAUSE = 'pause'                 # Wait value seconds for the period to pass
+START_SET = 'start set'         # Scan set number value starts
+SCAN = 'scan'                   # Run the scan value
+STOW = 'stow'                   # Go to the stow position
+END_SET = 'end set'             # Scan set number value has finished
+
+LoopAction = namedtuple('LoopAction', ['kind', 'value'])
+
+
+class OverlapPolicy():
+        '''OverlapPolicy(overlap_depth = True, max_sweep_tail = 2.0, depth_tolerance = 0.5,
+                         overlap_transitional = False)
+
+        Bounds how far a step of a plan is overlapped with the next. Once the
+        clip of a step is captured, the moves of the next step for the stages
+        that aren't moving through the depth (X and theta) are sent straight
+        away, without waiting for the move through the depth to finish. There
+        is no overlap when:
+
+          - the move through the depth is predicted to have more than
+            max_sweep_tail seconds left to run, or can't be predicted;
+          - the next step has no clip, unless overlap_transitional. Steps
+            without clips are there to steer the stages clear of walls.
+
+        The stages moving through the depth (z) wait until they finish it,
+        unless overlap_depth and the next step starts them within
+        depth_tolerance units of where the move through the depth ends, so
+        that cutting it short doesn't take them anywhere new.
+        '''
+
+        def __init__(self, overlap_depth = True, max_sweep_tail = 2.0, depth_tolerance = 0.5,
+                     overlap_transitional = False):
+                self.overlap_depth = overlap_depth
+                self.max_sweep_tail = max_sweep_tail
+                self.depth_tolerance = depth_tolerance
+                self.overlap_transitional = overlap_transitional
+
+        def overlap(self, step, next_step, sweep_tail, unit_scales):
+                '''OverlapPolicy.overlap(step, next_step, sweep_tail, unit_scales)
+
+                Split the speeds and moves of next_step into those to send as soon
+                as the clip of step is captured and those to send once its move
+                through the depth has finished. Returns ((speeds, moves), (speeds,
+                moves)), or None if next_step mustn't overlap step at all.
+
+                sweep_tail:     Predicted seconds left of the move through the
+                                depth of step, or None if unknown.
+
+                unit_scales:    (stage id, unit scale) of the stages, as in
+                                ScanPlan.unit_scales.
+                '''
+                if next_step == None or step.clip_duration == None:
+                        return None
+                if next_step.clip_duration == None and not self.overlap_transitional:
+                        return None
+                if sweep_tail == None or sweep_tail > self.max_sweep_tail:
+                        return None
+
+                # Where each stage moving through the depth is heading
+                sweep_ends = dict([ (stage_id, data) for stage_id, code, data in step.clip_moves ])
+                scales = dict(unit_scales)
+
+                early = set()
+                for stage_id, code, data in next_step.moves:
+                        if not sweep_ends.has_key(stage_id):
+                                early.add(stage_id)
+                        elif self.overlap_depth and \
+                                        abs(data - sweep_ends[stage_id]) <= self.depth_tolerance * scales[stage_id]:
+                                early.add(stage_id)
+
+                # A stage moving through the depth keeps its speed until it is moved
+                for stage_id, setting in next_step.speeds:
+                        if not sweep_ends.has_key(stage_id) and not stage_id in early:
+                                early.add(stage_id)
+
+                return ( ( tuple([ speed for speed in next_step.speeds if speed[0] in early ]),
+                           tuple([ move for move in next_step.moves if move[0] in early ]) ),
+                         ( tuple([ speed for speed in next_step.speeds if not speed[0] in early ]),
+                           tuple([ move for move in next_step.moves if not move[0] in early ]) ) )
+
+
+def plan_actions(plan, overlap_policy = None, clock = time):
+        '''plan_actions(plan, overlap_policy = None, clock = time)
+
+        Yield the PlanActions that run the plan: for each step, send its speeds
+        and moves and wait for them, then start its move through the depth,
+        record its clip and wait for the move through the depth to finish.
+
+        With an overlap_policy (see OverlapPolicy), the moves of the next step
+        are sent as soon as each clip is captured, as far as the policy allows,
+        before waiting for the move through the depth. clock returns the time
+        in seconds, and is read as each clip is started and once it has been
+        recorded to tell how much of the move through the depth is left.
+        '''
+        next_step_sent = False
+        for index, step in enumerate(plan.steps):
+                log.debug("Step %i of scan %s", step.number, plan.scan_id)
+
+                # Unless they went out while the last clip finished
+                if not next_step_sent:
+                        yield PlanAction(SEND, step, step.speeds, step.moves, step.move_time, None)
+                next_step_sent = False
+
+                yield PlanAction(WAIT_MOVE, step, (), (), None, None)
+
+                # If this scan point has no time value, there is no video to record
+                # Probably a transitional point that is just there to avoid crashing
+                # into walls.
+                if step.clip_duration == None:
+                        log.info("Point has no time value. Skipping z1 and video")
+                        continue
+
+                # Start the move through the depth and record the clip
+                yield PlanAction(SEND, step, step.clip_speeds, step.clip_moves, step.clip_move_time, None)
+                sweep_start = clock()
+                yield PlanAction(RECORD, step, (), (), None, None)
+
+                overlap = None
+                if not overlap_policy == None:
+                        if index + 1 < len(plan.steps):
+                                next_step = plan.steps[index + 1]
+                        else:
+                                next_step = None
+
+                        if step.clip_move_time == None:
+                                sweep_tail = None
+                        else:
+                                sweep_tail = max(0.0, step.clip_move_time - (clock() - sweep_start))
+
+                        overlap = overlap_policy.overlap(step, next_step, sweep_tail, plan.unit_scales)
+
+                if overlap == None:
+                        yield PlanAction(WAIT_DEPTH, step, (), (), None, None)
+                        continue
+
+                (early_speeds, early_moves), (late_speeds, late_moves) = overlap
+                log.debug("Starting scan point %d with %s, then %s" % (next_step.number, str(early_moves), str(late_moves)))
+
+                yield PlanAction(SEND, next_step, early_speeds, early_moves, next_step.move_time, None)
+
+                if late_speeds or late_moves:
+                        # The stages moving through the depth finish first
+                        yield PlanAction(WAIT_DEPTH, step, (), (), None,
+                                         tuple([ stage_id for stage_id, code, data in step.clip_moves ]))
+                        yield PlanAction(SEND, next_step, late_speeds, late_moves, next_step.move_time, None)
+
+                next_step_sent = True
+
+
+def scan_loop(scans, period = 0.0, num_scans = 1, continuous = False, duration = None,
+              home_on_start = True, home_between = True, clock = time):
+        '''scan_loop(scans, period = 0.0, num_scans = 1, continuous = False, duration = None,
+                     home_on_start = True, home_between = True, clock = time)
+
+        Yield the LoopActions of the scancam main loop: home, then run the list
+        of scans as a scan set at most every period seconds, homing between
+        scans and homing and stowing at the end of each set, for num_scans sets
+        or, if continuous, until duration seconds have passed (or for ever if
+        duration is None). clock returns the time in seconds.
+        '''
+        start = clock()
+        if home_on_start:
+                yield LoopAction(HOME, None)
+
+        completed_scan_sets = 0
+        last_scan_start_time = None
+        while True:
+                if not last_scan_start_time == None and clock() < last_scan_start_time + period:
+                        yield LoopAction(PAUSE, last_scan_start_time + period - clock())
+
+                if continuous and not duration == None and clock() - start >= duration:
+                        break
+
+                last_scan_start_time = clock()
+                yield LoopAction(START_SET, completed_scan_sets + 1)
+                for scan in scans:
+                        # Home between scans to prophylactically avoid locational drift
+                        if home_between:
+                                yield LoopAction(HOME, None)
+                        yield LoopAction(SCAN, scan)
+
+                # Move to stow position. You never know when an astronaut is going to
+                # want to remove us.
+                yield LoopAction(HOME, None)
+                yield LoopAction(STOW, None)
+
+                completed_scan_sets += 1
+                yield LoopAction(END_SET, completed_scan_sets)
+
+                if not continuous and completed_scan_sets == num_scans:
+                        break
+
+
+def expected_time(plan):
+        '''expected_time(plan)
+
+        Return the expected seconds to run the plan, or None if it can't be
+        predicted.
+        '''
+        if not plan.steps:
+                return 0.0
+        return plan.steps[-1].end_time
+
+
+def travel_time(plan):
+        '''travel_time(plan)
+
+        Return the predicted seconds spent moving between the points of the
+        plan, or None if it can't be predicted.
+        '''
+        total = 0.0
+        for step in plan.steps:
+                if step.move_time == None:
+                        return None
+                total = total + step.move_time
+        return total
+
+
+def clip_time(plan):
+        '''clip_time(plan)
+
+        Return the seconds of video the plan records.
+        '''
+        return sum([ step.clip_duration for step in plan.steps if not step.clip_duration == None ])
+
+
+def format_seconds(seconds):
+        if seconds == None:
+                return 'unknown'
+        return '%.1f s' % seconds
+
+
+def describe(plan):
+        '''describe(plan)
+
+        Return a one line summary of the plan: its points, clips and expected
+        times.
+        '''
+        clips = len([ step for step in plan.steps if not step.clip_duration == None ])
+        return "Scan %s: %i points, %i clips; travel %s, video %s, expected total %s" \
+                % (plan.scan_id, len(plan.steps), clips, format_seconds(travel_time(plan)),
+                   format_seconds(clip_time(plan)), format_seconds(expected_time(plan)))
+
+
+def describe_steps(plan):
+        '''describe_steps(plan)
+
+        Return a list of lines describing each step of the plan: the moves and
+        speed changes it sends and when its clip is expected.
+        '''
+        lines = []
+        for step in plan.steps:
+                line = "  %3i  move %s" % (step.number, format_seconds(step.move_time))
+                if step.speeds:
+                        line += "  speeds " + str(list(step.speeds))
+                line += "  moves " + str(list(step.moves))
+                if not step.clip_duration == None:
+                        line += "  clip %i s at %s (%s*)" % (step.clip_duration, format_seconds(step.start_time),
+                                                           step.filename_base)
+                lines.append(line)
+        return lines
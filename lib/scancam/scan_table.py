@@ -0,0 +1,401 @@
+'''Columnar scan point storage
+
+A ScanTable holds the points of a scan in a numpy structured array, one
+column per scan point key, rather than as a list of dictionaries. Rows are
+read and written through ScanPoint views, which behave like the point
+dictionaries they replace (point['x'], point.has_key('z1'), str(point)), so
+code written for lists of dictionaries works unchanged.
+
+The point-id and area-id strings are interned: each distinct id is stored once
+and the rows hold its index. z0, z1 and t are nullable, as a point without
+them is a different kind of point (see ScanBase). Keys outside the columns
+are kept per row in a dictionary.
+
+Needs numpy.
+'''
+import numpy
+
+# Columns of float values. x and y are always present.
+FLOAT_COLUMNS = ('x', 'y', 'z0', 'z1', 't')
+REQUIRED_COLUMNS = ('x', 'y')
+NULLABLE_COLUMNS = ('z0', 'z1', 't')
+
+# Columns of interned ids, held as indices into ScanTable.ids (-1 if absent)
+ID_COLUMNS = ('point-id', 'area-id')
+
+# Bit in the present column for each nullable column
+present_bits = dict([ (column, 1 << bit) for bit, column in enumerate(NULLABLE_COLUMNS) ])
+
+# The order keys come out of keys() in, as far as the row has them
+COLUMN_ORDER = FLOAT_COLUMNS + ID_COLUMNS
+column_keys = set(COLUMN_ORDER)
+
+scan_point_dtype = numpy.dtype( [ (column, 'f8') for column in FLOAT_COLUMNS ] +
+                                [ (column, 'i4') for column in ID_COLUMNS ] +
+                                [ ('present', 'u1') ] )
+
+
+class ScanPoint():
+        '''ScanPoint(table, index)
+
+        View of row index of a ScanTable that behaves like a scan point
+        dictionary. Changes made through it are made to the table.
+        '''
+
+        def __init__(self, table, index):
+                self.table = table
+                self.index = index
+
+        def __getitem__(self, key):
+                return self.table.get_value(self.index, key)
+
+        def __setitem__(self, key, value):
+                self.table.set_value(self.index, key, value)
+
+        def __delitem__(self, key):
+                self.table.delete_value(self.index, key)
+
+        def has_key(self, key):
+                return self.table.has_value(self.index, key)
+
+        __contains__ = has_key
+
+        def get(self, key, default = None):
+                if not self.has_key(key):
+                        return default
+                return self[key]
+
+        def keys(self):
+                return self.table.row_keys(self.index)
+
+        def __iter__(self):
+                return iter(self.keys())
+
+        def __len__(self):
+                return len(self.keys())
+
+        def items(self):
+                return [ (key, self[key]) for key in self.keys() ]
+
+        def values(self):
+                return [ self[key] for key in self.keys() ]
+
+        def to_dict(self):
+                '''ScanPoint.to_dict()
+
+                Return the point as a dictionary.
+                '''
+                return dict(self.items())
+
+        def copy(self):
+                return self.to_dict()
+
+        def __eq__(self, other):
+                if isinstance(other, ScanPoint):
+                        other = other.to_dict()
+                return self.to_dict() == other
+
+        def __ne__(self, other):
+                return not self == other
+
+        def __repr__(self):
+                return repr(self.to_dict())
+
+
+class ScanTable():
+        '''ScanTable(points = ())
+
+        Scan points held column by column in a numpy structured array of
+        scan_point_dtype. Behaves like the list of scan point dictionaries it
+        replaces: it can be appended to, indexed, iterated over and measured
+        with len(), and its points are ScanPoint views.
+
+        points:         Scan point dictionaries (or ScanPoints) to start with.
+        '''
+
+        def __init__(self, points = ()):
+                self.rows = numpy.zeros(16, dtype = scan_point_dtype)
+                self.count = 0
+
+                # Interned ids, and the index of each in ids
+                self.ids = []
+                self.id_index = {}
+
+                # Keys outside the columns, by row
+                self.extras = {}
+
+                # Rows appended but not yet written to rows, as tuples
+                self.pending = []
+
+                self.extend(points)
+
+        def __len__(self):
+                return self.count + len(self.pending)
+
+        def flush(self):
+                '''ScanTable.flush()
+
+                Write the rows appended since the last flush into the array.
+                Appending one row at a time is kept cheap by collecting the rows
+                until they are read.
+                '''
+                if not self.pending:
+                        return None
+
+                pending = numpy.array(self.pending, dtype = scan_point_dtype)
+                self.pending = []
+
+                first = self.add_rows(len(pending))
+                self.rows[first:self.count] = pending
+
+        def __getitem__(self, index):
+                self.flush()
+
+                if isinstance(index, slice):
+                        return [ ScanPoint(self, each_index) for each_index in range(*index.indices(self.count)) ]
+
+                if index < 0:
+                        index = index + self.count
+                if index < 0 or index >= self.count:
+                        raise IndexError('scan point index out of range')
+
+                return ScanPoint(self, index)
+
+        def __iter__(self):
+                self.flush()
+                for index in xrange(self.count):
+                        yield ScanPoint(self, index)
+
+        def index_ids(self):
+                '''ScanTable.index_ids()
+
+                Build the index of ids if it hasn't been. Tables read from scan
+                files (see scan_file.py) read their ids lazily and only index them
+                when ids are added.
+                '''
+                if self.id_index == None:
+                        self.ids = list(self.ids)
+                        self.id_index = dict([ (value, index) for index, value in enumerate(self.ids) ])
+
+        def intern(self, value):
+                '''ScanTable.intern(value)
+
+                Return the index of the id value in ids, adding it if it is new.
+                '''
+                self.index_ids()
+                index = self.id_index.get(value)
+                if index == None:
+                        index = len(self.ids)
+                        self.ids.append(value)
+                        self.id_index[value] = index
+                return index
+
+        def intern_all(self, values):
+                '''ScanTable.intern_all(values)
+
+                Return the list of the indices in ids of the id values in the list
+                values, adding those that are new. Quicker than intern() for many.
+                '''
+                self.index_ids()
+                new_values = list(set(values).difference(self.id_index))
+                self.id_index.update(zip(new_values, xrange(len(self.ids), len(self.ids) + len(new_values))))
+                self.ids.extend(new_values)
+
+                return map(self.id_index.__getitem__, values)
+
+        def reserve(self, count):
+                '''ScanTable.reserve(count)
+
+                Make room for count rows in all without reallocating.
+                '''
+                if count > len(self.rows):
+                        rows = numpy.zeros(count, dtype = scan_point_dtype)
+                        rows[:self.count] = self.rows[:self.count]
+                        self.rows = rows
+
+        def add_rows(self, count):
+                '''ScanTable.add_rows(count)
+
+                Add count empty rows (no id or nullable values, x and y of 0) and
+                return the index of the first. Rows still pending are flushed
+                first.
+                '''
+                self.flush()
+
+                first = self.count
+                if first + count > len(self.rows):
+                        self.reserve(max(first + count, 2*len(self.rows)))
+
+                rows = self.rows[first:first + count]
+                rows.fill(0)
+                for column in ID_COLUMNS:
+                        rows[column] = -1
+
+                self.count = first + count
+                return first
+
+        def append(self, point):
+                '''ScanTable.append(point)
+
+                Add the scan point dictionary point to the end of the table.
+                '''
+                row = [ point['x'], point['y'] ]
+
+                present = 0
+                for column in NULLABLE_COLUMNS:
+                        if point.has_key(column):
+                                row.append(point[column])
+                                present = present | present_bits[column]
+                        else:
+                                row.append(0.0)
+
+                for column in ID_COLUMNS:
+                        if point.has_key(column):
+                                row.append(self.intern(point[column]))
+                        else:
+                                row.append(-1)
+
+                row.append(present)
+
+                for key in point.keys():
+                        if not key in column_keys:
+                                index = len(self)
+                                self.extras.setdefault(index, {})[key] = point[key]
+
+                self.pending.append(tuple(row))
+
+        def extend(self, points):
+                for point in points:
+                        self.append(point)
+
+        def get_value(self, index, key):
+                if key in FLOAT_COLUMNS:
+                        if not self.has_value(index, key):
+                                raise KeyError(key)
+                        return float(self.rows[key][index])
+
+                if key in ID_COLUMNS:
+                        id_index = self.rows[key][index]
+                        if id_index < 0:
+                                raise KeyError(key)
+                        return self.ids[id_index]
+
+                extras = self.extras.get(index)
+                if extras == None:
+                        raise KeyError(key)
+                return extras[key]
+
+        def set_value(self, index, key, value):
+                if key in FLOAT_COLUMNS:
+                        self.rows[key][index] = value
+                        if key in present_bits:
+                                self.rows['present'][index] |= present_bits[key]
+
+                elif key in ID_COLUMNS:
+                        self.rows[key][index] = self.intern(value)
+
+                else:
+                        self.extras.setdefault(index, {})[key] = value
+
+        def delete_value(self, index, key):
+                if not self.has_value(index, key):
+                        raise KeyError(key)
+
+                if key in REQUIRED_COLUMNS:
+                        raise KeyError('%s is required in every scan point' % key)
+
+                if key in present_bits:
+                        self.rows['present'][index] &= ~present_bits[key]
+                elif key in ID_COLUMNS:
+                        self.rows[key][index] = -1
+                else:
+                        del self.extras[index][key]
+
+        def has_value(self, index, key):
+                if key in REQUIRED_COLUMNS:
+                        return True
+
+                if key in present_bits:
+                        return bool(self.rows['present'][index] & present_bits[key])
+
+                if key in ID_COLUMNS:
+                        return self.rows[key][index] >= 0
+
+                extras = self.extras.get(index)
+                return not extras == None and extras.has_key(key)
+
+        def row_keys(self, index):
+                keys = [ key for key in COLUMN_ORDER if self.has_value(index, key) ]
+                keys.extend(self.extras.get(index, {}).keys())
+                return keys
+
+        def column(self, key):
+                '''ScanTable.column(key)
+
+                Return the values of the float column key for every row as an
+                array. It is a view, so changing it changes the table. Rows without
+                a value hold 0 (see present()).
+                '''
+                self.flush()
+                return self.rows[key][:self.count]
+
+        def present(self, key):
+                '''ScanTable.present(key)
+
+                Return a boolean array that is true for the rows that have a value
+                for key.
+                '''
+                self.flush()
+                if key in REQUIRED_COLUMNS:
+                        return numpy.ones(self.count, dtype = bool)
+
+                if key in present_bits:
+                        return (self.rows['present'][:self.count] & present_bits[key]) > 0
+
+                if key in ID_COLUMNS:
+                        return self.rows[key][:self.count] >= 0
+
+                return numpy.array([ self.has_value(index, key) for index in xrange(self.count) ],
+                                   dtype = bool)
+
+        def set_column(self, key, values):
+                '''ScanTable.set_column(key, values)
+
+                Set the float column key of every row to values (a single value or
+                an array of one per row).
+                '''
+                self.flush()
+                self.rows[key][:self.count] = values
+                if key in present_bits:
+                        self.rows['present'][:self.count] |= present_bits[key]
+
+        def set_ids(self, key, values):
+                '''ScanTable.set_ids(key, values)
+
+                Set the id column key of every row from the sequence values.
+                '''
+                self.flush()
+                self.rows[key][:self.count] = self.intern_all(list(values))
+
+        def to_points(self):
+                '''ScanTable.to_points()
+
+                Return the scan points as a list of dictionaries.
+                '''
+                return [ point.to_dict() for point in self ]
+
+        def __getstate__(self):
+                self.flush()
+
+                # Only the rows in use are stored
+                state = dict(self.__dict__)
+                state['rows'] = self.rows[:self.count].copy()
+                state['ids'] = list(self.ids)
+                state['extras'] = dict(self.extras)
+                del state['id_index']
+                return state
+
+        def __setstate__(self, state):
+                self.__dict__.update(state)
+                self.id_index = None
+                self.index_ids()
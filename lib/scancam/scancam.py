@@ -10,6 +10,15 @@ import logging, idscam.common.syslogger
 
 log = idscam.common.syslogger.get_syslogger('scancam')
 
+import scan_plan
+from scan_plan import ScanPlan, PlanStep, OverlapPolicy
+
+try:
+        from scan_table import ScanTable
+except ImportError:
+        # Without numpy, scan points are kept in a list of dictionaries
+        ScanTable = None
+
 
 MAX_CLIP_LENGTH = 60                    # seconds
 MAX_Z_MOVE_SPEED = 3.0                  # mm/second
@@ -19,6 +28,114 @@ verbose_for_scan_build = False
 
 
 
+def empty_scanpoints():
+        '''empty_scanpoints()
+
+        Return an empty container for scan points: a ScanTable, or a list of
+        dictionaries if numpy isn't available. Both are appended to with point
+        dictionaries and give points that are read like dictionaries.
+        '''
+        if ScanTable == None:
+                return []
+        return ScanTable()
+
+
+def target_grid_points(origins, target_width = 19.1, target_height = 26.8,
+                       num_h_scan_points = 1, num_v_scan_points = 1, just_corners = False,
+                       always_start_z0 = False):
+        '''target_grid_points(origins, target_width = 19.1, target_height = 26.8,
+                              num_h_scan_points = 1, num_v_scan_points = 1, just_corners = False,
+                              always_start_z0 = False)
+
+        Return the list of scan point dictionaries for ScanBase.build_scan_from_target_origins(),
+        built one point at a time. See there for the arguments. scan_grid.target_grid() builds
+        the same points with numpy.
+        '''
+
+        cell_width = target_width/float(num_h_scan_points)
+        cell_height = target_height/float(num_v_scan_points)
+
+        # Iterate across rows and up columns to scan each target
+        scanpoints = []
+        first_z_last_time = ''
+        area_num = 0
+        for origin in origins:
+                area_num += 1
+                # The center of the first cell isn't the corner, it's half a cell over (and up)
+                x0 = origin['x'] + cell_width/2.0
+                y0 = origin['y'] + cell_height/2.0
+                for jj in range(num_v_scan_points):
+                        for ii in range(num_h_scan_points):
+                                scan_point = {}
+                                
+                                # It is useful for location calibration to be able to find the corners of the
+                                # wells. So with a True just_corners value we adjust the algorithm to skip all
+                                # locations except the four corners of the area.
+                                if not just_corners:
+                                        i = ii
+                                        j = jj
+                                else:
+                                        i = ii*(num_h_scan_points-1)
+                                        j = jj*(num_v_scan_points-1)
+                                        if ii > 1 or jj > 1:
+                                                break
+
+                                # Count even rows up and odd rows down to skip track back to 0
+                                if j%2 == 0:
+                                        scan_point['x'] = x0 + i*cell_width
+                                if j%2 == 1:
+                                        scan_point['x'] = x0 + (num_h_scan_points-1-i)*cell_width
+
+                                scan_point['y'] = y0 + j*cell_height
+
+                                # If the always_start_z0 flag is true, spoof the tracking flag to always 
+                                # start with the origin point's z0 value
+                                if always_start_z0 == True:
+                                        first_z_last_time = 'z1'
+
+                                # If there is a second z-axis value, alternate which one you
+                                # start with to avoid waiting for z to get back to z0 every time
+                                if origin.has_key('z1'):
+                                        if first_z_last_time != 'z0':
+                                                scan_point['z0'] = origin['z0']
+                                                scan_point['z1'] = origin['z1']
+                                                first_z_last_time = 'z0'
+                                        else:
+                                                scan_point['z0'] = origin['z1']
+                                                scan_point['z1'] = origin['z0']
+                                                first_z_last_time = 'z1'
+                                # If there's no second z value, just use the one you have
+                                else:
+                                        if scan_point.has_key('z0'):
+                                                scan_point['z0'] = origin['z0']
+                                                
+                                # Add cell identifier
+                                if origin.has_key('area-id'):
+                                        area_id = origin['area-id']
+                                else:
+                                        area_id = str(area_num)
+                                scan_point['point-id'] = "%s-%d-%d" % ( area_id, j+1, i+1)
+
+                                # Assign target areas id to point. This may be useful later when
+                                # calibrating in cases where a given calibration is to be applied
+                                # to all points in a target area. If none given, serialize.
+                                if origin.has_key('area-id'):
+                                        scan_point['area-id'] = origin['area-id']
+                                else:
+                                        scan_point['area-id'] = area_num
+                                        
+                                # Propagate any items that we haven't explicitly handled through
+                                # from the origin to this point. Likely to include t 
+                                for key in origin:
+                                        if not scan_point.has_key(key):
+                                                scan_point[key] = origin[key]
+
+                                # We're done with that point, add it to the new scan
+                                scanpoints.append( scan_point )
+
+        return scanpoints
+
+
 class ScanBase():
         '''ScanBase(id = None, video_params = None)
 
@@ -32,7 +149,9 @@ class ScanBase():
                         specified the camera will use its default values.
         
         Each scan is a sequential list of dictionaries, each of which represents a single
-        scan point. Each point must minimally include 'x' and 'y' keys.
+        scan point. Each point must minimally include 'x' and 'y' keys. Where numpy is
+        available, the list is a ScanTable whose points are read like dictionaries (see
+        scan_table.py).
 
         The dictionaries may optionally also include the following keys:
            'z0' -      The depth setting for a given scan point. When used with 'z1', the
@@ -62,7 +181,32 @@ class ScanBase():
                 # TODO: Compare video params keys against valid camera options?
                 self.video_format_params = video_format_params
                 
-                self.scanpoints = []
+                self.scanpoints = empty_scanpoints()
+
+                # Stage targets planned for the scan by scancams, by plan key
+                self.stage_plans = {}
+
+        def cached_plan(self, key):
+                '''ScanBase.cached_plan(key)
+
+                Return the plan stored with the scan under key by cache_plan(), or
+                None if there isn't one.
+                '''
+                # Scans pickled before plans were cached have no stage_plans
+                if not hasattr(self, 'stage_plans'):
+                        return None
+                return self.stage_plans.get(key)
+
+        def cache_plan(self, key, plan):
+                '''ScanBase.cache_plan(key, plan)
+
+                Store a plan with the scan under key, so that a scancam running the
+                scan again doesn't have to plan it again. key should capture
+                everything the plan depends on, including the scan points.
+                '''
+                if not hasattr(self, 'stage_plans'):
+                        self.stage_plans = {}
+                self.stage_plans[key] = plan
 
         def get_id(self):
                 '''ScanBase.get_id()
@@ -128,88 +272,26 @@ class ScanBase():
 
                 t values are constant for each target and assigned to all scan points
                 '''
-        
-                cell_width = target_width/float(num_h_scan_points)
-                cell_height = target_height/float(num_v_scan_points)
-
-                # Iterate across rows and up columns to scan each target
-                self.scanpoints = []
-                first_z_last_time = ''
-                area_num = 0
-                for origin in origins:
-                        area_num += 1
-                        # The center of the first cell isn't the corner, it's half a cell over (and up)
-                        x0 = origin['x'] + cell_width/2.0
-                        y0 = origin['y'] + cell_height/2.0
-                        for jj in range(num_v_scan_points):
-                                for ii in range(num_h_scan_points):
-                                        scan_point = {}
-                                        
-                                        # It is useful for location calibration to be able to find the corners of the
-                                        # wells. So with a True just_corners value we adjust the algorithm to skip all
-                                        # locations except the four corners of the area.
-                                        if not just_corners:
-                                                i = ii
-                                                j = jj
-                                        else:
-                                                i = ii*(num_h_scan_points-1)
-                                                j = jj*(num_v_scan_points-1)
-                                                if ii > 1 or jj > 1:
-                                                        break
-
-                                        # Count even rows up and odd rows down to skip track back to 0
-                                        if j%2 == 0:
-                                                scan_point['x'] = x0 + i*cell_width
-                                        if j%2 == 1:
-                                                scan_point['x'] = x0 + (num_h_scan_points-1-i)*cell_width
-
-                                        scan_point['y'] = y0 + j*cell_height
-
-                                        # If the always_start_z0 flag is true, spoof the tracking flag to always 
-                                        # start with the origin point's z0 value
-                                        if always_start_z0 == True:
-                                                first_z_last_time = 'z1'
-
-                                        # If there is a second z-axis value, alternate which one you
-                                        # start with to avoid waiting for z to get back to z0 every time
-                                        if origin.has_key('z1'):
-                                                if first_z_last_time != 'z0':
-                                                        scan_point['z0'] = origin['z0']
-                                                        scan_point['z1'] = origin['z1']
-                                                        first_z_last_time = 'z0'
-                                                else:
-                                                        scan_point['z0'] = origin['z1']
-                                                        scan_point['z1'] = origin['z0']
-                                                        first_z_last_time = 'z1'
-                                        # If there's no second z value, just use the one you have
-                                        else:
-                                                if scan_point.has_key('z0'):
-                                                        scan_point['z0'] = origin['z0']
-                                                        
-                                        # Add cell identifier
-                                        if origin.has_key('area-id'):
-                                                area_id = origin['area-id']
-                                        else:
-                                                area_id = str(area_num)
-                                        scan_point['point-id'] = "%s-%d-%d" % ( area_id, j+1, i+1)
-
-                                        # Assign target areas id to point. This may be useful later when
-                                        # calibrating in cases where a given calibration is to be applied
-                                        # to all points in a target area. If none given, serialize.
-                                        if origin.has_key('area-id'):
-                                                scan_point['area-id'] = origin['area-id']
-                                        else:
-                                                scan_point['area-id'] = area_num
-                                                
-                                        # Propagate any items that we haven't explicitly handled through
-                                        # from the origin to this point. Likely to include t 
-                                        for key in origin:
-                                                if not scan_point.has_key(key):
-                                                        scan_point[key] = origin[key]
+                grid_args = { 'target_width': target_width,
+                              'target_height': target_height,
+                              'num_h_scan_points': num_h_scan_points,
+                              'num_v_scan_points': num_v_scan_points,
+                              'just_corners': just_corners,
+                              'always_start_z0': always_start_z0 }
+
+                # Route optimization mustn't swap z0 and z1 of a scan built not to
+                self.always_start_z0 = always_start_z0
+
+                if ScanTable == None:
+                        self.scanpoints = target_grid_points(origins, **grid_args)
+                else:
+                        # Every point of every target at once
+                        import scan_grid
+                        self.scanpoints = scan_grid.target_grid(origins, **grid_args)
 
-                                        # We're done with that point, add it to the new scan
-                                        self.scanpoints.append( scan_point )
-                                        if verbose: print "Appended " + str(scan_point)
+                if verbose:
+                        for scan_point in self.scanpoints:
+                                print "Appended " + str(scan_point)
 
 
 
@@ -292,8 +374,11 @@ class SixWellBioCellScan(ScanBase):
                         return
 
                 # Add the video clip duration for each point
-                for scanpoint in self.scanpoints:
-                        scanpoint['t'] = clip_duration
+                if hasattr(self.scanpoints, 'set_column'):
+                        self.scanpoints.set_column('t', clip_duration)
+                else:
+                        for scanpoint in self.scanpoints:
+                                scanpoint['t'] = clip_duration
 
         def generate_well_origins( self, starting_well_origin, rotation_orientation_id ):
                 '''generate_well_origins( starting_well_origin )
@@ -370,7 +455,9 @@ def xtz2xyz(xtz, arm_length = 55.0):
 
 
 class ScanCamBase():
-        '''ScanCamBase(stages, camera, scancam_id = None, camera_warmup = 0.0, stage_timeout = 100)
+        '''ScanCamBase(stages, camera, scancam_id = None, camera_warmup = 0.0, stage_timeout = 100, 
+                       timeout_margin = 0.5, timeout_floor = 5.0, overlap_policy = None,
+                       compression_ratio = 0.0)
 
         Base class for scacncams.
 
@@ -385,11 +472,28 @@ class ScanCamBase():
         camera_warmup:  Seconds that it takes to warm up camera. Used to calculate second
                         depth move speed so that the move fudges closer to the clip duration
 
-        stage_timeout:  Number of seconds to wait for stage moves before timing out.
+        stage_timeout:  Number of seconds to wait for stage moves before timing out,
+                        when the duration of the moves can't be predicted.
+
+        timeout_margin: Fraction of the predicted duration of a move allowed on
+                        top of it before timing out.
+
+        timeout_floor:  Minimum number of seconds to wait for any move before
+                        timing out.
+
+        overlap_policy: OverlapPolicy (see scan_plan.py) for scan_action() to
+                        overlap each scan point with the next by, or None to
+                        run them one after the other.
+
+        compression_ratio:  Seconds the camera is expected to take compressing
+                        each second of video before the scan moves on. Only
+                        used for the expected times of compiled plans, and 0
+                        when clips are compressed in the background.
         '''
 
 
-        def __init__(self, stages, camera, scancam_id = None, camera_warmup = 0.0, stage_timeout = 100, target_video_dir = None):
+        def __init__(self, stages, camera, scancam_id = None, camera_warmup = 0.0, stage_timeout = 100, target_video_dir = None,
+                     timeout_margin = 0.5, timeout_floor = 5.0, overlap_policy = None, compression_ratio = 0.0):
 
                 self.stages = stages
                 self.camera = camera
@@ -398,6 +502,15 @@ class ScanCamBase():
                 self.id = scancam_id
                 self.camera_warmup = camera_warmup
                 self.stage_timeout = stage_timeout
+                self.timeout_margin = timeout_margin
+                self.timeout_floor = timeout_floor
+                self.overlap_policy = overlap_policy
+                self.compression_ratio = compression_ratio
+
+                # The predicted duration of the moves last sent and the time by
+                # which they should be complete, or None if not known
+                self.expected_move_time = None
+                self.move_deadline = None
                 if target_video_dir == None:
                         # Default to current directory if none given
                         self.target_video_dir = getcwd()
@@ -415,22 +528,79 @@ class ScanCamBase():
                 return self.id
 
 
-        def wait_for_stages_to_complete_actions(self):
-                '''ScanCamBase.wait_for_stages_to_complete_actions()
+        def wait_for_stages_to_complete_actions(self, stage_ids = None):
+                '''ScanCamBase.wait_for_stages_to_complete_actions(stage_ids = None)
 
                 For each scancam stage, wait until .in_action() returns False, and timeout
-                if it takes too long.
+                if it takes too long. All of the stages share a single deadline: the one
+                set by expect_moves() for the moves last sent, or stage_timeout seconds
+                from the start of the wait if their duration isn't known.
+
+                stage_ids:      Ids of the stages to wait for, if not all of them.
+                                The deadline is then kept for the others.
                 '''
-                # TODO: Fix timing such that if takes first stage X seconds to
-                # get to its target then next stage doesn't have a cumulative
-                # wait of up to X + timeout_secs
+                if self.move_deadline == None:
+                        timeout = self.stage_timeout
+                else:
+                        timeout = max(0.0, self.move_deadline - time())
+
+                if stage_ids == None:
+                        stages = self.stages.values()
+                else:
+                        stages = [ self.stages[stage_id] for stage_id in stage_ids ]
+
                 try:
-                        for stage in self.stages.values():
-                                stage.wait_for_action_to_complete( self.stage_timeout )
-                except zaber_device.DeviceTimeoutError, stage_id:
+                        zaber_device.wait_for_devices_to_complete_actions( stages,
+                                                                           timeout,
+                                                                           expected = self.expected_move_time )
+                except zaber_device.DeviceTimeoutError:
                         # If one device times out, stop all of them
                         self.stop()
                         raise
+                finally:
+                        if stage_ids == None:
+                                self.expected_move_time = None
+                                self.move_deadline = None
+
+
+        def move_timeout(self, expected_move_time):
+                '''ScanCamBase.move_timeout(expected_move_time)
+
+                Return the number of seconds to allow for moves expected to take
+                expected_move_time seconds: that plus timeout_margin of it, but no
+                less than timeout_floor.
+                '''
+                return max(self.timeout_floor, expected_move_time * (1.0 + self.timeout_margin))
+
+
+        def expect_moves(self, expected_move_time):
+                '''ScanCamBase.expect_moves(expected_move_time)
+
+                Set the deadline for the moves just sent from the number of seconds
+                they are expected to take (see predict_move_time()). If moves already
+                under way have a later deadline, it is kept. If expected_move_time is
+                None, the moves are waited on for stage_timeout seconds.
+                '''
+                if expected_move_time == None:
+                        move_deadline = time() + self.stage_timeout
+                else:
+                        move_deadline = time() + self.move_timeout(expected_move_time)
+
+                if self.move_deadline == None or move_deadline > self.move_deadline:
+                        self.expected_move_time = expected_move_time
+                        self.move_deadline = move_deadline
+
+
+        def try_predict_move_time(self, targets):
+                '''ScanCamBase.try_predict_move_time(targets)
+
+                Return predict_move_time(targets), or None if the settings needed
+                to predict it haven't been read from the stages.
+                '''
+                try:
+                        return self.predict_move_time(targets)
+                except KeyError:
+                        return None
 
 
         def build_timestring(self, t):
@@ -458,14 +628,20 @@ class ScanCamBase():
 
                 Send home command to all stages and wait to complete
                 '''
+                home_positions = {}
+                for stage_id in self.stages:
+                        home_positions[stage_id] = 0
+                expected_move_time = self.try_predict_move_time(home_positions)
+
                 for stage in self.stages.values():
                         stage.home()
                         stage.step()
+                self.expect_moves(expected_move_time)
 
                 try:
                         self.wait_for_stages_to_complete_actions()
-                except zaber_device.DeviceTimeoutError, device_id:
-                        log.warning("Device %d timed out during homing" % device_id)
+                except zaber_device.DeviceTimeoutError, error:
+                        log.warning("Timed out during homing: %s" % error)
                         raise
 
 
@@ -482,13 +658,15 @@ class ScanCamBase():
                 wait_for_move_to_complete:  If true wait until all devices are
                                 no longer active before returning.
                 '''
+                # Predicted from where the stages are before they move
+                expected_move_time = self.try_predict_move_time(stage_targets)
+
                 for stage_id in stage_targets:
                         # Enqueue scan point move commands
                         self.stages[stage_id].move_absolute( stage_targets[stage_id] )
 
-                for stage_id in stage_targets:
-                        # Step to next queued scan point for all axes
-                        self.stages[stage_id].step()
+                self.step_stages( stage_targets.keys() )
+                self.expect_moves(expected_move_time)
 
                 # Return if we don't have to wait for the moves
                 if not wait_for_completion: return
@@ -496,10 +674,200 @@ class ScanCamBase():
                 # Wait for all moves to complete
                 try:
                         self.wait_for_stages_to_complete_actions()
-                except zaber_device.DeviceTimeoutError, device_id:
-                        log.critical("Device %d timed out during move for scan point %d" % (device_id, scan_point_num))
+                except zaber_device.DeviceTimeoutError, error:
+                        log.critical("Timed out during move to %s: %s" % (str(stage_targets), error))
                         raise
 
+                log.debug("Stages at " + str(self.stage_positions()))
+
+
+        def step_stages(self, stage_ids):
+                '''ScanCamBase.step_stages(stage_ids)
+
+                Send the next queued command of each of the stages in stage_ids.
+                The writes are held back so that the commands for all axes go out
+                together in a single write.
+                '''
+                connections = set([self.stages[stage_id].connection for stage_id in stage_ids])
+                for connection in connections:
+                        connection.hold_writes()
+                try:
+                        for stage_id in stage_ids:
+                                # Step to next queued scan point for all axes
+                                self.stages[stage_id].step()
+                finally:
+                        for connection in connections:
+                                connection.release_writes()
+
+
+        def send_moves(self, moves, expected_move_time):
+                '''ScanCamBase.send_moves(moves, expected_move_time)
+
+                Send compiled moves, a sequence of (stage id, command number, data),
+                together and set their deadline from expected_move_time (see
+                expect_moves()). Doesn't wait for them.
+                '''
+                for stage_id, code, data in moves:
+                        self.stages[stage_id].enqueue_code(code, data)
+
+                self.step_stages( [ stage_id for stage_id, code, data in moves ] )
+                self.expect_moves(expected_move_time)
+
+
+        def stage_positions(self, max_age = None):
+                '''ScanCamBase.stage_positions(max_age = None)
+
+                Return a dictionary of the stage positions in scientific units,
+                keyed by stage id. The positions are the last ones reported by
+                the stages, so no commands are sent. A position is None if the
+                stage hasn't reported one, is moving or reported it more than 
+                max_age seconds ago.
+                '''
+                positions = {}
+                for stage_id in self.stages:
+                        positions[stage_id] = self.stages[stage_id].cached_position(max_age)
+                return positions
+
+
+        def stages2xyz(self, stage_positions):
+                '''ScanCamBase.stages2xyz(stage_positions)
+
+                Convert a dictionary of stage positions to the scan coordinates.
+                The base class has no geometry, so the stage ids are the axes.
+                '''
+                return dict(stage_positions)
+
+
+        def current_position(self, max_age = None):
+                '''ScanCamBase.current_position(max_age = None)
+
+                Return the current position in scan coordinates (e.g. 
+                {'x': <>, 'y': <>, 'z': <>}) from the positions last reported
+                by the stages. Returns None if any stage position isn't known
+                (see stage_positions()).
+                '''
+                positions = self.stage_positions(max_age)
+                if None in positions.values():
+                        return None
+                return self.stages2xyz(positions)
+
+
+        def predict_move_time(self, targets, start = None):
+                '''ScanCamBase.predict_move_time(targets, start = None)
+
+                Return the number of seconds move_stages(targets) is expected to
+                take, from the kinematic models of the stages. The stages move
+                together, so this is the time of the slowest.
+
+                targets:        Dictionary of stage targets, as for move_stages().
+
+                start:          Dictionary of stage positions to move from. Stages
+                                missing from it move from the last position they
+                                reported.
+                '''
+                if start == None:
+                        start = {}
+
+                move_time = 0.0
+                for stage_id in targets:
+                        stage_time = self.stages[stage_id].predict_move_time( targets[stage_id],
+                                                                              start.get(stage_id) )
+                        move_time = max(move_time, stage_time)
+                return move_time
+
+
+        def stage_spans(self):
+                '''ScanCamBase.stage_spans()
+
+                Return a dictionary of the travel of each stage in scientific units,
+                keyed by stage id, for weighing moves against each other when the
+                stage settings haven't been read. The base class doesn't know the
+                travel of its stages, so it is empty and moves are weighed by
+                distance.
+                '''
+                return {}
+
+
+        def target_move_cost(self, stage_ids = None):
+                '''ScanCamBase.target_move_cost(stage_ids = None)
+
+                Return a function cost(a, b) giving the seconds to move from one
+                dictionary of stage targets to another, from the kinematic models
+                of the stages in stage_ids (all of them by default). Only the stages
+                in both a and b are counted. The stages move together, so it is the
+                time of the slowest. If the stage settings haven't been read, the
+                cost is the largest fraction of the travel of any stage instead (see
+                stage_spans()).
+                '''
+                if stage_ids == None:
+                        stage_ids = self.stages.keys()
+
+                try:
+                        models = dict([ (stage_id, self.stages[stage_id].kinematic_model())
+                                        for stage_id in stage_ids ])
+                except KeyError:
+                        spans = self.stage_spans()
+                        spans = dict([ (stage_id, float(spans.get(stage_id, 1.0))) for stage_id in stage_ids ])
+
+                        def cost(a, b):
+                                move_cost = 0.0
+                                for stage_id in spans:
+                                        if a.has_key(stage_id) and b.has_key(stage_id):
+                                                move_cost = max(move_cost, abs(b[stage_id] - a[stage_id])/spans[stage_id])
+                                return move_cost
+
+                        return cost
+
+                def cost(a, b):
+                        move_cost = 0.0
+                        for stage_id in models:
+                                if a.has_key(stage_id) and b.has_key(stage_id):
+                                        move_cost = max(move_cost, models[stage_id].move_time(a[stage_id], b[stage_id]))
+                        return move_cost
+
+                return cost
+
+
+        def xy_candidates(self, xy_point):
+                '''ScanCamBase.xy_candidates(xy_point)
+
+                Return the list of the stage targets that put the camera over the
+                x,y point. The base class has no geometry, so there is one: the
+                point itself.
+                '''
+                return [ {'x': xy_point['x'], 'y': xy_point['y']} ]
+
+
+        def plan_xy(self, xy_points):
+                '''ScanCamBase.plan_xy(xy_points)
+
+                Return the stage targets for the x and y of each point in the list
+                xy_points, one of the xy_candidates() of each.
+                '''
+                return [ self.xy_candidates(point)[0] for point in xy_points ]
+
+
+        def home_position(self):
+                '''ScanCamBase.home_position()
+
+                Return the position in scan coordinates that home() leaves the
+                stages at.
+                '''
+                return self.stages2xyz( dict([ (stage_id, 0.0) for stage_id in self.stages ]) )
+
+
+        def plan_scan(self, xyz_scan, start = None):
+                '''ScanCamBase.plan_scan(xyz_scan, start = None)
+
+                Return a list of the stage targets for the x and y of each scan
+                point, or None if the scancam has no planner. Without a plan,
+                scan_action() converts each point as it is reached by move().
+
+                start is the dictionary of stage positions the scan starts from
+                (home if None), for planners that count the move to the first point.
+                '''
+                return None
+
 
         def in_action(self):
                 '''ScanCamBase.in_action()
@@ -512,17 +880,85 @@ class ScanCamBase():
                 return in_action
         
 
-        def scan_action(self, xyz_scan):
+        def kinematic_models(self):
+                '''ScanCamBase.kinematic_models()
 
-                scan_point_num = 0
-                for point in xyz_scan.scanpoints:
+                Return the kinematic model of each stage (see
+                zaber_device.kinematic_model()), keyed by stage id, or None if the
+                settings needed for them haven't been read.
+                '''
+                try:
+                        return dict([ (stage_id, self.stages[stage_id].kinematic_model())
+                                      for stage_id in self.stages ])
+                except KeyError:
+                        return None
+
+
+        def plan_move_time(self, models, speed_settings, positions, targets):
+                '''ScanCamBase.plan_move_time(models, speed_settings, positions, targets)
+
+                Return the predicted seconds to move the stages from positions to
+                targets (dictionaries keyed by stage id), with the target_speed
+                settings in speed_settings in place of those of the models. A stage
+                with no known position is taken to cross its full travel. Returns
+                None if it can't be predicted.
+                '''
+                if models == None:
+                        return None
+
+                move_time = 0.0
+                for stage_id in targets:
+                        model = models[stage_id]
+                        if speed_settings.has_key(stage_id):
+                                model = model.with_target_speed( speed_settings[stage_id] )
+
+                        if positions.get(stage_id) == None:
+                                stage_time = model.full_travel_time()
+                        else:
+                                stage_time = model.move_time( positions[stage_id], targets[stage_id] )
+
+                        if stage_time == None:
+                                return None
+                        move_time = max(move_time, stage_time)
+                return move_time
+
+
+        def compile_scan(self, xyz_scan, start = None):
+                '''ScanCamBase.compile_scan(xyz_scan, start = None)
 
+                Work out everything needed to run xyz_scan before running it, and
+                return it as a ScanPlan (see scan_plan.py) for run_plan().
+
+                start:          Dictionary of the stage positions the scan starts
+                                from, keyed by stage id. Defaults to the positions
+                                last reported by the stages.
+
+                Raises ValueError if the move through the depth of a point would
+                have to be faster than MAX_Z_MOVE_SPEED.
+                '''
+                if start == None:
+                        start = self.stage_positions()
+                positions = dict(start)
+
+                points = xyz_scan.scanpoints
+                targets = self.plan_scan(xyz_scan, start)
+                if targets == None:
+                        targets = self.plan_xy(points)
+
+                models = self.kinematic_models()
+                speed_settings = {}
+
+                filename_prefix = gethostname() + '_' + str(xyz_scan.get_id()) + '_'
+
+                elapsed = 0.0
+                steps = []
+                scan_point_num = 0
+                for point, target in zip(points, targets):
                         scan_point_num += 1
-                        log.debug("Step " + str(scan_point_num) + " " + str(point))
 
                         # Start to build the move setting for this scan point
-                        move_setting = {'x': point['x'],
-                                        'y': point['y']}
+                        stage_targets = dict(target)
+                        speeds = []
 
                         # Add z target if required
                         if point.has_key('z0'):
@@ -534,82 +970,194 @@ class ScanCamBase():
                                         z1_speed = abs(point['z1']-point['z0']) / (float(point['t']))
 
                                         if z1_speed > MAX_Z_MOVE_SPEED:
-                                                log.error( str(target_z_speed) + " is faster than the maximum speed: %f" % MAX_Z_MOVE_SPEED)
+                                                log.error( str(z1_speed) + " is faster than the maximum speed: %f" % MAX_Z_MOVE_SPEED)
                                                 raise ValueError
 
-                                        # But, the camera may require a warm-up time from system call to the first frame.
-                                        # The camera warm-up time may even be a significant fraction of the clip-duration, and we
-                                        # need to block on the camera call due to the variability in compression time. So we
-                                        # are stuck not able to wait to start the move because we will already be blocking 
-                                        # on the camera
-
-                                        # The hack is to back up and take a running start. We adjust the z0 to be further from z1
-                                        # than specified and time it so that we will be at the desired z0 location when the 
-                                        # video starts.
+                                        # The camera may require a warm-up time from system call to the first frame, so
+                                        # back up and take a running start, timed to be at the desired z0 when the video
+                                        # starts.
                                         if point['z0'] < point['z1']:
-                                                move_setting['z'] = point['z0'] - z1_speed * self.camera_warmup 
+                                                stage_targets['z'] = point['z0'] - z1_speed * self.camera_warmup 
                                         else:   
-                                                move_setting['z'] = point['z0'] + z1_speed * self.camera_warmup 
+                                                stage_targets['z'] = point['z0'] + z1_speed * self.camera_warmup 
 
                                 else:
-                                        move_setting['z'] = point['z0']
-
-                                # Set z-axis speed to standard moderately fast value. It may have been set to a
-                                # different value during an image-through-depth sequence
-                                self.stages['z'].set_target_speed_in_units( STANDARD_Z_SPEED, 'T-series' )
-
-                        # Move to x,y,z
-                        log.debug( "Moving to " + str(move_setting) )
-                        self.move( move_setting )
-                        
+                                        stage_targets['z'] = point['z0']
+
+                                # Set z-axis speed to standard moderately fast value, if it was changed for an
+                                # image-through-depth sequence (or hasn't been set yet)
+                                setting = self.stages['z'].target_speed_setting( STANDARD_Z_SPEED, 'T-series' )
+                                if not speed_settings.get('z') == setting:
+                                        speeds.append( ('z', setting) )
+                                        speed_settings['z'] = setting
+
+                        moves = tuple([ (stage_id,) + self.stages[stage_id].compile_command('move_absolute', stage_targets[stage_id])
+                                        for stage_id in sorted(stage_targets) ])
+                        move_time = self.plan_move_time(models, speed_settings, positions, stage_targets)
+                        positions.update(stage_targets)
+
+                        if elapsed == None or move_time == None:
+                                elapsed = None
+                        else:
+                                elapsed = elapsed + move_time
 
                         # If this scan point has no time value, there is no video to record
-                        # Probably a transitional point that is just there to avoid crashing
-                        # into walls.
                         if not point.has_key('t'):
-                                log.info("Point has no time value. Skipping z1 and video")
+                                steps.append( PlanStep(scan_point_num, tuple(speeds), moves, move_time,
+                                                       (), (), None, None, None, elapsed, elapsed) )
                                 continue
-                        
-                        # Start z1 move
+
+                        clip_speeds = ()
+                        clip_moves = ()
+                        clip_move_time = 0.0
                         if point.has_key('z1'):
-                                self.stages['z'].set_target_speed_in_units( z1_speed, 'T-series' )
-                                move_setting = {'z': point['z1']}
-                                self.move( move_setting, wait_for_completion = False )
+                                setting = self.stages['z'].target_speed_setting( z1_speed, 'T-series' )
+                                clip_speeds = ( ('z', setting), )
+                                speed_settings['z'] = setting
+
+                                clip_moves = ( ('z',) + self.stages['z'].compile_command('move_absolute', point['z1']), )
+                                clip_move_time = self.plan_move_time(models, speed_settings, positions, {'z': point['z1']})
+                                positions['z'] = point['z1']
 
-                      
-                        # Build video file target basename in the format:
+                        # Video file target basename in the format:
                         #       <payload>_<scan definition ID>_<scan point ID>.<YYYY-MM-DD_HH-mm-SS>.h264
-                        t_str = self.build_timestring( gmtime(time()) )
-                        filename_base = gethostname() + '_' + xyz_scan.get_id() + '_'
+                        # The time string is added when the clip is recorded
                         if point.has_key('point-id'):
-                                filename_base += point['point-id'] + '.' + t_str
+                                filename_base = filename_prefix + str(point['point-id']) + '.'
                         else:
-                                filename_base += str(scan_point_num) + '.' + t_str
+                                filename_base = filename_prefix + str(scan_point_num) + '.'
 
-                        # Change working directory so that video are placed in correct spot
+                        clip_duration = int(point['t'])
+
+                        # Clips compressed before moving on hold the scan up too
+                        start_time = elapsed
+                        if elapsed == None or clip_move_time == None:
+                                elapsed = None
+                        else:
+                                elapsed = elapsed + max(clip_duration + self.camera_warmup, clip_move_time) \
+                                          + clip_duration * self.compression_ratio
+
+                        steps.append( PlanStep(scan_point_num, tuple(speeds), moves, move_time,
+                                               clip_speeds, clip_moves, clip_move_time,
+                                               clip_duration, filename_base, start_time, elapsed) )
+
+                unit_scales = tuple([ (stage_id, self.stages[stage_id].unit_scale()) for stage_id in sorted(self.stages) ])
+
+                return ScanPlan(xyz_scan.get_id(), xyz_scan.video_format_params, unit_scales, tuple(steps),
+                                tuple(sorted(positions.items())))
+
+
+        def prepare_plan(self, plan):
+                '''ScanCamBase.prepare_plan(plan)
+
+                Check that plan can be run with the stage settings, and change to
+                the video directory if it records any clips.
+
+                Raises ValueError if the stage settings have changed the unit scales
+                since the plan was compiled.
+                '''
+                for stage_id, unit_scale in plan.unit_scales:
+                        if not self.stages[stage_id].unit_scale() == unit_scale:
+                                log.critical("Plan for scan " + str(plan.scan_id) + " was compiled for different stage settings.")
+                                raise ValueError
+
+                # Change working directory so that video are placed in correct spot
+                if [ step for step in plan.steps if not step.clip_duration == None ]:
                         try:
                                 chdir( self.target_video_dir ) 
                         except OSError:
                                 log.warning("Invalid video target directory. Exiting.")
                                 sys.exit(-1)
-                                
-                        # Record Video                        
-                        try:
-                                self.camera.record_video(filename_base, int(point['t']), xyz_scan.video_format_params)
-                        except KeyboardInterrupt:
-                                raise        
-                        except:
-                                raise
 
-                        # Assure that the last z-axis move was completed
-                        try:
-                                self.wait_for_stages_to_complete_actions()
-                        except zaber_device.DeviceTimeoutError, device_id:
-                                log.warning("Device %d timed out during second z move on scan point %d" % (device_id, scan_point_num))
-                                raise
+
+        def run_plan(self, plan, overlap_policy = None):
+                '''ScanCamBase.run_plan(plan, overlap_policy = None)
+
+                Run a ScanPlan compiled by compile_scan(): for each step, set the
+                speeds, make the moves and wait for them, then start the move
+                through the depth, record the clip and wait for the move to finish.
+                With an overlap_policy, steps are overlapped as for
+                run_plan_pipelined(). The actions come from scan_plan.plan_actions().
+
+                Raises ValueError if the stage settings have changed the unit scales
+                since the plan was compiled.
+                '''
+                self.prepare_plan(plan)
+
+                stages = self.stages
+                for action in scan_plan.plan_actions(plan, overlap_policy, time):
+                        step = action.step
+
+                        if action.kind == scan_plan.SEND:
+                                for stage_id, setting in action.speeds:
+                                        stages[stage_id].set('target_speed', setting)
+                                if action.moves:
+                                        self.send_moves(action.moves, action.move_time)
+
+                        elif action.kind == scan_plan.WAIT_MOVE:
+                                # Move to x,y,z
+                                try:
+                                        self.wait_for_stages_to_complete_actions()
+                                except zaber_device.DeviceTimeoutError, error:
+                                        log.critical("Timed out during move on scan point %d: %s" % (step.number, error))
+                                        raise
+
+                        elif action.kind == scan_plan.RECORD:
+                                # Record Video                        
+                                filename_base = step.filename_base + self.build_timestring( gmtime(time()) )
+                                self.camera.record_video(filename_base, step.clip_duration, plan.video_format_params)
+
+                        elif action.kind == scan_plan.WAIT_DEPTH:
+                                # Assure that the last z-axis move was completed
+                                try:
+                                        self.wait_for_stages_to_complete_actions(action.stage_ids)
+                                except zaber_device.DeviceTimeoutError, error:
+                                        log.warning("Timed out during second z move on scan point %d: %s" % (step.number, error))
+                                        raise
+
+
+        def run_plan_pipelined(self, plan, overlap_policy = None):
+                '''ScanCamBase.run_plan_pipelined(plan, overlap_policy = None)
+
+                Run a ScanPlan as run_plan() does, but start each step as soon as
+                the clip of the last one is captured, as far as overlap_policy
+                allows (see OverlapPolicy in scan_plan.py): the moves of the
+                next step that are allowed go out straight away, the rest once
+                the move through the depth has finished, and only then are all
+                of the moves waited for. Clips still compressing (see
+                CompressionPool) carry on meanwhile.
+
+                overlap_policy: Defaults to self.overlap_policy, or an
+                                OverlapPolicy() if there isn't one.
+
+                Raises ValueError if the stage settings have changed the unit scales
+                since the plan was compiled.
+                '''
+                if overlap_policy == None:
+                        overlap_policy = self.overlap_policy
+                if overlap_policy == None:
+                        overlap_policy = OverlapPolicy()
+
+                self.run_plan(plan, overlap_policy)
+
+
+        def scan_action(self, xyz_scan):
+                '''ScanCamBase.scan_action(xyz_scan)
+
+                Run the scan xyz_scan: compile it with compile_scan() and run the
+                plan with run_plan(), or run_plan_pipelined() if there is an
+                overlap policy.
+                '''
+                plan = self.compile_scan(xyz_scan)
+                log.info(scan_plan.describe(plan))
+                if self.overlap_policy == None:
+                        self.run_plan(plan)
+                else:
+                        self.run_plan_pipelined(plan)
 
 class XThetaZScanCam(ScanCamBase):
-        '''XThetaZScanCam(self, stages, arm_length = 52.5, min_X = 0.0, max_X = 176.0, camera_warmup = 0.0, stage_timeout = 100)
+        '''XThetaZScanCam(self, stages, arm_length = 52.5, min_X = 0.0, max_X = 176.0, camera_warmup = 0.0, stage_timeout = 100,
+                          timeout_margin = 0.5, timeout_floor = 5.0, overlap_policy = None, compression_ratio = 0.0)
 
         Scancam with 200mm x-axis, rotary stage, and 10mm z-axis. The z-axis and
         camera are mounted to the rotary axis and can swing around to where the
@@ -631,11 +1179,25 @@ class XThetaZScanCam(ScanCamBase):
         camera_warmup:  Seconds that it takes to warm up camera. Used to calculate second
                         depth move speed so that the move fudges closer to the clip duration
 
-        stage_timeout:  Number of seconds to wait for stage moves before timing out.
+        stage_timeout:  Number of seconds to wait for stage moves before timing out,
+                        when the duration of the moves can't be predicted.
+
+        timeout_margin: Fraction of the predicted duration of a move allowed on
+                        top of it before timing out.
+
+        timeout_floor:  Minimum number of seconds to wait for any move before
+                        timing out.
+
+        overlap_policy: OverlapPolicy to overlap scan points by, or None (see
+                        ScanCamBase).
+
+        compression_ratio:  Seconds of compression expected per second of
+                        video before the scan moves on (see ScanCamBase).
         '''
 
         def __init__(self, stages, camera = None, arm_length = 52.5, min_X = 0.0, max_X = 176.0, 
-                     camera_warmup = 0.0, stage_timeout = 100, target_video_dir = None):
+                     camera_warmup = 0.0, stage_timeout = 100, target_video_dir = None,
+                     timeout_margin = 0.5, timeout_floor = 5.0, overlap_policy = None, compression_ratio = 0.0):
 
                 self.arm_length = arm_length
                 self.min_X = min_X
@@ -648,7 +1210,9 @@ class XThetaZScanCam(ScanCamBase):
                 xtz_stages['z'] = stages[2]
 
                 ScanCamBase.__init__(self, xtz_stages, camera, camera_warmup = camera_warmup, 
-                                     stage_timeout = stage_timeout, target_video_dir = target_video_dir)
+                                     stage_timeout = stage_timeout, target_video_dir = target_video_dir,
+                                     timeout_margin = timeout_margin, timeout_floor = timeout_floor,
+                                     overlap_policy = overlap_policy, compression_ratio = compression_ratio)
 
                 self.used_negative_of_angle_last_time = False                
 
@@ -726,6 +1290,203 @@ class XThetaZScanCam(ScanCamBase):
                 return x_theta_point
 
 
+        def stages2xyz(self, stage_positions):
+                '''XThetaZScanCam.stages2xyz(stage_positions)
+
+                Convert {'X': <>, 'theta': <>, 'z': <>} stage positions to an
+                {'x': <>, 'y': <>, 'z': <>} point with the arm length of this
+                scancam.
+                '''
+                return xtz2xyz(stage_positions, arm_length = self.arm_length)
+
+
+        def xy2xtheta_arrays(self, x, y):
+                '''XThetaZScanCam.xy2xtheta_arrays(x, y)
+
+                Batch version of xy2xtheta() for numpy arrays of x and y, with the
+                geometry of this scancam. Returns (X, theta, reachable, in_limits).
+                Needs numpy. See scancam.xtheta.xy2xtheta_arrays().
+                '''
+                import xtheta
+                return xtheta.xy2xtheta_arrays(x, y, self.arm_length, self.min_X, self.max_X,
+                                               prefer_negative = self.used_negative_of_angle_last_time)
+
+
+        def xtz2xyz_arrays(self, X, theta):
+                '''XThetaZScanCam.xtz2xyz_arrays(X, theta)
+
+                Batch version of xtz2xyz() for numpy arrays of X and theta, with the
+                arm length of this scancam. Returns (x, y). Needs numpy.
+                '''
+                import xtheta
+                return xtheta.xtz2xyz_arrays(X, theta, self.arm_length)
+
+
+        def xtheta_candidates(self, xy_point):
+                '''XThetaZScanCam.xtheta_candidates(xy_point)
+
+                Return the list of {'X': <>, 'theta': <>} stage targets that reach
+                the x,y point within min_X and max_X. There are at most two: the
+                natural acos angle first and then its negative (360 - acos). See
+                xy2xtheta().
+                '''
+                x = xy_point['x']
+                y = xy_point['y']
+
+                try:
+                        theta = math.degrees( math.acos( float(-y)/float(self.arm_length) ))
+                except ValueError:
+                        # Beyond the reach of the swing arm. Do the best we can with
+                        # the arm straight up or down.
+                        if( y > 0 ):
+                                theta = 180.0
+                        else:
+                                theta = 0.0
+
+                candidates = []
+                for branch_theta in (theta, 360 - theta):
+                        X = x + self.arm_length * math.sin( math.radians( branch_theta ) )
+                        if X < self.min_X or X > self.max_X:
+                                continue
+                        candidate = { 'X': X, 'theta': branch_theta }
+                        if not candidate in candidates:
+                                candidates.append( candidate )
+
+                return candidates
+
+
+        def xtheta_move_cost(self):
+                '''XThetaZScanCam.xtheta_move_cost()
+
+                Return a function cost(a, b) giving the seconds to move from one
+                {'X': <>, 'theta': <>} target to another, from the kinematic models
+                of the stages. The stages move together, so it is the time of the
+                slower. If the stage settings haven't been read, the cost is the
+                larger fraction of the travel of either stage instead.
+                '''
+                return self.target_move_cost( ('X', 'theta') )
+
+
+        def stage_spans(self):
+                '''XThetaZScanCam.stage_spans()
+
+                Return the travel of the X, theta and z stages.
+                '''
+                return { 'X': self.max_X - self.min_X, 'theta': 360.0, 'z': 10.0 }
+
+
+        def xy_candidates(self, xy_point):
+                '''XThetaZScanCam.xy_candidates(xy_point)
+
+                Return the X-theta targets for the x,y point. See xtheta_candidates().
+                '''
+                return self.xtheta_candidates( xy_point )
+
+
+        def plan_xy(self, xy_points):
+                '''XThetaZScanCam.plan_xy(xy_points)
+
+                Return the X-theta targets for the list of x,y points, planned by
+                plan_xtheta().
+                '''
+                return self.plan_xtheta( xy_points )
+
+
+        def plan_xtheta(self, xy_points, start = None):
+                '''XThetaZScanCam.plan_xtheta(xy_points, start = None)
+
+                Choose between the two X-theta targets of every point in the list
+                xy_points so that the total time of the moves between them is the
+                least, counting the move to the first point from the X-theta target
+                start (home if None). This is solved over the whole list by dynamic
+                programming, so a choice is never forced into a long rotary swing
+                later on by an earlier point, as choosing point by point can be.
+
+                Returns a list of {'X': <>, 'theta': <>} targets, one per point.
+                Raises ValueError if a point can't be reached within min_X and max_X.
+                '''
+                cost = self.xtheta_move_cost()
+                if start == None:
+                        start = { 'X': 0.0, 'theta': 0.0 }
+
+                # For each point, each candidate with the least total cost to reach
+                # it and the index of the candidate before it on that path
+                layers = []
+                previous = None
+                for point in xy_points:
+                        candidates = self.xtheta_candidates( point )
+                        if not candidates:
+                                log.critical("Unable to translate (%f, %f) to X-theta coordinates." % (point['x'], point['y']))
+                                raise ValueError
+
+                        layer = []
+                        for candidate in candidates:
+                                if previous == None:
+                                        layer.append( (candidate, cost(start, candidate), None) )
+                                        continue
+
+                                best_total, best_index = None, None
+                                for index in range(len(previous)):
+                                        before, total, back = previous[index]
+                                        total = total + cost(before, candidate)
+                                        # Ties go to the earlier (natural acos) candidate
+                                        if best_total == None or total < best_total:
+                                                best_total, best_index = total, index
+                                layer.append( (candidate, best_total, best_index) )
+
+                        layers.append( layer )
+                        previous = layer
+
+                if not layers:
+                        return []
+
+                # Walk back from the cheapest last target
+                index = 0
+                for each_index in range(len(previous)):
+                        if previous[each_index][1] < previous[index][1]:
+                                index = each_index
+
+                plan = []
+                for layer in reversed(layers):
+                        candidate, total, back = layer[index]
+                        plan.append( candidate )
+                        index = back
+                plan.reverse()
+
+                return plan
+
+
+        def plan_scan(self, xyz_scan, start = None):
+                '''XThetaZScanCam.plan_scan(xyz_scan, start = None)
+
+                Return the X-theta targets for the scan points of xyz_scan, planned
+                by plan_xtheta() from the stage positions start (home if None). The
+                plan is cached with the scan, so it is only worked out the first time
+                the scan is run from the same start by a scancam of the same geometry.
+                '''
+                # A stage with no position known is taken to be at home
+                xtheta_start = { 'X': 0.0, 'theta': 0.0 }
+                if not start == None:
+                        for stage_id in xtheta_start:
+                                if not start.get(stage_id) == None:
+                                        xtheta_start[stage_id] = start[stage_id]
+
+                # Stage positions read back vary by a few microsteps from run to run,
+                # which shouldn't make a new plan every time
+                xy_points = tuple([ (point['x'], point['y']) for point in xyz_scan.scanpoints ])
+                key = ('xtheta', self.arm_length, self.min_X, self.max_X, xy_points,
+                       round(xtheta_start['X'], 1), round(xtheta_start['theta'], 1))
+
+                plan = xyz_scan.cached_plan(key)
+                if plan == None:
+                        plan = self.plan_xtheta( [ {'x': x, 'y': y} for x, y in xy_points ],
+                                                 xtheta_start )
+                        xyz_scan.cache_plan(key, plan)
+                        log.debug("Planned X-theta targets for scan " + str(xyz_scan.get_id()))
+
+                return plan
+
+
         def move(self, settings, wait_for_completion = True):
                 '''XThetaZScanCam.move(settings)
 
@@ -749,11 +1510,39 @@ class XThetaZScanCam(ScanCamBase):
                 log.debug("Moving " + str(my_id) + " to " + str(xtz_setting))
                 self.move_stages( xtz_setting, wait_for_completion = wait_for_completion )
 
+        def stow_position(self):
+                '''XThetaZScanCam.stow_position()
+
+                Return the stow location in scan coordinates.
+                '''
+                return {'x': 120, 'y': 0, 'z': 5 }
+
+        def stow_targets(self):
+                '''XThetaZScanCam.stow_targets()
+
+                Return the stage targets of the stow location, keyed by stage id.
+                '''
+                stow_position = self.stow_position()
+                stage_targets = self.xy2xtheta( {'x': stow_position['x'], 'y': stow_position['y']} )
+                stage_targets['z'] = stow_position['z']
+                return stage_targets
+
         def goto_stow_position(self):
                 '''XThetaZScancam.gotostow_position()
 
-                Move stages to preset stow locations.
+                Move stages to preset stow locations, and wait for the camera to
+                finish writing out the clips of the scan.
                 '''
-                target_locations = {'x': 120, 'y': 0, 'z': 5 }
+                target_locations = self.stow_position()
                 log.info("Sending stages to stow locations: " + str(target_locations) )
-                self.move( target_locations )
+                self.move( target_locations, wait_for_completion = False )
+
+                # Clips may still be compressing. Wait for them while the stages move.
+                if not self.camera == None:
+                        self.camera.flush()
+
+                try:
+                        self.wait_for_stages_to_complete_actions()
+                except zaber_device.DeviceTimeoutError, error:
+                        log.critical("Timed out during move to stow position: %s" % error)
+                        raise
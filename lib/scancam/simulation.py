@@ -0,0 +1,847 @@
+'''Discrete-event simulation of a scancam run
+
+simulate() runs compiled scan plans (see scan_plan.py) the way bin/scancam
+runs them, homing, scanning, stowing and waiting out the period between scan
+sets, but against simulated components on a virtual clock instead of the
+hardware:
+
+  SimulatedBus          The serial bus, with the framing time of every packet
+                        at the baud rate, one packet at a time each way, in
+                        front of the stages.
+  zaber.simulator.virtual_device
+                        The stages, moving with the trapezoidal profile of
+                        their settings.
+  SimulatedCamera       UeyeCamera.record_video(): daemon restarts, warm-up,
+                        capture and compression, in the background with
+                        compression workers as with a CompressionPool.
+
+Nothing sleeps, so hours of scanning take seconds to simulate. The result is a
+SimulationReport of how the time went: the phases of the run (travel, capture,
+compression, waiting for the period, ...) and how busy the bus, the stages
+and the camera were.
+
+The run is made of processes, generators that yield what they wait for: a
+number of seconds, a Signal, or another process generator to run to its end.
+What is sent, waited for and recorded comes from scan_plan.plan_actions() and
+scan_plan.scan_loop(), as it does for ScanCamBase and bin/scancam, so the
+simulation makes the same decisions as the real run.
+'''
+import heapq
+import types
+
+import logging, idscam.common.syslogger
+
+from zaber.simulator import virtual_device, scancam_devices, HOME, ERROR
+
+import scan_plan
+
+log = idscam.common.syslogger.get_syslogger('scancam')
+
+# Bytes in a packet of the binary protocol, and bits on the wire per byte
+# (start bit, 8 data bits, stop bit)
+PACKET_SIZE = 6
+BITS_PER_BYTE = 10
+
+# Order the phases are reported in
+PHASES = ('homing', 'serial', 'travel', 'daemon restart', 'warm-up', 'capture',
+          'compression', 'compression backlog', 'depth move', 'compression drain', 'stow',
+          'waiting for period')
+
+
+class Signal():
+        '''Signal()
+
+        Something a process can wait for. Processes waiting on it carry on when
+        it fires, and any that wait for it afterwards carry straight on.
+        '''
+
+        def __init__(self):
+                self.fired = False
+                self.waiters = []
+
+        def fire(self):
+                self.fired = True
+                waiters = self.waiters
+                self.waiters = []
+                for waiter in waiters:
+                        waiter()
+
+
+class VirtualClock():
+        '''VirtualClock()
+
+        Event scheduler keeping simulated time. Events run in time order (and
+        in the order they were scheduled at the same time), and the clock jumps
+        from one to the next.
+        '''
+
+        def __init__(self):
+                self.now = 0.0
+                self.events = []
+                self.sequence = 0
+
+        def at(self, when, function, *args):
+                '''VirtualClock.at(when, function, *args)
+
+                Call function(*args) at the simulated time when (or now, if that
+                has passed).
+                '''
+                self.sequence += 1
+                heapq.heappush(self.events, (max(when, self.now), self.sequence, function, args))
+
+        def after(self, delay, function, *args):
+                self.at(self.now + delay, function, *args)
+
+        def time(self):
+                '''VirtualClock.time()
+
+                Return the simulated time, in seconds, as time.time() would.
+                '''
+                return self.now
+
+        def start(self, generator):
+                '''VirtualClock.start(generator)
+
+                Run the process generator from now and return a Signal that
+                fires when it finishes.
+                '''
+                process = Process(self, generator)
+                self.after(0.0, process.resume)
+                return process.finished
+
+        def run(self, until = None):
+                '''VirtualClock.run(until = None)
+
+                Run events until there are none left, or until the simulated time
+                until.
+                '''
+                while self.events:
+                        if not until == None and self.events[0][0] > until:
+                                self.now = until
+                                return
+                        when, sequence, function, args = heapq.heappop(self.events)
+                        self.now = when
+                        function(*args)
+
+
+class Process():
+        '''Process(clock, generator)
+
+        Steps a process generator (see the module docstring) along on clock.
+        Started by VirtualClock.start().
+        '''
+
+        def __init__(self, clock, generator):
+                self.clock = clock
+                self.stack = [generator]
+                self.finished = Signal()
+
+        def resume(self):
+                while self.stack:
+                        try:
+                                request = self.stack[-1].next()
+                        except StopIteration:
+                                self.stack.pop()
+                                continue
+
+                        if isinstance(request, types.GeneratorType):
+                                self.stack.append(request)
+                        elif isinstance(request, Signal):
+                                if not request.fired:
+                                        request.waiters.append(self.resume)
+                                        return
+                        else:
+                                self.clock.after(request, self.resume)
+                                return
+
+                self.finished.fire()
+
+
+class PhaseTimer():
+        '''PhaseTimer(clock)
+
+        Adds up the simulated time spent in each phase of the run. The run is
+        in one phase at a time, from enter() to the next enter().
+        '''
+
+        def __init__(self, clock):
+                self.clock = clock
+                self.totals = {}
+                self.phase = None
+                self.since = 0.0
+
+        def enter(self, phase):
+                if not self.phase == None:
+                        self.totals[self.phase] = self.totals.get(self.phase, 0.0) + self.clock.now - self.since
+                self.phase = phase
+                self.since = self.clock.now
+
+        def stop(self):
+                self.enter(None)
+
+
+class SimulatedBus():
+        '''SimulatedBus(clock, devices, baudrate = 9600)
+
+        The serial bus between the computer and the chain of virtual_devices.
+        A packet takes PACKET_SIZE * BITS_PER_BYTE / baudrate seconds on the
+        wire, and only one can be on the wire each way at a time, so commands
+        and replies queue. Every command is answered once: straight away, or
+        when the motion it starts finishes.
+
+        baudrate:       Bits per second, or None for no framing delay.
+        '''
+
+        def __init__(self, clock, devices, baudrate = 9600):
+                self.clock = clock
+                self.devices = dict([ (device.device_number, device) for device in devices ])
+
+                if baudrate == None:
+                        self.packet_time = 0.0
+                else:
+                        self.packet_time = PACKET_SIZE * BITS_PER_BYTE / float(baudrate)
+
+                # When the line each way is next free, and how long it has been busy
+                self.tx_free = 0.0
+                self.rx_free = 0.0
+                self.tx_busy = 0.0
+                self.rx_busy = 0.0
+                self.packets_sent = 0
+                self.errors = 0
+
+                # Commands not answered yet for each device, and the (device
+                # numbers, Signal) of the processes waiting for them
+                self.unanswered = dict([ (number, 0) for number in self.devices ])
+                self.idle_waiters = []
+
+                # Seconds each device has spent moving
+                self.motion_time = dict([ (number, 0.0) for number in self.devices ])
+
+        def send(self, device_number, command, data):
+                '''SimulatedBus.send(device_number, command, data)
+
+                Send a command down the bus after the packets already queued,
+                and return when it has been sent.
+                '''
+                start = max(self.clock.now, self.tx_free)
+                self.tx_free = start + self.packet_time
+                self.tx_busy += self.packet_time
+                self.packets_sent += 1
+                self.unanswered[device_number] += 1
+
+                self.clock.at(self.tx_free, self.receive, device_number, command, data)
+                return self.tx_free
+
+        def receive(self, device_number, command, data):
+                device = self.devices[device_number]
+
+                # A command during a motion cuts it short
+                motion = device.motion
+                replies = device.handle(command, data, self.clock.now)
+                if not motion == None and not device.motion is motion:
+                        self.motion_time[device_number] += self.clock.now - motion[1]
+                        self.answered(device_number)
+
+                if not device.motion == None and not device.motion is motion:
+                        self.clock.at(device.completion_time(), self.complete, device, device.motion)
+                        # Answered now and again when the motion completes
+                        if replies:
+                                self.unanswered[device_number] += 1
+                else:
+                        # Commands that start no motion are answered straight away
+                        if not replies:
+                                self.answered(device_number)
+
+                for reply in replies:
+                        self.reply(reply)
+
+        def complete(self, device, motion):
+                # Unless another command has cut it short
+                if device.motion is motion:
+                        self.motion_time[device.device_number] += motion[4]
+                        self.reply(device.complete(self.clock.now))
+
+        def reply(self, packet):
+                start = max(self.clock.now, self.rx_free)
+                self.rx_free = start + self.packet_time
+                self.rx_busy += self.packet_time
+
+                if packet[1] == ERROR:
+                        self.errors += 1
+                        log.warning("Simulated device %i replied with error %i" % (packet[0], packet[2]))
+
+                self.clock.at(self.rx_free, self.answered, packet[0])
+
+        def answered(self, device_number):
+                self.unanswered[device_number] -= 1
+                if self.unanswered[device_number] == 0:
+                        waiters = self.idle_waiters
+                        self.idle_waiters = []
+                        for device_numbers, signal in waiters:
+                                if self.is_idle(device_numbers):
+                                        signal.fire()
+                                else:
+                                        self.idle_waiters.append( (device_numbers, signal) )
+
+        def is_idle(self, device_numbers):
+                for number in device_numbers:
+                        if self.unanswered[number]:
+                                return False
+                return True
+
+        def sent(self):
+                '''SimulatedBus.sent()
+
+                Process generator that waits until every queued command has been
+                sent.
+                '''
+                if self.tx_free > self.clock.now:
+                        yield self.tx_free - self.clock.now
+
+        def idle(self, device_numbers = None):
+                '''SimulatedBus.idle(device_numbers = None)
+
+                Return a Signal that fires once every command sent has been
+                answered, as wait_for_stages_to_complete_actions() waits.
+
+                device_numbers: Numbers of the devices to wait for, if not all
+                                of them.
+                '''
+                if device_numbers == None:
+                        device_numbers = self.devices.keys()
+
+                signal = Signal()
+                if self.is_idle(device_numbers):
+                        signal.fire()
+                else:
+                        self.idle_waiters.append( (device_numbers, signal) )
+                return signal
+
+
+class SimulatedCamera():
+        '''SimulatedCamera(clock, phases, warmup = 0.0, compression_ratio = 1.0,
+                           daemon_restart_time = 10.0, compression_workers = 0,
+                           compression_queue = 4,
+                           num_camera_calls_between_ueye_daemon_restarts = 50)
+
+        Takes as long as UeyeCamera.record_video() to record a clip: restarting
+        the camera daemon when it is due, warming up, capturing for the clip
+        duration and compressing the raw frames.
+
+        With compression_workers, the raw frames are compressed in the
+        background as by a CompressionPool of that many workers, holding at
+        most compression_queue clips. Free disk space isn't simulated.
+
+        warmup:                 Seconds from the camera call to the first frame.
+
+        compression_ratio:      Seconds raw2h264 takes per second of video.
+
+        daemon_restart_time:    Seconds to restart the ueye daemon.
+        '''
+
+        def __init__(self, clock, phases, warmup = 0.0, compression_ratio = 1.0,
+                     daemon_restart_time = 10.0, compression_workers = 0,
+                     compression_queue = 4,
+                     num_camera_calls_between_ueye_daemon_restarts = 50):
+                self.clock = clock
+                self.phases = phases
+                self.warmup = warmup
+                self.compression_ratio = compression_ratio
+                self.daemon_restart_time = daemon_restart_time
+                self.num_camera_calls_between_ueye_daemon_restarts = num_camera_calls_between_ueye_daemon_restarts
+                self.compression_workers = compression_workers
+                self.compression_queue = max(compression_queue, 1)
+
+                self.num_camera_calls_since_ueye_daemon_restart = 0
+                self.clips = 0
+                self.daemon_restarts = 0
+                self.busy_time = 0.0
+                self.compression_time = 0.0
+
+                # Compression durations waiting for a worker, the clips waiting
+                # or being compressed, the workers running and a Signal that
+                # fires when the next clip finishes
+                self.compression_jobs = []
+                self.outstanding = 0
+                self.running_workers = 0
+                self.compressed = Signal()
+
+        def record_video(self, clip_duration, video_format_params = None):
+                '''SimulatedCamera.record_video(clip_duration, video_format_params = None)
+
+                Process generator recording a clip of clip_duration seconds.
+                '''
+                started = self.clock.now
+
+                if self.num_camera_calls_since_ueye_daemon_restart > self.num_camera_calls_between_ueye_daemon_restarts:
+                        self.phases.enter('daemon restart')
+                        yield self.daemon_restart_time
+                        self.num_camera_calls_since_ueye_daemon_restart = 0
+                        self.daemon_restarts += 1
+
+                self.num_camera_calls_since_ueye_daemon_restart += 1
+
+                self.phases.enter('warm-up')
+                yield self.warmup
+
+                self.phases.enter('capture')
+                yield clip_duration
+
+                self.clips += 1
+                if self.compression_workers > 0:
+                        self.busy_time += self.clock.now - started
+                        yield self.submit(clip_duration * self.compression_ratio)
+                        return
+
+                self.phases.enter('compression')
+                yield clip_duration * self.compression_ratio
+
+                self.compression_time += clip_duration * self.compression_ratio
+                self.busy_time += self.clock.now - started
+
+        def submit(self, compression_duration):
+                '''SimulatedCamera.submit(compression_duration)
+
+                Process generator queuing a clip for the compression workers,
+                first waiting while compression_queue clips are outstanding, as
+                CompressionPool.submit() does.
+                '''
+                if self.outstanding >= self.compression_queue:
+                        self.phases.enter('compression backlog')
+                        while self.outstanding >= self.compression_queue:
+                                yield self.compressed
+
+                self.compression_jobs.append(compression_duration)
+                self.outstanding += 1
+                if self.running_workers < self.compression_workers:
+                        self.running_workers += 1
+                        self.clock.start(self.compression_worker())
+
+        def compression_worker(self):
+                while self.compression_jobs:
+                        compression_duration = self.compression_jobs.pop(0)
+                        yield compression_duration
+
+                        self.compression_time += compression_duration
+                        self.outstanding -= 1
+                        compressed = self.compressed
+                        self.compressed = Signal()
+                        compressed.fire()
+
+                self.running_workers -= 1
+
+        def flush(self):
+                '''SimulatedCamera.flush()
+
+                Process generator waiting until every clip has been compressed.
+                '''
+                while self.outstanding:
+                        yield self.compressed
+
+
+class SimulationReport():
+        '''SimulationReport(duration, phases, scan_sets, points, clips, ...)
+
+        How a simulated run went. Times are simulated seconds. See describe().
+        '''
+
+        def __init__(self, duration, phases, scan_sets, set_durations, points, clips,
+                     daemon_restarts, camera_time, bus_time, packets, errors, motion_times,
+                     period, compression_time = 0.0, compression_workers = 0):
+                self.duration = duration
+                self.phases = phases
+                self.scan_sets = scan_sets
+                self.set_durations = set_durations
+                self.points = points
+                self.clips = clips
+                self.daemon_restarts = daemon_restarts
+                self.camera_time = camera_time
+                self.bus_time = bus_time
+                self.packets = packets
+                self.errors = errors
+                self.motion_times = motion_times
+                self.period = period
+                self.compression_time = compression_time
+                self.compression_workers = compression_workers
+
+        def utilisation(self, busy_time):
+                if self.duration <= 0:
+                        return 0.0
+                return 100.0 * busy_time / self.duration
+
+        def describe(self):
+                '''SimulationReport.describe()
+
+                Return a list of lines describing the run: what was done, the time
+                spent in each phase and the utilisation of each component.
+                '''
+                lines = [ "Simulated %s: %i scan set(s), %i points, %i clips, %i daemon restart(s)"
+                          % (format_duration(self.duration), self.scan_sets, self.points, self.clips,
+                             self.daemon_restarts) ]
+
+                if self.set_durations:
+                        longest = max(self.set_durations)
+                        line = "Scan sets took %s to %s" % (format_duration(min(self.set_durations)),
+                                                            format_duration(longest))
+                        if self.period > 0:
+                                if longest > self.period:
+                                        line += ", longer than the period of %s, so they ran back to back" \
+                                                % format_duration(self.period)
+                                else:
+                                        line += ", %.0f%% of the period of %s" \
+                                                % (100.0 * longest / self.period, format_duration(self.period))
+                        lines.append(line)
+
+                lines.append("Phases:")
+                for phase in PHASES:
+                        if self.phases.has_key(phase):
+                                lines.append("  %-20s %12s  %5.1f%%" % (phase, format_duration(self.phases[phase]),
+                                                                      self.utilisation(self.phases[phase])))
+
+                lines.append("Utilisation:")
+                lines.append("  %-20s %12s  %5.1f%%" % ('camera', format_duration(self.camera_time),
+                                                      self.utilisation(self.camera_time)))
+                if self.compression_workers > 0:
+                        lines.append("  %-20s %12s  %5.1f%%  (of %i worker(s))"
+                                     % ('compression', format_duration(self.compression_time),
+                                        self.utilisation(self.compression_time) / self.compression_workers,
+                                        self.compression_workers))
+                for stage_id in sorted(self.motion_times):
+                        lines.append("  %-20s %12s  %5.1f%%" % ('stage ' + str(stage_id),
+                                                              format_duration(self.motion_times[stage_id]),
+                                                              self.utilisation(self.motion_times[stage_id])))
+                lines.append("  %-20s %12s  %5.1f%%  (%i packets each way)"
+                             % ('serial bus', format_duration(self.bus_time), self.utilisation(self.bus_time),
+                                self.packets))
+                if self.errors:
+                        lines.append("%i error replies from the stages" % self.errors)
+
+                return lines
+
+
+def format_duration(seconds):
+        '''format_duration(seconds)
+
+        Return seconds as hours, minutes and seconds, e.g. '2:05:07.3'.
+        '''
+        minutes, seconds = divmod(round(seconds, 1), 60.0)
+        hours, minutes = divmod(int(minutes), 60)
+        return '%i:%02i:%04.1f' % (hours, minutes, seconds)
+
+
+def virtual_devices(stages, settings_cache = None, port = None):
+        '''virtual_devices(stages, settings_cache = None, port = None)
+
+        Return a virtual_device standing in for each of the zaber stages, with
+        the settings cached for the stage on port in settings_cache if there
+        are any, and otherwise those of the stage in scancam_devices().
+        '''
+        defaults = dict([ (device.device_number, device) for device in scancam_devices() ])
+
+        devices = []
+        for stage in stages:
+                device = defaults.get(stage.device_number)
+                if device == None:
+                        device = virtual_device(stage.device_number)
+
+                if not settings_cache == None:
+                        cached = settings_cache.lookup(port, stage.device_number)
+                        if not cached == None:
+                                for name, value in cached['settings'].items():
+                                        number = stage.setting_commands.get(name)
+                                        if device.settings.has_key(number):
+                                                device.settings[number] = value
+
+                devices.append(device)
+        return devices
+
+
+def load_device_settings(stages, devices):
+        '''load_device_settings(stages, devices)
+
+        Fill the settings of each of the zaber stages from the virtual_device
+        with the same device number, as if they had been read from it.
+        '''
+        by_number = dict([ (device.device_number, device) for device in devices ])
+        for stage in stages:
+                device = by_number[stage.device_number]
+                for name, number in stage.setting_commands.items():
+                        if number == stage.setting_commands.get('current_position'):
+                                stage.settings[name] = device.position
+                        elif device.settings.has_key(number):
+                                stage.settings[name] = device.settings[number]
+
+                for name, number in stage.setting_commands.items():
+                        if stage.settings.has_key(name):
+                                stage.handle_setting_reply(number, stage.settings[name])
+
+
+class SimulatedRun():
+        '''SimulatedRun(scancam, plans, devices, camera_warmup = None,
+                        compression_ratio = 1.0, daemon_restart_time = 10.0,
+                        compression_workers = 0, compression_queue = 4,
+                        baudrate = 9600)
+
+        A run of the compiled plans by scancam (used for its stage ids, device
+        numbers and stow position only) on simulated components. See
+        simulate().
+        '''
+
+        def __init__(self, scancam, plans, devices, camera_warmup = None,
+                     compression_ratio = 1.0, daemon_restart_time = 10.0,
+                     compression_workers = 0, compression_queue = 4,
+                     baudrate = 9600):
+                self.scancam = scancam
+                self.plans = plans
+
+                self.clock = VirtualClock()
+                self.phases = PhaseTimer(self.clock)
+                self.bus = SimulatedBus(self.clock, devices, baudrate)
+
+                if camera_warmup == None:
+                        camera_warmup = scancam.camera_warmup
+                self.camera = SimulatedCamera(self.clock, self.phases, camera_warmup,
+                                              compression_ratio, daemon_restart_time,
+                                              compression_workers, compression_queue)
+
+                self.device_numbers = dict([ (stage_id, scancam.stages[stage_id].device_number)
+                                             for stage_id in scancam.stages ])
+                self.scan_sets = 0
+                self.set_durations = []
+                self.points = 0
+
+        def send(self, stage_id, code, data):
+                self.bus.send(self.device_numbers[stage_id], code, data)
+
+        def move(self, moves, phase):
+                '''SimulatedRun.move(moves, phase)
+
+                Process generator sending the moves and waiting for them, in phase
+                once they are on the wire.
+                '''
+                self.phases.enter('serial')
+                for stage_id, code, data in moves:
+                        self.send(stage_id, code, data)
+                yield self.bus.sent()
+
+                self.phases.enter(phase)
+                yield self.bus.idle()
+
+        def home(self):
+                yield self.move([ (stage_id, HOME, 0) for stage_id in sorted(self.device_numbers) ], 'homing')
+
+        def stow(self):
+                '''SimulatedRun.stow()
+
+                Process generator moving to the stow position while the camera
+                finishes writing out its clips, as goto_stow_position() does.
+                '''
+                self.phases.enter('serial')
+                stow_targets = getattr(self.scancam, 'stow_targets', None)
+                if not stow_targets == None:
+                        targets = stow_targets()
+                        for stage_id in sorted(targets):
+                                self.send(stage_id, *self.scancam.stages[stage_id].compile_command('move_absolute', targets[stage_id]))
+                yield self.bus.sent()
+
+                self.phases.enter('compression drain')
+                yield self.camera.flush()
+
+                self.phases.enter('stow')
+                yield self.bus.idle()
+
+        def speed_commands(self, speeds):
+                return [ (stage_id, self.scancam.stages[stage_id].setting_commands['target_speed'], setting)
+                         for stage_id, setting in speeds ]
+
+        def run_plan(self, plan):
+                '''SimulatedRun.run_plan(plan)
+
+                Process generator running the plan as ScanCamBase.run_plan() does,
+                or as run_plan_pipelined() does if the scancam has an overlap
+                policy.
+                '''
+                self.points += len(plan.steps)
+                for action in scan_plan.plan_actions(plan, self.scancam.overlap_policy, self.clock.time):
+                        if action.kind == scan_plan.SEND:
+                                self.phases.enter('serial')
+                                for command in self.speed_commands(action.speeds) + list(action.moves):
+                                        self.send(*command)
+                                yield self.bus.sent()
+
+                        elif action.kind == scan_plan.WAIT_MOVE:
+                                self.phases.enter('travel')
+                                yield self.bus.idle()
+
+                        elif action.kind == scan_plan.RECORD:
+                                yield self.camera.record_video(action.step.clip_duration, plan.video_format_params)
+
+                        elif action.kind == scan_plan.WAIT_DEPTH:
+                                self.phases.enter('depth move')
+                                if action.stage_ids == None:
+                                        yield self.bus.idle()
+                                else:
+                                        yield self.bus.idle( [ self.device_numbers[stage_id] for stage_id in action.stage_ids ] )
+
+        def run(self, period = 0.0, num_scans = 1, continuous = False, duration = None,
+                home_on_start = True, home_between = True):
+                '''SimulatedRun.run(period = 0.0, num_scans = 1, continuous = False,
+                                    duration = None, home_on_start = True, home_between = True)
+
+                Process generator for the main loop of bin/scancam (see
+                scan_plan.scan_loop()): home, then run scan sets at most every
+                period seconds, each homing between scans and stowing at the end,
+                for num_scans sets or, if continuous, until duration seconds have
+                passed.
+                '''
+                last_scan_start_time = None
+                for action in scan_plan.scan_loop(self.plans, period, num_scans, continuous, duration,
+                                                  home_on_start, home_between, self.clock.time):
+                        if action.kind == scan_plan.HOME:
+                                yield self.home()
+                        elif action.kind == scan_plan.PAUSE:
+                                self.phases.enter('waiting for period')
+                                yield action.value
+                        elif action.kind == scan_plan.START_SET:
+                                last_scan_start_time = self.clock.now
+                        elif action.kind == scan_plan.SCAN:
+                                yield self.run_plan(action.value)
+                        elif action.kind == scan_plan.STOW:
+                                yield self.stow()
+                        elif action.kind == scan_plan.END_SET:
+                                self.scan_sets = action.value
+                                self.set_durations.append(self.clock.now - last_scan_start_time)
+
+                self.phases.stop()
+
+        def report(self, period = 0.0):
+                motion_times = dict([ (stage_id, self.bus.motion_time[self.device_numbers[stage_id]])
+                                      for stage_id in self.device_numbers ])
+                return SimulationReport(self.clock.now, dict(self.phases.totals), self.scan_sets,
+                                        self.set_durations, self.points, self.camera.clips,
+                                        self.camera.daemon_restarts, self.camera.busy_time,
+                                        max(self.bus.tx_busy, self.bus.rx_busy), self.bus.packets_sent,
+                                        self.bus.errors, motion_times, period,
+                                        self.camera.compression_time, self.camera.compression_workers)
+
+
+def compile_plans(scancam, scans, home_between = True, start_positions = None):
+        '''compile_plans(scancam, scans, home_between = True, start_positions = None)
+
+        Compile the scans as they will be run: each from home when homing
+        between them, otherwise the first from start_positions (home if None)
+        and each after it from where the last finished.
+        '''
+        home_positions = dict([ (stage_id, 0.0) for stage_id in scancam.stages ])
+        start = start_positions
+        if start == None:
+                start = home_positions
+        plans = []
+        for scan in scans:
+                if home_between:
+                        start = home_positions
+                plan = scancam.compile_scan(scan, start)
+                start = dict(plan.end_positions)
+                plans.append(plan)
+        return plans
+
+
+def simulate(scancam, scans, devices, period = 0.0, num_scans = 1, continuous = False,
+             hours = 24.0, home_on_start = True, home_between = True, start_positions = None,
+             **components):
+        '''simulate(scancam, scans, devices, period = 0.0, num_scans = 1, continuous = False,
+                    hours = 24.0, home_on_start = True, home_between = True, start_positions = None,
+                    **components)
+
+        Simulate running the scans with scancam on the virtual_devices devices,
+        as bin/scancam would with the same options, and return a
+        SimulationReport. The settings of the scancam stages are filled from
+        the devices.
+
+        period:         Minimum minutes between the starts of scan sets.
+
+        hours:          Simulated hours to run for when continuous. The last
+                        scan set is finished.
+
+        start_positions: Stage positions the first scan is compiled from when
+                        not homing between scans, as for compile_plans(). The
+                        virtual devices start at home.
+
+        components:     camera_warmup, compression_ratio, daemon_restart_time,
+                        compression_workers, compression_queue and baudrate of
+                        the simulated components (see SimulatedRun).
+        '''
+        load_device_settings(scancam.stages.values(), devices)
+        plans = compile_plans(scancam, scans, home_between, start_positions)
+        for plan in plans:
+                log.debug(scan_plan.describe(plan))
+
+        run = SimulatedRun(scancam, plans, devices, **components)
+        finished = run.clock.start(run.run(period * 60.0, num_scans, continuous, hours * 3600.0,
+                                           home_on_start, home_between))
+        run.clock.run()
+
+        if not finished.fired:
+                log.warning("Simulated run stopped waiting for replies that never came")
+        return run.report(period * 60.0)
+
+
+def example_scancam():
+        '''example_scancam()
+
+        Return an XThetaZScanCam with unconnected stages numbered as in
+        bin/scancam, and the virtual_devices to simulate them with.
+        '''
+        from zaber.serial_connection import serial_connection
+        from zaber.linear_slides import linear_slide
+        from zaber.rotary_stages import rotary_stage
+        from scancam import XThetaZScanCam
+
+        connection = serial_connection(None)
+        stages = [ linear_slide(connection, 1, mm_per_rev = .6096, defer_settings = True),
+                   rotary_stage(connection, 2, deg_per_step = .015, defer_settings = True),
+                   linear_slide(connection, 3, mm_per_rev = .3048, defer_settings = True) ]
+        return XThetaZScanCam(stages), virtual_devices(stages)
+
+
+def example_scans(num_h_scan_points = 3, num_v_scan_points = 3, clip_duration = 20):
+        '''example_scans(num_h_scan_points = 3, num_v_scan_points = 3, clip_duration = 20)
+
+        Return a scan of the wells of a six well plate, each tiled
+        num_h_scan_points by num_v_scan_points, with a clip through the depth
+        at each point.
+        '''
+        from scancam import ScanBase
+
+        scan = ScanBase('simulation-example', {'subsampling': 3})
+        origins = []
+        for row in range(2):
+                for column in range(3):
+                        origins.append( {'x': 60.0 + 39.0*column, 'y': -30.0 + 39.0*row,
+                                         'z0': 0.5, 'z1': 3.5, 't': clip_duration,
+                                         'area-id': '%s%d' % ('AB'[row], column + 1)} )
+        scan.build_scan_from_target_origins(origins, target_width = 34.8, target_height = 34.8,
+                                            num_h_scan_points = num_h_scan_points,
+                                            num_v_scan_points = num_v_scan_points)
+        return [ scan ]
+
+
+if __name__ == '__main__':
+        import sys
+        from time import time
+
+        # simulation.py [hours [period minutes]]
+        hours = 6.0
+        period = 30.0
+        if sys.argv[1:]:
+                hours = float(sys.argv[1])
+        if sys.argv[2:]:
+                period = float(sys.argv[2])
+
+        scancam, devices = example_scancam()
+        start = time()
+        report = simulate(scancam, example_scans(), devices, period = period, continuous = True,
+                          hours = hours, camera_warmup = 0.5, compression_workers = 1)
+        for line in report.describe():
+                print line
+        print 'Simulated in %.2f s' % (time() - start)
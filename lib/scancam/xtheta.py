@@ -0,0 +1,157 @@
+'''Batch X-theta kinematics
+
+Array versions of XThetaZScanCam.xy2xtheta() and xtz2xyz() for working on
+whole grids of points at once, such as calibration grids and reachability maps
+of the workspace. They need numpy, which the rest of the scancam package does
+not.
+
+Angles are in degrees and distances in mm, as for the scalar versions.
+'''
+import numpy
+
+
+def xtheta_branches(x, y, arm_length = 52.5):
+        '''xtheta_branches(x, y, arm_length = 52.5)
+
+        Return both X-theta branches for arrays of x and y as the tuple
+        (X, theta, negative_X, negative_theta, reachable).
+
+        theta is the natural acos angle and negative_theta is its negative,
+        360 - theta. X and negative_X are the X-stage settings that go with
+        them. reachable is a boolean array that is false where y is beyond the
+        reach of the swing arm. There theta is set straight up (180) or down (0)
+        to do the best it can, as xy2xtheta() does.
+        '''
+        x = numpy.asarray(x, dtype = float)
+        y = numpy.asarray(y, dtype = float)
+
+        ratio = -y/float(arm_length)
+        reachable = numpy.abs(ratio) <= 1.0
+
+        theta = numpy.degrees( numpy.arccos( numpy.clip(ratio, -1.0, 1.0) ) )
+        swing = arm_length * numpy.sin( numpy.radians( theta ) )
+
+        # sin(360 - theta) is -sin(theta)
+        return x + swing, theta, x - swing, 360.0 - theta, reachable
+
+
+def xy2xtheta_arrays(x, y, arm_length = 52.5, min_X = 0.0, max_X = 176.0, prefer_negative = False):
+        '''xy2xtheta_arrays(x, y, arm_length = 52.5, min_X = 0.0, max_X = 176.0, prefer_negative = False)
+
+        Return the X-theta targets for arrays of x and y as the tuple
+        (X, theta, reachable, in_limits).
+
+        Each point takes the natural acos branch (or its negative, if
+        prefer_negative is set) unless that puts X outside min_X to max_X, in
+        which case it takes the other branch, as xy2xtheta() does. Unlike
+        xy2xtheta(), the choice for one point doesn't depend on the points
+        before it. See XThetaZScanCam.plan_xtheta() to choose branches over a
+        scan.
+
+        reachable is false where y is beyond the reach of the arm (see
+        xtheta_branches()). in_limits is false where neither branch keeps X
+        within limits, which xy2xtheta() raises ValueError for.
+        '''
+        X, theta, negative_X, negative_theta, reachable = xtheta_branches(x, y, arm_length)
+
+        if prefer_negative:
+                X, theta, negative_X, negative_theta = negative_X, negative_theta, X, theta
+
+        first_in_limits = (X >= min_X) & (X <= max_X)
+        second_in_limits = (negative_X >= min_X) & (negative_X <= max_X)
+
+        X = numpy.where(first_in_limits, X, negative_X)
+        theta = numpy.where(first_in_limits, theta, negative_theta)
+
+        return X, theta, reachable, first_in_limits | second_in_limits
+
+
+def xtz2xyz_arrays(X, theta, arm_length = 55.0):
+        '''xtz2xyz_arrays(X, theta, arm_length = 55.0)
+
+        Return the tuple (x, y) of arrays of the points reached by arrays of X
+        and theta settings. The array version of xtz2xyz().
+        '''
+        X = numpy.asarray(X, dtype = float)
+        radians = numpy.radians( numpy.asarray(theta, dtype = float) )
+
+        x = X - numpy.sin( radians ) * arm_length
+        y = -numpy.cos( radians ) * arm_length
+
+        return x, y
+
+
+def reachability_map(x_step = 0.1, y_step = 0.1, arm_length = 52.5, min_X = 0.0, max_X = 176.0):
+        '''reachability_map(x_step = 0.1, y_step = 0.1, arm_length = 52.5, min_X = 0.0, max_X = 176.0)
+
+        Return the tuple (x, y, reachable) of 2D arrays over a grid of the whole
+        workspace: x from min_X - arm_length to max_X + arm_length and y across
+        the reach of the arm, with the given steps in mm. reachable is true
+        where the camera can be put over the point exactly.
+        '''
+        x_values = numpy.arange(min_X - arm_length, max_X + arm_length + x_step/2.0, x_step)
+        y_values = numpy.arange(-arm_length, arm_length + y_step/2.0, y_step)
+        x, y = numpy.meshgrid(x_values, y_values)
+
+        X, theta, reachable, in_limits = xy2xtheta_arrays(x, y, arm_length, min_X, max_X)
+
+        return x, y, reachable & in_limits
+
+
+def benchmark(points = 100000, arm_length = 52.5, min_X = 0.0, max_X = 176.0):
+        '''benchmark(points = 100000, arm_length = 52.5, min_X = 0.0, max_X = 176.0)
+
+        Convert random points across the workspace with xy2xtheta() and with
+        xy2xtheta_arrays(), check they agree and print how long each took.
+        '''
+        from time import time
+        from scancam import XThetaZScanCam, xtz2xyz
+
+        random = numpy.random.RandomState(0)
+        x = random.uniform(min_X, max_X, points)
+        y = random.uniform(-arm_length, arm_length, points)
+
+        scancam = XThetaZScanCam([None, None, None], arm_length = arm_length, min_X = min_X, max_X = max_X)
+
+        start = time()
+        scalar = []
+        for index in xrange(points):
+                # Each point on its own, as the batch version does
+                scancam.used_negative_of_angle_last_time = False
+                try:
+                        scalar.append( scancam.xy2xtheta( {'x': x[index], 'y': y[index]} ) )
+                except ValueError:
+                        scalar.append( None )
+        scalar_time = time() - start
+
+        start = time()
+        X, theta, reachable, in_limits = xy2xtheta_arrays(x, y, arm_length, min_X, max_X)
+        batch_time = time() - start
+
+        for index in xrange(points):
+                if scalar[index] == None:
+                        assert not in_limits[index]
+                else:
+                        assert in_limits[index]
+                        assert abs(scalar[index]['X'] - X[index]) < 1e-9
+                        assert abs(scalar[index]['theta'] - theta[index]) < 1e-9
+
+        start = time()
+        for index in xrange(points):
+                xtz2xyz( {'X': X[index], 'theta': theta[index]}, arm_length )
+        scalar_inverse_time = time() - start
+
+        start = time()
+        xtz2xyz_arrays(X, theta, arm_length)
+        batch_inverse_time = time() - start
+
+        print 'xy2xtheta: %i points, %.3f s one at a time, %.4f s batched (%.0fx)' \
+                % (points, scalar_time, batch_time, scalar_time/batch_time)
+        print 'xtz2xyz:   %i points, %.3f s one at a time, %.4f s batched (%.0fx)' \
+                % (points, scalar_inverse_time, batch_inverse_time, scalar_inverse_time/batch_inverse_time)
+
+
+if __name__ == '__main__':
+        import sys
+        if sys.argv[1:2] == ['benchmark']:
+                benchmark()
@@ -0,0 +1,121 @@
+from copy import copy
+from math import sqrt
+
+# Conversions from the target_speed and acceleration settings to microsteps/s
+# and microsteps/s^2, by controller series. Speeds were backed out from the
+# zaber interface GUI. The A-series speed is a hack that was backed out to get
+# the speeds wanted from the LSA10A, and its acceleration isn't known, so
+# A-series moves are modelled as starting at full speed.
+controller_factors = {
+        'A-series':     (.61035, None),
+        'T-series':     (9.375, 11250.0),
+        }
+
+def trapezoid_move_time(distance, speed, acceleration = None):
+    '''trapezoid_move_time(distance, speed, acceleration = None)
+
+    Return the time in seconds to move distance from rest to rest, speeding up
+    and slowing down at acceleration, with a top speed of speed. If the move is
+    too short to reach speed, the profile is a triangle instead. With no
+    acceleration the move is taken at speed throughout.
+    '''
+    distance = abs(distance)
+
+    if distance == 0 or speed <= 0:
+        return 0.0
+
+    if acceleration == None or acceleration <= 0:
+        return distance/float(speed)
+
+    if distance >= speed*speed/float(acceleration):
+        # Reaches the target speed
+        return distance/float(speed) + speed/float(acceleration)
+    else:
+        # Accelerates for half the way and decelerates for the other half
+        return 2*sqrt(distance/float(acceleration))
+
+class move_model():
+    '''move_model(target_speed,
+                  acceleration,
+                  maximum_range = None,
+                  microsteps_per_unit = 1,
+                  controller_series = 'T-series')
+
+    Kinematic model of a device, for predicting how long moves take.
+
+    target_speed, acceleration and maximum_range are the device settings, as
+    in zaber_device.settings. Moves follow a trapezoidal speed profile, and
+    targets beyond 0 to maximum_range are taken as far as the end of travel.
+    microsteps_per_unit converts the move units used by move_time() to
+    microsteps. It depends on the microstep resolution (see
+    zaber_device.microsteps_per_unit).
+
+    See zaber_device.move_model() to build one from a device.
+    '''
+    def __init__(self,
+                 target_speed,
+                 acceleration,
+                 maximum_range = None,
+                 microsteps_per_unit = 1,
+                 controller_series = 'T-series'):
+
+        speed_factor, acceleration_factor = controller_factors[controller_series]
+        self.speed_factor = speed_factor
+
+        # microsteps/s and microsteps/s^2
+        self.speed = target_speed*speed_factor
+        if acceleration_factor == None:
+            self.acceleration = None
+        else:
+            self.acceleration = acceleration*acceleration_factor
+
+        self.maximum_range = maximum_range
+        self.microsteps_per_unit = microsteps_per_unit
+
+    def with_target_speed(self, target_speed):
+        '''move_model.with_target_speed(target_speed)
+
+        Return a copy of the model that moves at the target_speed setting
+        instead.
+        '''
+        model = copy(self)
+        model.speed = target_speed*self.speed_factor
+        return model
+
+    def clamp(self, position):
+        '''move_model.clamp(position)
+
+        Return the microstep position, limited to the travel of the device.
+        '''
+        if position < 0:
+            return 0
+        if not self.maximum_range == None and position > self.maximum_range:
+            return self.maximum_range
+        return position
+
+    def microstep_move_time(self, start, target):
+        '''move_model.microstep_move_time(start, target)
+
+        Return the time in seconds to move from start to target, both in
+        microsteps.
+        '''
+        distance = self.clamp(target) - self.clamp(start)
+        return trapezoid_move_time(distance, self.speed, self.acceleration)
+
+    def move_time(self, start, target):
+        '''move_model.move_time(start, target)
+
+        Return the time in seconds to move from start to target, both in move
+        units.
+        '''
+        return self.microstep_move_time(start*self.microsteps_per_unit, \
+                target*self.microsteps_per_unit)
+
+    def full_travel_time(self):
+        '''move_model.full_travel_time()
+
+        Return the time in seconds to move from one end of travel to the other.
+        '''
+        if self.maximum_range == None:
+            return None
+        return self.microstep_move_time(0, self.maximum_range)
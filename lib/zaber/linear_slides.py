@@ -1,5 +1,6 @@
 from zaber_device import *
 from zaber_multidevice import *
+from kinematics import controller_factors
 
 # Units are all with respect to 1 mm 
 linear_units = {
@@ -19,6 +20,8 @@ class linear_slide(zaber_device):
                  units = 'mm',
                  run_mode = CONTINUOUS,
                  action_handler = None,
+                 settings_cache = None,
+                 defer_settings = False,
                  verbose = False):
     
     Modified zaber_device with support for more meaningful linear units.
@@ -38,6 +41,8 @@ class linear_slide(zaber_device):
                  units = 'mm',
                  run_mode = CONTINUOUS,
                  action_handler = None,
+                 settings_cache = None,
+                 defer_settings = False,
                  verbose = False):
 
         mm_per_step = float(mm_per_rev)/float(steps_per_rev)
@@ -47,6 +52,8 @@ class linear_slide(zaber_device):
                 units_per_step = mm_per_step*linear_units[self.move_units],
                 run_mode = run_mode,
                 action_handler = action_handler,
+                settings_cache = settings_cache,
+                defer_settings = defer_settings,
                 verbose = verbose)
 
 
@@ -56,20 +63,25 @@ class linear_slide(zaber_device):
         Sets the speed at which move_relative and move_absolute commands will move
         (after acceleration period) in terms of meaningful scientific units.
         '''
-        # Constants backed out from zaber interface GUI
-        # TODO: The A-series number is a hack that was backed out to get the number i wanted
-        # contact Zaber to better understand the correct number for the LSA10A with
-        # different controllers
-        controller_factor = { 'A-series': .61035, 'T-series': 9.375 }
+        self.set_target_speed( self.target_speed_setting( speed_units_per_s, controller_series ) )
 
-        # TODO: read microstep resolution from ctrlr in case it differs from the default
-        #print "microstep resolution =", self.get( "microstep_resolution", blocking = True )
-        ustep_resolution = 1.0/64.0       
-        units_per_ustep = self.units_per_step * ustep_resolution
+    def target_speed_setting( self, speed_units_per_s, controller_series = "T-series" ):
+        ''' target_speed_setting( speed, stage_series )
+
+        Return the target_speed setting that set_target_speed_in_units() would send
+        for the speed in scientific units.
+        '''
+        # The speed is set in microsteps, whose size depends on the microstep 
+        # resolution of the controller
+        if self.microsteps_per_unit:
+            units_per_ustep = 1.0/self.microsteps_per_unit
+        else:
+            # Settings not read yet. Assume the default resolution.
+            units_per_ustep = self.units_per_step/64.0
 
         try:
-            data = int(speed_units_per_s / controller_factor[controller_series] / units_per_ustep)
-            self.set_target_speed( data )
+            speed_factor = controller_factors[controller_series][0]
+            return int(speed_units_per_s / speed_factor / units_per_ustep)
         except KeyError:
             print "set_target_speed():", controller_series, "is not a known controller series"
             raise
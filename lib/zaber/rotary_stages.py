@@ -15,6 +15,8 @@ class rotary_stage(zaber_device):
                  units = 'deg',
                  run_mode = CONTINUOUS,
                  action_handler = None,
+                 settings_cache = None,
+                 defer_settings = False,
                  verbose = False):
     
     Modified zaber_device with support for more meaningful linear units.
@@ -32,6 +34,8 @@ class rotary_stage(zaber_device):
                  units = 'deg',
                  run_mode = CONTINUOUS,
                  action_handler = None,
+                 settings_cache = None,
+                 defer_settings = False,
                  verbose = False):
 
         self.move_units = units
@@ -40,6 +44,8 @@ class rotary_stage(zaber_device):
                 units_per_step = deg_per_step*rotary_units[self.move_units],
                 run_mode = run_mode,
                 action_handler = action_handler,
+                settings_cache = settings_cache,
+                defer_settings = defer_settings,
                 verbose = verbose)
         
 
@@ -1,9 +1,15 @@
 import serial
 import struct
 import signal
-from threading import Thread,Event
+import os
+import select
+from time import time, sleep
+from threading import Thread,Event,Condition,Lock,current_thread
+from thread import get_ident
 from Queue import Queue,Empty
+from collections import deque
 from warnings import *
+from traffic_capture import traffic_capture, monotonic, SENT, RECEIVED
 
 PARITY_NONE, PARITY_EVEN, PARITY_ODD = 'N', 'E', 'O'
 STOPBITS_ONE, STOPBITS_TWO = (1, 2)
@@ -11,6 +17,10 @@ FIVEBITS, SIXBITS, SEVENBITS, EIGHTBITS = (5,6,7,8)
 
 GENERAL, DEVICE, MALFORMED = (0x00,0x01,0x02)
 
+# Placed on the packet queue by serial_connection.close() to wake the
+# queue handler so that it exits immediately
+SHUTDOWN = ('shutdown',)
+
 class serial_connection():
     """serial_connection (default = None, data_block_format = '<2Bi', packet_q = None)
 
@@ -80,6 +90,18 @@ class serial_connection():
 
         self.running = Event()
 
+        # Device packets that arrived in a batch but have not been handled yet
+        self.pending_packets = deque()
+
+        # The thread running the queue handler through open(), if any
+        self.handler_thread = None
+
+        # Notified after every packet is dispatched. See wait_until().
+        self.dispatched = Condition()
+
+        # Held by a thread handling the queue from wait_until()
+        self.handling_lock = Lock()
+
         # Initialise serial port
         self.io = async_serial(port, data_block_format, self.packet_q)
         
@@ -92,10 +114,15 @@ class serial_connection():
             self.data_block_types.append(type(each_value))
 
         self.data_block_types = tuple(self.data_block_types)
+        self.device_packet_length = len(self.data_block_types)
 
         # We allow open the serial port immediately so we don't lose
-        # replies during hardware initialisation
-        self.io.open()
+        # replies during hardware initialisation. Without a port (as when 
+        # replaying a capture) there is nothing to open and commands are
+        # dropped.
+        self.port_opened = not port == None
+        if self.port_opened:
+            self.io.open()
 
         # Initialise handler dictionary.
         self.handler_list = {}
@@ -104,6 +131,13 @@ class serial_connection():
         # device IDs and handler IDs.
         self.device_list = {}
 
+        # Precomputed lookups used by the queue handler so that dispatching a
+        # packet is a single dictionary lookup and call. handler_calls maps
+        # handler IDs and device_handlers maps device IDs to the callable
+        # that a packet should be passed to.
+        self.handler_calls = {}
+        self.device_handlers = {}
+
         self.default_handler_id = 1
 
     def __del__(self):
@@ -111,16 +145,62 @@ class serial_connection():
         # Exit tidily, shutting down connections etc
         self.close()
 
-    def send_command(self, device_id, command, data = 0):
-        """ serial_connection.send_command(device_id, command, data = 0)
+    def get_port(self):
+        """ serial_connection.get_port()
+        Return the serial port device string (or number) this connection
+        was opened with.
+        """
+        return self.io.serial.port
+
+    def send_command(self, device_id, command, data = 0, urgent = False, cancels = ()):
+        """ serial_connection.send_command(device_id, command, data = 0, 
+                urgent = False, cancels = ())
         Send a command to the specified device ID. No check is made on
         the validity of the device ID as the topology of network is not
         necessarily known.
+
+        The command is queued for the writer thread. Urgent commands (such
+        as stops) go ahead of every ordinary command still waiting to be
+        written, and any of those for the same device (or for any device
+        if device_id is 0) whose command is in cancels are dropped.
         """
-        self.io.write((device_id, command, data))
+        if self.port_opened:
+            self.io.write((device_id, command, data), urgent, cancels)
          
         return 0
 
+    def start_capture(self, path):
+        """ serial_connection.start_capture(path)
+        Start logging every packet sent and received to the binary capture 
+        file at path, replacing any capture already running. See 
+        traffic_capture.
+        """
+        self.stop_capture()
+        self.io.capture = traffic_capture(path)
+
+    def stop_capture(self):
+        """ serial_connection.stop_capture()
+        Stop logging packets and close the capture file.
+        """
+        capture = self.io.capture
+        self.io.capture = None
+        if not capture == None:
+            capture.close()
+
+    def hold_writes(self):
+        """ serial_connection.hold_writes()
+        Hold back ordinary commands until release_writes() is called, so
+        that commands sent to several devices at once go out in a single
+        write. Urgent commands are never held. Calls can be nested.
+        """
+        self.io.hold_writes()
+
+    def release_writes(self):
+        """ serial_connection.release_writes()
+        Release the commands held back since the matching hold_writes().
+        """
+        self.io.release_writes()
+
     def register_device(self, handler_id, device_id):
         """ serial_connection.register_device(handler_id, device_id)
         Attempt to register the the device given by device_id
@@ -134,6 +214,7 @@ class serial_connection():
                     %(str(device_id),str(handler_id),str(self.device_list[device_id])))
         else:
             self.device_list[device_id] = handler_id
+            self.update_dispatch_tables()
 
     
     def register(self, handler, handler_id = None, device_id = None):
@@ -164,6 +245,7 @@ class serial_connection():
         
         # This will overwrite a previously registered handler function
         self.handler_list[handler_id] = handler
+        self.update_dispatch_tables()
 
         # If no device id was passed
         if not device_id == None:
@@ -172,6 +254,32 @@ class serial_connection():
 
         return handler_id
     
+    def update_dispatch_tables(self):
+        """ serial_connection.update_dispatch_tables()
+        Rebuild the handler ID and device ID dispatch tables from
+        handler_list and device_list. This is called whenever a handler
+        or device is registered.
+
+        A handler that is a Queue is replaced by its put method so that the
+        type of the handler only needs to be checked here rather than for
+        every packet.
+        """
+        handler_calls = {}
+        for handler_id in self.handler_list:
+            handler = self.handler_list[handler_id]
+            if isinstance(handler, Queue):
+                handler_calls[handler_id] = handler.put
+            else:
+                handler_calls[handler_id] = handler
+
+        device_handlers = {}
+        for device_id in self.device_list:
+            if handler_calls.has_key(self.device_list[device_id]):
+                device_handlers[device_id] = handler_calls[self.device_list[device_id]]
+
+        self.handler_calls = handler_calls
+        self.device_handlers = device_handlers
+
     def inspect_packet(self, packet):
         """ serial_connection.inspect_packet(packet)
         Function that inspects the packet and returns a tuple containing
@@ -285,40 +393,78 @@ class serial_connection():
         """
         return data_block
 
-    def queue_handler(self, packets_to_handle=None):
-        """ serial_connection.queue_handler()
+    def queue_handler(self, packets_to_handle=None, timeout=None):
+        """ serial_connection.queue_handler(packets_to_handle=None, timeout=None)
         Function to handle the queue. This is the function that blocks
         until data is available on the queue. It inspects packets as they
         arrive, attempts to ignore malformed packets, and then sends the
         rest on accordingly.
+
+        Device packets are recognised by their length and sent straight to
+        the handler found in the device_handlers table. Anything else goes
+        through inspect_packet() and dispatch_packets().
+
+        The queue is waited on without a timeout unless one is given, in 
+        which case the handler returns if nothing arrives in time. close() 
+        wakes the handler by placing SHUTDOWN on the queue.
+
+        Threads waiting in wait_until() are notified after every packet.
         """
         if packets_to_handle == None:
             block = True
         else:
             block = False
 
+        device_packet_length = self.device_packet_length
+
         try:
             while block or packets_to_handle > 0 :
                 
-                try:
+                if self.pending_packets:
+                    # Finish off the last batch before going back to the queue
+                    data_block = self.pending_packets.popleft()
+
+                else:
                     if self.should_exit:
                         break
                     
-                    # Drop out of the queue check every half a second to check
-                    # we shouldn't be exiting
-                    data_block = self.packet_q.get(True, 0.5)
+                    try:
+                        data_block = self.packet_q.get(True, timeout)
+                    except Empty:
+                        break
 
-                    if not block:
-                        packets_to_handle = packets_to_handle - 1
-                
-                except Empty:
-                    if self.should_exit:
+                    if data_block is SHUTDOWN:
+                        # Put it back so that any other thread handling the
+                        # queue gets woken up too
+                        self.packet_q.put(SHUTDOWN)
                         break
-                    else:
+
+                    if type(data_block) == list:
+                        # async_serial hands over every packet framed by a single
+                        # read as one list. Unroll it and handle them in order.
+                        self.pending_packets.extend(data_block)
                         continue
 
+                if not block:
+                    packets_to_handle = packets_to_handle - 1
+
                 packet = self.build_packet(data_block)
 
+                if len(data_block) == device_packet_length and \
+                        not type(data_block[0]) == tuple:
+                    # We seem to have a device packet
+                    try:
+                        self.device_handlers[data_block[0]](packet)
+                    except KeyError:
+                        if not self.device_handlers.has_key(data_block[0]):
+                            warn('Data returned from unregistered device ' \
+                                    + str(data_block[0]) + ': ' + str(packet))
+                        else:
+                            raise
+                    
+                    self.notify_dispatched()
+                    continue
+
                 packet_details = self.inspect_packet(data_block)
                 if packet_details[0] == GENERAL:
                     # We seem to have a general packet
@@ -343,6 +489,8 @@ class serial_connection():
                     # We seem to have a malformed packet
                     warn('Malformed packet received. Ignoring it...')
 
+                self.notify_dispatched()
+
         except KeyboardInterrupt:
             self.close()
             # Pass on the interrupt to the calling function
@@ -357,32 +505,93 @@ class serial_connection():
         """ serial_connection.dispatch_packets(destination, packet)
         Attempt to dispatch the packet to the destination (a handler ID)
         """
-        if self.handler_list.has_key(destination):
-
-            # See whether we have a queue of a function on which to act
-            # This uses the big evil that is 'isinstance' to negate the 
-            # need for a separate queue handler class. Perhaps there is 
-            # a better way to do this...?
-            if isinstance(self.handler_list[destination], Queue):
-                # we have a handler queue
-                self.handler_list[destination].put(packet)
-            else:
-                # We have something else
-                self.handler_list[destination](packet)
+        if self.handler_calls.has_key(destination):
+            # Queue handlers have already been swapped for their put method
+            # in update_dispatch_tables()
+            self.handler_calls[destination](packet)
 
         else:
             warn('No handler ID: %s is registered.' % (str(destination)))
             if not source == None:
-                self.handler_list[source](('destination_not_registered', packet))
+                self.handler_calls[source](('destination_not_registered', packet))
 
 
     
+    def notify_dispatched(self):
+        """ serial_connection.notify_dispatched()
+        Wake any threads waiting in wait_until() so that they can check
+        whether they are done waiting.
+        """
+        self.dispatched.acquire()
+        try:
+            self.dispatched.notifyAll()
+        finally:
+            self.dispatched.release()
+
+    def handled_elsewhere(self):
+        """ serial_connection.handled_elsewhere()
+        Return whether the queue handler is running (through open()) in a
+        thread other than the calling one.
+        """
+        return self.running.isSet() and not self.handler_thread == get_ident()
+
+    def wait_until(self, condition_met, timeout=None):
+        """ serial_connection.wait_until(condition_met, timeout=None)
+        Block until condition_met() returns True, which it can only do as a
+        result of packets being dispatched. Returns False if timeout
+        seconds pass first, otherwise True.
+
+        If the queue handler is running in another thread, this just waits
+        for it to dispatch packets. Otherwise packets are handled from this
+        thread. If several threads wait at once without a running queue
+        handler, only one of them handles packets at a time and the others
+        wait on it.
+        """
+        if not timeout == None:
+            deadline = time() + timeout
+        
+        while not condition_met():
+            if timeout == None:
+                remaining = None
+            else:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    return False
+
+            if not self.handled_elsewhere() and self.handling_lock.acquire(False):
+                try:
+                    if not condition_met():
+                        self.queue_handler(1, remaining)
+                finally:
+                    self.handling_lock.release()
+                
+                if self.should_exit:
+                    return condition_met()
+            else:
+                self.dispatched.acquire()
+                try:
+                    if not condition_met():
+                        if remaining == None and not self.handled_elsewhere():
+                            # Another waiter is handling packets. Check back
+                            # in case it finishes before our packet arrives.
+                            remaining = 0.05
+                        self.dispatched.wait(remaining)
+                finally:
+                    self.dispatched.release()
+
+        return True
+
     def open(self):
         """ serial_connection.open()
-        Method to open the connection
+        Method to open the connection. This runs the queue handler in the
+        calling thread until the connection is closed.
         """
-        self.queue_handler()
+        self.handler_thread = get_ident()
         self.running.set()
+        try:
+            self.queue_handler()
+        finally:
+            self.running.clear()
 
     def close(self):
         """ serial_connection.close()
@@ -390,9 +599,99 @@ class serial_connection():
         """
         self.should_exit = True
         self.io.close()
+        self.stop_capture()
+        self.packet_q.put(SHUTDOWN)
         self.running.clear()
         print '\nGoodbye from the serial connection!'
 
+class packet_framer():
+    '''packet_framer(data_block_format = '<2Bi', buffer_packets = 64)
+
+    Frames a raw byte stream from the serial bus into fixed size packets.
+
+    Incoming bytes are copied into a preallocated bytearray which is reused
+    for the life of the framer. Every whole packet currently held is unpacked
+    in a single pass and the trailing partial packet (if any) is moved back
+    to the start of the buffer to be completed by the next call to feed().
+
+    buffer_packets is the number of whole packets the buffer can initially
+    hold. The buffer grows if a single read ever returns more than that.
+    '''
+
+    def __init__(self, data_block_format = '<2Bi', buffer_packets = 64):
+
+        try:
+            self.struct = struct.Struct(data_block_format)
+        except:
+            raise StandardError('Problem encountered loading struct with ' +data_block_format)
+
+        self.packet_size = self.struct.size
+
+        self.buffer = bytearray(self.packet_size*buffer_packets)
+        self.view = memoryview(self.buffer)
+
+        # Number of bytes in the buffer that are yet to be unpacked
+        self.fill = 0
+
+    def feed(self, data):
+        '''packet_framer.feed(data)
+
+        Append data to the buffer and return a list of all of the packets
+        it completes, unpacked using the data block format. The list is empty
+        if no packet was completed.
+        '''
+        new_fill = self.fill + len(data)
+
+        if new_fill > len(self.buffer):
+            self.grow(new_fill)
+
+        self.view[self.fill:new_fill] = data
+        self.fill = new_fill
+
+        if self.fill < self.packet_size:
+            return []
+
+        packet_size = self.packet_size
+        whole_bytes = self.fill - self.fill % packet_size
+        
+        unpack_from = self.struct.unpack_from
+        buffer = self.buffer
+        packets = [unpack_from(buffer, offset) \
+                for offset in xrange(0, whole_bytes, packet_size)]
+
+        # Keep the partial packet. It is always shorter than the whole
+        # packets before it, so the copy never overlaps itself.
+        remainder = self.fill - whole_bytes
+        if remainder:
+            self.view[0:remainder] = self.view[whole_bytes:self.fill]
+
+        self.fill = remainder
+
+        return packets
+
+    def grow(self, size):
+        '''packet_framer.grow(size)
+
+        Reallocate the buffer so that it can hold at least size bytes,
+        keeping the bytes that are yet to be unpacked.
+        '''
+        new_size = len(self.buffer)
+        while new_size < size:
+            new_size = new_size*2
+
+        new_buffer = bytearray(new_size)
+        new_buffer[0:self.fill] = self.buffer[0:self.fill]
+        
+        self.buffer = new_buffer
+        self.view = memoryview(self.buffer)
+
+    def reset(self):
+        '''packet_framer.reset()
+
+        Discard any partial packet held in the buffer.
+        '''
+        self.fill = 0
+
 class async_serial(Thread):
     def __init__(self,
                  port = None,           #Number of device, numbering starts at
@@ -411,13 +710,17 @@ class async_serial(Thread):
                  xonxoff=0,             #enable software flow control
                  rtscts=0,              #enable RTS/CTS flow control
                  writeTimeout=None,     #set a timeout for writes
-                 dsrdtr=None            #None: use rtscts setting, dsrdtr override if true or false
+                 dsrdtr=None,           #None: use rtscts setting, dsrdtr override if true or false
+                 max_write_batch=4      #Most ordinary packets written at once. An
+                                        # urgent packet waits for at most one
+                                        # batch to go out on the wire.
                  ):
 
         '''Initialise the asynchronous serial object
         '''
         
         Thread.__init__(self)
+        self.daemon = True
         self.serial = serial.Serial( port,
                                 baudrate,
                                 bytesize,
@@ -431,14 +734,27 @@ class async_serial(Thread):
         
         self.running = Event()
 
-        self.buffer = ''
-        
-        try:
-            self.struct = struct.Struct(data_block_format)
-        except:
-            raise StandardError('Problem encountered loading struct with ' +data_block_format)
+        # Writing to this pipe wakes the listening thread out of select()
+        self.wakeup_r, self.wakeup_w = os.pipe()
+
+        self.framer = packet_framer(data_block_format)
+
+        # Packets waiting for the writer thread. Urgent packets are always
+        # written before ordinary ones.
+        self.writes = deque()
+        self.urgent_writes = deque()
+        self.write_condition = Condition()
+        self.writes_held = 0
+        self.max_write_batch = max_write_batch
+
+        self.writer = Thread(target = self.write_loop)
+        self.writer.daemon = True
+
+        # A traffic_capture that every packet written and read is recorded in
+        self.capture = None
         
-        self.packet_size = self.struct.size
+        self.struct = self.framer.struct
+        self.packet_size = self.framer.packet_size
         
         if read_q == None:
             self.read_q = Queue()
@@ -451,33 +767,171 @@ class async_serial(Thread):
         '''
         self.serial.flushOutput()
         self.serial.flushInput()
+        self.framer.reset()
         self.running.set()
         self.start()
+        self.writer.start()
     
-    def write(self, data):
-        '''Write a packet to the serial bus.
+    def write(self, data, urgent = False, cancels = ()):
+        '''Queue a packet to be written to the serial bus by the writer thread.
+
+        Urgent packets jump ahead of all the ordinary packets still waiting. The
+        waiting ordinary packets for the same device (or all devices if the
+        device is 0) whose command is in cancels are dropped, since they would
+        otherwise undo the urgent packet (such as a move queued before a stop).
+        '''
+        self.write_condition.acquire()
+        try:
+            if urgent:
+                if cancels:
+                    device = data[0]
+                    self.writes = deque([packet for packet in self.writes \
+                            if not (packet[1] in cancels and \
+                                    (device == 0 or packet[0] == device))])
+                self.urgent_writes.append(data)
+                self.write_condition.notify()
+            else:
+                self.writes.append(data)
+                if not self.writes_held:
+                    self.write_condition.notify()
+        finally:
+            self.write_condition.release()
+
+    def hold_writes(self):
+        '''Hold ordinary packets back until release_writes() is called.
         '''
-        self.serial.write(apply(self.struct.pack, data))
+        self.write_condition.acquire()
+        self.writes_held = self.writes_held + 1
+        self.write_condition.release()
 
-    def close(self):
-        '''Close the listening thread.
+    def release_writes(self):
+        '''Release the packets held back by hold_writes().
+        '''
+        self.write_condition.acquire()
+        try:
+            self.writes_held = self.writes_held - 1
+            if not self.writes_held:
+                self.write_condition.notify()
+        finally:
+            self.write_condition.release()
+
+    def next_writes(self):
+        '''Wait for packets to write and take them off the write queues. All of the
+        urgent packets are taken if there are any, otherwise up to max_write_batch
+        ordinary packets. Once the thread is closed, held packets are taken too and
+        an empty list is returned when there is nothing left to write.
+        '''
+        self.write_condition.acquire()
+        try:
+            while self.running.isSet() and not self.urgent_writes and \
+                    (self.writes_held or not self.writes):
+                self.write_condition.wait()
+
+            if self.urgent_writes:
+                batch = list(self.urgent_writes)
+                self.urgent_writes.clear()
+            else:
+                batch = [self.writes.popleft() for each_write in \
+                        xrange(min(self.max_write_batch, len(self.writes)))]
+        finally:
+            self.write_condition.release()
+
+        return batch
+
+    def write_loop(self):
+        '''Run by the writer thread. Packets are packed and written together. The
+        next batch isn't taken until the last one has had time to go out on the
+        wire, so that an urgent packet only ever queues behind the batch in
+        progress rather than everything sitting in the port's output buffer.
+        '''
+        pack = self.struct.pack
+        
+        while True:
+            batch = self.next_writes()
+            if not batch:
+                # Only happens once closed and everything has been written
+                return None
+
+            data = ''.join([apply(pack, packet) for packet in batch])
+            capture = self.capture
+            if not capture == None:
+                capture_time = monotonic()
+
+            try:
+                write_time = time()
+                self.serial.write(data)
+                self.serial.flush()
+            except (serial.SerialException, OSError, ValueError), errmsg:
+                warn('Unable to write to the serial port: %s' % str(errmsg))
+                continue
+
+            if not capture == None:
+                capture.record_packets(SENT, batch, capture_time)
+
+            # Each byte is 10 bits on the wire (with the start and stop bits)
+            remaining = write_time + len(data)*10.0/self.serial.baudrate - time()
+            if remaining > 0:
+                sleep(remaining)
+
+    def close(self, write_timeout = 1.0):
+        '''Close the listening and writer threads. Packets still waiting to be
+        written (such as a final stop) are written first, waiting for up to
+        write_timeout seconds.
         '''
         self.running.clear()
+        self.write_condition.acquire()
+        self.write_condition.notify()
+        self.write_condition.release()
+        
+        if self.writer.isAlive() and not self.writer is current_thread():
+            self.writer.join(write_timeout)
+
+        try:
+            os.write(self.wakeup_w, 'x')
+        except OSError:
+            pass
 
     def run(self):
         '''Run is the function that runs in the new thread and is called by
         start(), inherited from the Thread class
         '''
+        # Wait on the serial port's file descriptor when we can get one so
+        # that we wake as soon as bytes arrive or close() is called. Ports
+        # without one fall back to blocking reads with the packet timeout.
+        try:
+            fileno = self.serial.fileno()
+        except:
+            fileno = None
+
         try:
             while(self.running.isSet()):
-                new_data = self.serial.read(self.packet_size-len(self.buffer))
-                self.buffer = self.buffer + new_data
-                if (len(self.buffer) == self.packet_size):
-                    # Put the unpacked data onto the read queue
-                    self.read_q.put(self.struct.unpack(self.buffer))
+                if not fileno == None:
+                    readable = select.select([fileno, self.wakeup_r], [], [])[0]
+                    
+                    if self.wakeup_r in readable:
+                        os.read(self.wakeup_r, 4096)
+                        continue
 
-                    # Clear the buffer
-                    self.buffer = ''
+                # Drain everything that has already arrived in one read. If
+                # nothing is waiting, block (up to the packet timeout) on the
+                # first byte of the next reply.
+                new_data = self.serial.read(self.serial.inWaiting() or 1)
+                
+                if not new_data:
+                    continue
+
+                packets = self.framer.feed(new_data)
+
+                capture = self.capture
+                if packets and not capture == None:
+                    capture.record_packets(RECEIVED, packets)
+                
+                if len(packets) == 1:
+                    self.read_q.put(packets[0])
+                elif packets:
+                    # A burst of replies goes onto the read queue as a single
+                    # batch so that the queue handler only wakes once for it
+                    self.read_q.put(packets)
 
         except KeyboardInterrupt:
             self.interrupt_main()
@@ -489,6 +943,111 @@ class basic_test:
         self.async_serial = async_serial('/dev/ttyUSB0', '<2Bi')
         self.async_serial.open()
 
+def stop_latency_bound(baudrate = 9600, max_write_batch = 4, data_block_format = '<2Bi'):
+    '''stop_latency_bound(baudrate = 9600, max_write_batch = 4, data_block_format = '<2Bi')
+
+    Return the longest time in seconds that an urgent packet (such as a stop) can
+    spend on the wire. It waits behind at most one batch of ordinary packets
+    that is already being written, and then goes out itself. Each byte takes 10
+    bits on the wire (8 data bits, a start bit and a stop bit).
+
+    This is wire time only, so it is a lower bound on the worst latency rather
+    than a guarantee. Waking the writer thread, buffering in the serial driver
+    or USB adapter and the thread reading the far end all add to it, by tens of
+    milliseconds on a loaded machine.
+    '''
+    packet_time = struct.calcsize(data_block_format)*10.0/baudrate
+
+    return (max_write_batch + 1)*packet_time
+
+def stop_latency_benchmark(iterations = 50, backlog = 20, baudrate = 9600):
+    '''stop_latency_benchmark(iterations = 50, backlog = 20, baudrate = 9600)
+
+    Measure the time from a stop being written to it arriving at the other end of
+    the serial port, while backlog ordinary packets for another device are
+    waiting to be written ahead of it. Also counts how many of those ordinary 
+    packets got out ahead of the stop.
+
+    A pseudo-terminal stands in for the serial port. Its far end is read no
+    faster than the bytes would cross the wire at baudrate, so the latencies
+    can be compared with the wire time of stop_latency_bound(). They also
+    include the scheduling of the writer and reader threads, which the bound
+    leaves out.
+    '''
+    import thread
+
+    packer = struct.Struct('<2Bi')
+    stop_command = 23
+    
+    master, slave = os.openpty()
+    io = async_serial(os.ttyname(slave), '<2Bi')
+    io.open()
+
+    state = {'received': 0, 'stop_time': None, 'ahead': 0}
+    stop_arrived = Event()
+
+    def read_master():
+        framer = packet_framer('<2Bi')
+        while True:
+            try:
+                new_data = os.read(master, 4096)
+            except OSError:
+                return
+            # The time the bytes would take on the wire
+            sleep(len(new_data)*10.0/baudrate)
+            for packet in framer.feed(new_data):
+                if packet[1] == stop_command:
+                    state['stop_time'] = time()
+                    state['ahead'] = state['received']
+                    stop_arrived.set()
+                else:
+                    state['received'] = state['received'] + 1
+
+    thread.start_new_thread(read_master, ())
+
+    latencies = []
+    ahead = []
+    for n in range(iterations):
+        stop_arrived.clear()
+        state['received'] = 0
+
+        for each_packet in range(backlog):
+            io.write((2, 20, each_packet))
+
+        # Send the stop part way through writing the backlog
+        sleep(3*stop_latency_bound(baudrate, io.max_write_batch))
+
+        sent_time = time()
+        io.write((1, stop_command, 0), urgent = True, cancels = (20,))
+        stop_arrived.wait(5)
+        
+        latencies.append(state['stop_time'] - sent_time)
+        ahead.append(state['ahead'])
+
+        # Let the backlog drain before the next stop
+        while state['received'] < backlog:
+            sleep(0.001)
+
+    io.close()
+    io.join(1)
+    os.close(master)
+
+    bound = stop_latency_bound(baudrate, io.max_write_batch)
+    within_bound = len([latency for latency in latencies if latency <= bound])
+
+    latencies.sort()
+    print 'Stop latency over %d stops, sent while writing %d packets at %d baud:' \
+            % (iterations, backlog, baudrate)
+    print '    median: %.3f ms' % (1000*latencies[len(latencies)/2])
+    print '    99%%:    %.3f ms' % (1000*latencies[int(len(latencies)*0.99)])
+    print '    max:    %.3f ms' % (1000*latencies[-1])
+    print '    wire time bound:  %.3f ms (met by %d of %d)' % (1000*bound, within_bound, iterations)
+    if within_bound < iterations:
+        print '    the rest were held up by thread scheduling, which the bound leaves out'
+    print '    packets written ahead of the stop: %d to %d' % (min(ahead), max(ahead))
+
+    return latencies
+
 def main(argv):
     ''' Run some basic stuff to test it working
     '''
@@ -500,4 +1059,7 @@ def main(argv):
 
 if __name__ == "__main__":
     import sys
-    main(sys.argv)
+    if sys.argv[1:2] == ['benchmark']:
+        stop_latency_benchmark()
+    else:
+        main(sys.argv)
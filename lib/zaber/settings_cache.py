@@ -0,0 +1,124 @@
+import os
+import pickle
+from warnings import warn
+
+DEFAULT_SETTINGS_CACHE = os.path.expanduser('~/.zaber_settings_cache')
+
+# Settings that change as the device is used and so are never worth caching
+volatile_settings = ('current_position',)
+
+class settings_cache():
+    '''settings_cache(path = None, refresh = False)
+
+    On-disk cache of the settings read back from Zaber devices, so that a
+    device doesn't have to be asked for every one of its settings each time
+    it is initialised.
+
+    Entries are keyed by the serial device the chain is connected to and the
+    device number on the chain. Each entry holds the device ID reported by
+    the device (from return_device_id) along with its settings. It is up to
+    the device to check that an entry still matches the hardware before
+    using it. See zaber_device.load_settings().
+
+    path: File to keep the cache in. Defaults to DEFAULT_SETTINGS_CACHE.
+
+    refresh: If True, existing entries are ignored so that every device reads
+        all of its settings again. The fresh settings are still stored.
+    '''
+
+    def __init__(self, path = None, refresh = False):
+
+        if path == None:
+            path = DEFAULT_SETTINGS_CACHE
+
+        self.path = path
+        self.refresh = refresh
+
+        self.entries = {}
+        self.load()
+
+    def load(self):
+        '''settings_cache.load()
+
+        Read the cache file. A missing or unreadable file leaves the cache
+        empty.
+        '''
+        try:
+            cache_file = open(self.path, 'rb')
+        except IOError:
+            return None
+
+        try:
+            try:
+                self.entries = pickle.load(cache_file)
+            except Exception:
+                warn('Unable to read the settings cache %s. Ignoring it.' % self.path)
+                self.entries = {}
+        finally:
+            cache_file.close()
+
+        return None
+
+    def save(self):
+        '''settings_cache.save()
+
+        Write the cache file. The file is written alongside and then renamed
+        into place so that an interrupted write can't leave a corrupt cache.
+        '''
+        temp_path = self.path + '.tmp'
+        try:
+            cache_file = open(temp_path, 'wb')
+            try:
+                pickle.dump(self.entries, cache_file)
+            finally:
+                cache_file.close()
+            os.rename(temp_path, self.path)
+        except (IOError, OSError), errmsg:
+            warn('Unable to write the settings cache %s: %s' % (self.path, str(errmsg)))
+
+        return None
+
+    def lookup(self, port, device_number):
+        '''settings_cache.lookup(port, device_number)
+
+        Return the cached entry for the device as a dictionary with the keys
+        'device_id' and 'settings', or None if there isn't one (or the cache
+        is being refreshed).
+        '''
+        if self.refresh:
+            return None
+
+        return self.entries.get((port, device_number))
+
+    def store(self, port, device_number, device_id, settings):
+        '''settings_cache.store(port, device_number, device_id, settings)
+
+        Store the settings for the device and save the cache. Volatile
+        settings are left out.
+        '''
+        cached_settings = {}
+        for each_setting in settings:
+            if not each_setting in volatile_settings:
+                cached_settings[each_setting] = settings[each_setting]
+
+        self.entries[(port, device_number)] = {'device_id': device_id,
+                                               'settings': cached_settings}
+        self.save()
+
+        return None
+
+    def forget(self, port, device_number, setting):
+        '''settings_cache.forget(port, device_number, setting)
+
+        Drop a single setting from the device's entry, so that it is read
+        from the device next time. This should be called when a setting is
+        changed on the device. The cache is only saved if something was
+        actually dropped.
+        '''
+        entry = self.entries.get((port, device_number))
+
+        if not entry == None and entry['settings'].has_key(setting):
+            del entry['settings'][setting]
+            self.save()
+
+        return None
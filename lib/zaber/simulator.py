@@ -0,0 +1,550 @@
+import os
+import select
+import random
+from math import sqrt
+from time import time, sleep
+from threading import Thread, Event
+from serial_connection import packet_framer
+from kinematics import controller_factors, trapezoid_move_time
+
+# Conversions from the T-series speed and acceleration settings to
+# microsteps/s and microsteps/s^2
+T_SERIES_SPEED_FACTOR, T_SERIES_ACCELERATION_FACTOR = controller_factors['T-series']
+
+# Command numbers of the T-series binary protocol, as in zaber_device
+RESET, HOME, RENUMBER = (0, 1, 2)
+STORE_CURRENT_POSITION, RETURN_STORED_POSITION, MOVE_TO_STORED_POSITION = (16, 17, 18)
+MOVE_ABSOLUTE, MOVE_RELATIVE, MOVE_AT_CONSTANT_SPEED, STOP = (20, 21, 22, 23)
+RETURN_DEVICE_ID, RETURN_SETTING, ECHO_DATA, RETURN_CURRENT_POSITION = (50, 53, 55, 60)
+
+MICROSTEP_RESOLUTION, TARGET_SPEED, ACCELERATION = (37, 42, 43)
+MAXIMUM_RANGE, CURRENT_POSITION = (44, 45)
+
+ERROR, BUSY = (255, 255)
+
+# Commands that a device answers even while it is homing
+always_answered = (STOP, RETURN_DEVICE_ID, RETURN_SETTING, ECHO_DATA, \
+        RETURN_CURRENT_POSITION)
+
+class virtual_device():
+    '''virtual_device(device_number,
+                      device_id = 0,
+                      maximum_range = 1000000,
+                      microstep_resolution = 64,
+                      target_speed = 2000,
+                      acceleration = 100)
+
+    A simulated T-series Zaber device, as found on a virtual_chain.
+
+    Moves take as long as they would on the device, following a trapezoidal
+    speed profile set by the target_speed and acceleration settings (see
+    T_SERIES_SPEED_FACTOR and T_SERIES_ACCELERATION_FACTOR). A move or stop sent
+    during a move takes over from it, so only one reply is sent for them. Moves
+    always start from rest, even when they take over from another move.
+
+    device_id is returned by return_device_id. Positions are in microsteps and
+    moves outside 0 to maximum_range are refused with an error, as are settings
+    the device doesn't have.
+
+    Changing the microstep resolution rescales the position, as the hardware
+    does. Changing the target speed or acceleration during a move carries the
+    move on from where it has got to with the new setting.
+    '''
+    def __init__(self,
+                 device_number,
+                 device_id = 0,
+                 maximum_range = 1000000,
+                 microstep_resolution = 64,
+                 target_speed = 2000,
+                 acceleration = 100):
+
+        self.device_number = device_number
+        self.device_id = device_id
+
+        # Settings by command number, as in zaber_device.setting_commands
+        self.settings = {
+                MICROSTEP_RESOLUTION:       microstep_resolution,
+                38:                         10,     # running_current
+                39:                         20,     # hold_current
+                40:                         0,      # device_mode
+                TARGET_SPEED:               target_speed,
+                ACCELERATION:               acceleration,
+                MAXIMUM_RANGE:              maximum_range,
+                47:                         0,      # home_offset
+                48:                         0,      # alias_number
+                }
+
+        self.stored_positions = {}
+
+        self.position = 0
+
+        # The motion in progress as (command, start time, start position,
+        # target, duration), or None
+        self.motion = None
+
+    def speed(self):
+        return self.settings[TARGET_SPEED]*T_SERIES_SPEED_FACTOR
+
+    def acceleration(self):
+        return self.settings[ACCELERATION]*T_SERIES_ACCELERATION_FACTOR
+
+    def move_duration(self, distance):
+        '''virtual_device.move_duration(distance)
+
+        Return the time in seconds to move distance microsteps from rest to
+        rest.
+        '''
+        return trapezoid_move_time(distance, self.speed(), self.acceleration())
+
+    def current_position(self, now):
+        '''virtual_device.current_position(now)
+
+        Return the position at the time now, part way through any motion.
+        '''
+        if self.motion == None:
+            return self.position
+
+        command, start_time, start, target, duration = self.motion
+
+        elapsed = now - start_time
+        if elapsed >= duration:
+            return target
+
+        if command == MOVE_AT_CONSTANT_SPEED:
+            return int(start + (target - start)*elapsed/duration)
+
+        distance = abs(target - start)
+        speed = self.speed()
+        acceleration = self.acceleration()
+
+        if acceleration <= 0:
+            travelled = speed*elapsed
+        else:
+            if distance >= speed*speed/acceleration:
+                peak_speed = speed
+            else:
+                peak_speed = sqrt(distance*acceleration)
+            ramp_time = peak_speed/acceleration
+
+            if elapsed < ramp_time:
+                travelled = acceleration*elapsed*elapsed/2
+            elif elapsed < duration - ramp_time:
+                travelled = peak_speed*ramp_time/2 + peak_speed*(elapsed - ramp_time)
+            else:
+                remaining = duration - elapsed
+                travelled = distance - acceleration*remaining*remaining/2
+
+        if target < start:
+            travelled = -travelled
+
+        return int(start + travelled)
+
+    def completion_time(self):
+        '''virtual_device.completion_time()
+
+        Return when the motion in progress finishes, or None if there isn't one.
+        '''
+        if self.motion == None:
+            return None
+
+        return self.motion[1] + self.motion[4]
+
+    def complete(self, now):
+        '''virtual_device.complete(now)
+
+        Finish the motion in progress and return its reply packet.
+        '''
+        command, start_time, start, target, duration = self.motion
+
+        self.position = target
+        self.motion = None
+
+        if command == HOME:
+            return (self.device_number, HOME, 0)
+
+        return (self.device_number, command, self.position)
+
+    def start_motion(self, command, target, now):
+        self.position = self.current_position(now)
+
+        if command == MOVE_AT_CONSTANT_SPEED:
+            duration = abs(target - self.position)/max(self.speed(), 1)
+        else:
+            duration = self.move_duration(target - self.position)
+
+        self.motion = (command, now, self.position, target, duration)
+
+    def handle(self, command, data, now):
+        '''virtual_device.handle(command, data, now)
+
+        Act on a command received at the time now and return a list of the
+        reply packets to send straight away. Replies to moves are sent when
+        the move completes instead (see complete()).
+        '''
+        number = self.device_number
+        maximum_range = self.settings[MAXIMUM_RANGE]
+
+        if not self.motion == None and self.motion[0] == HOME and \
+                not command in always_answered:
+            return [(number, ERROR, BUSY)]
+
+        if command == RESET:
+            self.motion = None
+            return []
+
+        elif command == HOME:
+            self.start_motion(HOME, 0, now)
+            return []
+
+        elif command == RENUMBER:
+            return [(number, RENUMBER, number)]
+
+        elif command == STORE_CURRENT_POSITION:
+            self.stored_positions[data] = self.current_position(now)
+            return [(number, STORE_CURRENT_POSITION, data)]
+
+        elif command == RETURN_STORED_POSITION:
+            if not self.stored_positions.has_key(data):
+                return [(number, ERROR, 1700)]
+            return [(number, RETURN_STORED_POSITION, self.stored_positions[data])]
+
+        elif command == MOVE_TO_STORED_POSITION:
+            if not self.stored_positions.has_key(data):
+                return [(number, ERROR, 1800)]
+            self.start_motion(MOVE_TO_STORED_POSITION, self.stored_positions[data], now)
+            return []
+
+        elif command == MOVE_ABSOLUTE or command == MOVE_RELATIVE:
+            if command == MOVE_ABSOLUTE:
+                target = data
+            else:
+                target = self.current_position(now) + data
+
+            if target < 0 or target > maximum_range:
+                return [(number, ERROR, command)]
+
+            self.start_motion(command, target, now)
+            return []
+
+        elif command == MOVE_AT_CONSTANT_SPEED:
+            # Runs until the end of travel. The reply is the speed, straight away.
+            if data == 0:
+                self.position = self.current_position(now)
+                self.motion = None
+            else:
+                self.settings[TARGET_SPEED] = abs(data)
+                if data > 0:
+                    self.start_motion(MOVE_AT_CONSTANT_SPEED, maximum_range, now)
+                else:
+                    self.start_motion(MOVE_AT_CONSTANT_SPEED, 0, now)
+            return [(number, MOVE_AT_CONSTANT_SPEED, data)]
+
+        elif command == STOP:
+            self.position = self.current_position(now)
+            self.motion = None
+            return [(number, STOP, self.position)]
+
+        elif command == RETURN_DEVICE_ID:
+            return [(number, RETURN_DEVICE_ID, self.device_id)]
+
+        elif command == RETURN_SETTING:
+            if data == CURRENT_POSITION:
+                return [(number, CURRENT_POSITION, self.current_position(now))]
+            if not self.settings.has_key(data):
+                return [(number, ERROR, RETURN_SETTING)]
+            return [(number, data, self.settings[data])]
+
+        elif command == ECHO_DATA:
+            return [(number, ECHO_DATA, data)]
+
+        elif command == RETURN_CURRENT_POSITION:
+            return [(number, RETURN_CURRENT_POSITION, self.current_position(now))]
+
+        elif command == CURRENT_POSITION:
+            if data < 0 or data > maximum_range:
+                return [(number, ERROR, CURRENT_POSITION)]
+            self.motion = None
+            self.position = data
+            return [(number, CURRENT_POSITION, data)]
+
+        elif self.settings.has_key(command):
+            if command == MICROSTEP_RESOLUTION:
+                if not data in (1, 2, 4, 8, 16, 32, 64, 128):
+                    return [(number, ERROR, MICROSTEP_RESOLUTION)]
+
+                scale = float(data)/self.settings[MICROSTEP_RESOLUTION]
+                self.position = int(self.current_position(now)*scale)
+                self.motion = None
+                self.settings[MAXIMUM_RANGE] = int(maximum_range*scale)
+
+            elif data < 0:
+                return [(number, ERROR, command)]
+
+            motion = self.motion
+            if command in (TARGET_SPEED, ACCELERATION) and not motion == None and \
+                    not motion[0] == MOVE_AT_CONSTANT_SPEED:
+                self.position = self.current_position(now)
+                self.motion = None
+                self.settings[command] = data
+                self.start_motion(motion[0], motion[3], now)
+                return [(number, command, data)]
+
+            self.settings[command] = data
+            return [(number, command, data)]
+
+        # Not a command we know
+        return [(number, ERROR, command)]
+
+class virtual_chain(Thread):
+    '''virtual_chain(devices = None,
+                     data_block_format = '<2Bi',
+                     baudrate = 9600,
+                     busy_probability = 0.0,
+                     seed = None)
+
+    A chain of simulated T-series Zaber devices behind a pseudo-terminal. Once
+    started, self.port is the device string to open in place of the real serial
+    port, for instance with serial_connection(chain.port).
+
+    devices is a list of virtual_device instances. By default there are three,
+    numbered 1 to 3, set up as the x, theta and z stages of the ScanCam (see
+    scancam_devices()).
+
+    Replies are sent no faster than they would cross the wire at baudrate (or as
+    fast as possible if baudrate is None). Commands to device 0 go to every
+    device.
+
+    busy_probability is the chance that a move is refused with a busy error, to
+    exercise the handling of busy errors. seed seeds the random numbers used for
+    this.
+
+    Call close() to stop the simulation.
+    '''
+    def __init__(self,
+                 devices = None,
+                 data_block_format = '<2Bi',
+                 baudrate = 9600,
+                 busy_probability = 0.0,
+                 seed = None):
+
+        Thread.__init__(self)
+        self.daemon = True
+
+        if devices == None:
+            devices = scancam_devices()
+
+        self.devices = {}
+        for each_device in devices:
+            self.devices[each_device.device_number] = each_device
+
+        self.framer = packet_framer(data_block_format)
+        self.struct = self.framer.struct
+
+        self.baudrate = baudrate
+        self.busy_probability = busy_probability
+        self.random = random.Random(seed)
+
+        # When the simulated wire is next free to carry a reply
+        self.line_free_at = 0.0
+
+        self.master, self.slave = os.openpty()
+        self.port = os.ttyname(self.slave)
+
+        # Writing to this pipe wakes the simulation out of select()
+        self.wakeup_r, self.wakeup_w = os.pipe()
+
+        self.running = Event()
+
+        # Counts of the packets received and sent
+        self.packets_received = 0
+        self.packets_sent = 0
+
+    def start(self):
+        self.running.set()
+        Thread.start(self)
+
+    def close(self):
+        '''virtual_chain.close()
+
+        Stop the simulation and close the pseudo-terminal.
+        '''
+        self.running.clear()
+        try:
+            os.write(self.wakeup_w, 'x')
+        except OSError:
+            pass
+
+        if self.isAlive():
+            self.join(1)
+
+        for fd in (self.master, self.slave, self.wakeup_r, self.wakeup_w):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def handle_packet(self, packet, now):
+        '''virtual_chain.handle_packet(packet, now)
+
+        Pass a received packet on to the devices it is for and return their
+        replies.
+        '''
+        device_number, command, data = packet
+
+        if device_number == 0:
+            devices = [self.devices[number] for number in sorted(self.devices)]
+        elif self.devices.has_key(device_number):
+            devices = [self.devices[device_number]]
+        else:
+            return []
+
+        replies = []
+        for each_device in devices:
+            if self.busy_probability and \
+                    command in (MOVE_ABSOLUTE, MOVE_RELATIVE, MOVE_TO_STORED_POSITION) and \
+                    self.random.random() < self.busy_probability:
+                replies.append((each_device.device_number, ERROR, BUSY))
+            else:
+                replies.extend(each_device.handle(command, data, now))
+
+        return replies
+
+    def send(self, replies):
+        if not replies:
+            return None
+
+        data = ''.join([apply(self.struct.pack, reply) for reply in replies])
+
+        if not self.baudrate == None:
+            # Wait for the wire to carry the replies ahead of these
+            now = time()
+            if self.line_free_at > now:
+                sleep(self.line_free_at - now)
+            self.line_free_at = max(now, self.line_free_at) + len(data)*10.0/self.baudrate
+
+        os.write(self.master, data)
+        self.packets_sent = self.packets_sent + len(replies)
+
+    def run(self):
+        while self.running.isSet():
+            completion_times = [each_device.completion_time() \
+                    for each_device in self.devices.values() \
+                    if not each_device.completion_time() == None]
+
+            if completion_times:
+                timeout = max(0, min(completion_times) - time())
+            else:
+                timeout = None
+
+            try:
+                readable = select.select([self.master, self.wakeup_r], [], [], timeout)[0]
+            except (select.error, ValueError):
+                return None
+
+            if self.wakeup_r in readable:
+                return None
+
+            replies = []
+            if self.master in readable:
+                try:
+                    new_data = os.read(self.master, 4096)
+                except OSError:
+                    return None
+
+                now = time()
+                for packet in self.framer.feed(new_data):
+                    self.packets_received = self.packets_received + 1
+                    replies.extend(self.handle_packet(packet, now))
+
+            now = time()
+            for number in sorted(self.devices):
+                each_device = self.devices[number]
+                if not each_device.completion_time() == None and \
+                        each_device.completion_time() <= now:
+                    replies.append(each_device.complete(now))
+
+            try:
+                self.send(replies)
+            except OSError:
+                return None
+
+def scancam_devices():
+    '''scancam_devices()
+
+    Return virtual devices standing in for the ScanCam stages: the x stage
+    (T-LSM200A) as device 1, the theta stage (T-RS60A) as device 2 and the z
+    stage (T-LSA10A) as device 3. The maximum ranges are the travel of each
+    stage in microsteps at a resolution of 64.
+    '''
+    return [virtual_device(1, device_id = 4012, maximum_range = 4199475),
+            virtual_device(2, device_id = 4302, maximum_range = 1536000),
+            virtual_device(3, device_id = 4002, maximum_range = 209974)]
+
+def round_trip_benchmark(iterations = 200, baudrate = 9600):
+    '''round_trip_benchmark(iterations = 200, baudrate = 9600)
+
+    Measure, against a virtual_chain, the time zaber_device takes to get a
+    setting back from a device and to make short moves on all three ScanCam
+    stages at once.
+    '''
+    from serial_connection import serial_connection
+    from zaber_device import zaber_device, discover_chain, wait_for_futures
+
+    chain = virtual_chain(baudrate = baudrate)
+    chain.start()
+
+    connection = serial_connection(chain.port)
+    devices = [zaber_device(connection, number, 'device_%d' % number, \
+            defer_settings = True) for number in (1, 2, 3)]
+    discover_chain(devices)
+
+    setting_times = []
+    for n in xrange(iterations):
+        start = time()
+        devices[0].get('target_speed', blocking = True)
+        setting_times.append(time() - start)
+
+    move_times = []
+    for n in xrange(iterations):
+        start = time()
+        futures = [each_device.send_command(MOVE_RELATIVE, 64*((-1)**n)) \
+                for each_device in devices]
+        wait_for_futures(futures, timeout = 5)
+        move_times.append(time() - start)
+
+    connection.close()
+    chain.close()
+
+    setting_times.sort()
+    move_times.sort()
+    print 'Round trips to a virtual chain at %s baud:' % str(baudrate)
+    print '    setting:          median %.3f ms, max %.3f ms' \
+            % (1000*setting_times[len(setting_times)/2], 1000*setting_times[-1])
+    print '    move x3 (1 step): median %.3f ms, max %.3f ms (%.1f moves/s)' \
+            % (1000*move_times[len(move_times)/2], 1000*move_times[-1], \
+               3*len(move_times)/sum(move_times))
+
+    return setting_times, move_times
+
+def serve(argv):
+    '''Run a virtual chain of the ScanCam stages until interrupted, so that
+    programs such as bin/scancam can be pointed at it.
+    '''
+    chain = virtual_chain()
+    chain.start()
+    print 'Virtual Zaber chain on %s' % chain.port
+
+    try:
+        while chain.isAlive():
+            sleep(1)
+    except KeyboardInterrupt:
+        pass
+
+    chain.close()
+
+if __name__ == "__main__":
+    import sys
+    if sys.argv[1:2] == ['benchmark']:
+        round_trip_benchmark()
+    else:
+        serve(sys.argv)
@@ -0,0 +1,211 @@
+import struct
+from time import time, sleep
+from threading import Lock
+from warnings import warn
+
+SENT, RECEIVED = (0, 1)
+
+# Every capture file starts with this
+CAPTURE_HEADER = 'ZCAP\x01'
+
+# timestamp, direction, device, command, data
+record_format = struct.Struct('<dBBBi')
+
+def monotonic_clock():
+    '''monotonic_clock()
+
+    Return a function giving the time in seconds from a clock that never goes
+    backwards (CLOCK_MONOTONIC), for timestamping captured packets. Falls back
+    to time.time if the clock can't be reached.
+    '''
+    try:
+        import ctypes
+        import ctypes.util
+
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1')
+        clock_gettime = librt.clock_gettime
+
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        CLOCK_MONOTONIC = 1
+
+        def monotonic():
+            now = timespec()
+            if not clock_gettime(CLOCK_MONOTONIC, ctypes.byref(now)) == 0:
+                raise OSError('clock_gettime failed')
+            return now.tv_sec + now.tv_nsec*1e-9
+
+        monotonic()
+        return monotonic
+
+    except (OSError, AttributeError):
+        warn('No monotonic clock available. Using the time of day to timestamp packets.')
+        return time
+
+monotonic = monotonic_clock()
+
+class traffic_capture():
+    '''traffic_capture(path)
+
+    Log of the packets sent and received on a serial connection, written to the
+    binary file at path. Each record is a record_format struct holding a
+    monotonic timestamp, the direction (SENT or RECEIVED) and the device, command
+    and data of the packet.
+
+    See serial_connection.start_capture() and read_capture().
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.file.write(CAPTURE_HEADER)
+
+        self.lock = Lock()
+
+    def record_packets(self, direction, packets, timestamp = None):
+        '''traffic_capture.record_packets(direction, packets, timestamp = None)
+
+        Record the list of (device, command, data) packets as all sent or received
+        at timestamp, a monotonic() time. If no timestamp is given they are
+        recorded as happening now.
+        '''
+        if timestamp == None:
+            timestamp = monotonic()
+        pack = record_format.pack
+        records = ''.join([pack(timestamp, direction, packet[0], packet[1], packet[2]) \
+                for packet in packets])
+
+        self.lock.acquire()
+        try:
+            if not self.file == None:
+                self.file.write(records)
+        finally:
+            self.lock.release()
+
+    def close(self):
+        '''traffic_capture.close()
+        '''
+        self.lock.acquire()
+        try:
+            if not self.file == None:
+                self.file.close()
+                self.file = None
+        finally:
+            self.lock.release()
+
+def read_capture(path):
+    '''read_capture(path)
+
+    Return a list of the records in the capture file at path as (timestamp,
+    direction, device, command, data) tuples, in time order. The reader and
+    writer threads record separately, so the file itself may be slightly out of
+    order. A partly written last record is ignored.
+    '''
+    capture_file = open(path, 'rb')
+    try:
+        if not capture_file.read(len(CAPTURE_HEADER)) == CAPTURE_HEADER:
+            raise IOError('%s is not a serial traffic capture' % path)
+        data = capture_file.read()
+    finally:
+        capture_file.close()
+
+    size = record_format.size
+    unpack_from = record_format.unpack_from
+
+    records = [unpack_from(data, offset) \
+            for offset in xrange(0, len(data) - len(data) % size, size)]
+    records.sort(key = lambda record: record[0])
+
+    return records
+
+def replay(connection, path, speed = 1.0):
+    '''replay(connection, path, speed = 1.0)
+
+    Feed the packets received in the capture at path to the queue handler of
+    connection, as if they had just arrived from the serial port. Handlers
+    registered with the connection see them exactly as they saw them live.
+
+    The packets are fed with the gaps between them as recorded, divided by
+    speed. If speed is None, they are fed as fast as possible.
+
+    connection would normally be made with no port (serial_connection(None)),
+    so that nothing the handlers send goes anywhere. If the queue handler isn't
+    running in another thread, the packets are handled in this thread as they
+    are fed.
+
+    Returns the number of packets fed.
+    '''
+    records = [record for record in read_capture(path) if record[1] == RECEIVED]
+
+    if not records:
+        return 0
+
+    handle_here = not connection.handled_elsewhere()
+
+    first_timestamp = records[0][0]
+    start = time()
+
+    for timestamp, direction, device, command, data in records:
+        if not speed == None:
+            delay = start + (timestamp - first_timestamp)/speed - time()
+            if delay > 0:
+                sleep(delay)
+
+        connection.packet_q.put((device, command, data))
+
+        if handle_here:
+            connection.queue_handler(1)
+
+    return len(records)
+
+def dispatch_benchmark(path):
+    '''dispatch_benchmark(path)
+
+    Replay the capture at path as fast as possible to a zaber_device for each
+    device seen in it and report how quickly the packets are handled.
+    '''
+    from serial_connection import serial_connection
+    from zaber_device import zaber_device
+
+    device_numbers = set([record[2] for record in read_capture(path)]) - set([0])
+
+    connection = serial_connection(None)
+    for number in sorted(device_numbers):
+        zaber_device(connection, number, 'device_%d' % number, defer_settings = True)
+
+    start = time()
+    packets = replay(connection, path, speed = None)
+    elapsed = time() - start
+
+    connection.close()
+
+    print 'Replayed %d received packets for %d devices in %.3f s (%.1f us per packet)' \
+            % (packets, len(device_numbers), elapsed, 1e6*elapsed/max(packets, 1))
+
+    return elapsed
+
+def print_capture(path):
+    '''print_capture(path)
+
+    Print the records in the capture at path, with times relative to the first.
+    '''
+    records = read_capture(path)
+    if not records:
+        return None
+
+    first_timestamp = records[0][0]
+    for timestamp, direction, device, command, data in records:
+        if direction == SENT:
+            direction_name = 'sent'
+        else:
+            direction_name = 'received'
+
+        print '%10.6f  %-8s  %3i  %3i  %i' \
+                % (timestamp - first_timestamp, direction_name, device, command, data)
+
+if __name__ == "__main__":
+    import sys
+    if sys.argv[1:2] == ['benchmark']:
+        dispatch_benchmark(sys.argv[2])
+    else:
+        print_capture(sys.argv[1])
@@ -1,11 +1,18 @@
 from warnings import warn
 from serial_connection import *
+from kinematics import move_model
+from settings_cache import volatile_settings
 from Queue import Queue
-from time import sleep
+from collections import deque
+from threading import Condition, Lock
+from time import sleep, time
 import signal
 
 CONTINUOUS, STEP = (0,1)
 
+# The kinds of command, as looked up by command number in command_kinds
+BASE_COMMAND, STOP_COMMAND, MOVE_COMMAND, SETTING_COMMAND = (0,1,2,3)
+
 
 
 
@@ -68,6 +75,32 @@ extra_error_codes = {
 
 meta_commands = {}
 
+# Replies whose data is the current position of the device in microsteps
+position_replies = set([
+        base_commands['home'],
+        base_commands['return_current_position'],
+        move_commands['stored_position'],
+        move_commands['absolute'],
+        move_commands['relative'],
+        stop_commands['stop'],
+        setting_commands['current_position'],
+        ])
+
+class command_record(object):
+    '''command_record(command, data, pause_after)
+
+    A command waiting on a device's command queue, along with the time it was
+    queued. The class is kept to fixed slots (hence it derives from object) as
+    meta commands with repeats can queue a great many of them.
+    '''
+    __slots__ = ('command', 'data', 'pause_after', 'queued_at')
+
+    def __init__(self, command, data, pause_after):
+        self.command = command
+        self.data = data
+        self.pause_after = pause_after
+        self.queued_at = time()
+
 class device_base():
     ''' device_base(connection, id, run_mode = CONTINUOUS, verbose = False)
 
@@ -117,6 +150,9 @@ class device_base():
         self.meta_command_pause_after = False
         self.pause_after = True
 
+        # Meta commands compiled by compile_meta_command(), by name
+        self.compiled_meta_commands = {}
+
         # Register with the connection
         self.connection.register(self.packet_handler, id)
         
@@ -131,6 +167,10 @@ class device_base():
 
         self.pending_responses = 0
 
+        # Notified whenever the device drops out of the action state so that
+        # waiting threads wake as soon as the last response arrives
+        self.action_condition = Condition()
+
         self.verbose = verbose
 
         # Create data structures to store the response lookups
@@ -225,7 +265,8 @@ class device_base():
             self.awaiting_action = True
         elif not self.in_action():
             # We should send the command now
-            apply(self.do_now, self.command_queue.pop(0))
+            record = self.command_queue.popleft()
+            self.do_now(record.command, record.data, record.pause_after)
         elif self.run_mode == CONTINUOUS:
             # This is the state when we are in_action() but 
             # the queue handler should make things
@@ -259,14 +300,42 @@ class device_base():
                 print 'pause'
 
 
+        self.enqueue_code(command_dictionary[command], data, pause_after)
+
+        return None
+
+    def enqueue_code(self, code, data = 0, pause_after = True):
+        '''device_base.enqueue_code(code, data = 0, pause_after = True)
+
+        As enqueue(), but with the command number rather than the name of the 
+        command, and without regard to any meta command being run.
+        '''
         if not self.in_action() and len(self.command_queue) == 0 and not self.responses_pending()\
             and not self.run_mode == STEP:
             # Execute immediately
-            apply(self.do_now, (command_dictionary[command], data, pause_after))
+            self.do_now(code, data, pause_after)
         else:
-            self.command_queue.append((command_dictionary[command], data, pause_after))
+            self.command_queue.append(command_record(code, data, pause_after))
 
         return None
+
+    def queue_depth(self):
+        '''device_base.queue_depth()
+
+        Return the number of commands waiting on the command queue.
+        '''
+        return len(self.command_queue)
+
+    def oldest_command_age(self):
+        '''device_base.oldest_command_age()
+
+        Return how many seconds the command at the front of the command queue
+        has been waiting, or None if the queue is empty.
+        '''
+        if not self.command_queue:
+            return None
+
+        return time() - self.command_queue[0].queued_at
     
     def enqueue_base_command(self, command, argument):
         '''device_base.base_command(command, argument)
@@ -376,77 +445,155 @@ class device_base():
         '''device_base.on_busy_error()
 
         This function resends the last command until it goes through.
+        Returns whatever do_now() returns for the resent command.
         '''
         print 'error   : Busy error received, resending the last command'
         
-        self.do_now(self.last_packet_sent[1], self.last_packet_sent[2])
+        return self.do_now(self.last_packet_sent[1], self.last_packet_sent[2])
 
 
     def meta(self, name, meta_command):
-        '''device_base.meta(meta_command)
-
-        Execute the supplied meta command. At this stage it is
-        expanded out and the relevant functions are called to handle it.
+        '''device_base.meta(name, meta_command)
 
-        meta commands that are part of the meta_command recursively
-        call this function.
+        Execute the supplied meta command. It is compiled into a flat list of
+        commands the first time it is run (see compile_meta_command()), and
+        after that each run just enqueues the commands in the list.
         '''
         
+        plan = self.compiled_meta_commands.get(name)
+        if plan == None or not plan[0] == self.unit_scale():
+            plan = self.compile_meta_command(name, meta_command)
+        
         if self.verbose:
             for n in range(0,self.meta_command_depth):
                 print '\t',
-            print 'metacommand: %s' % (name)
+            print 'metacommand: %s (%i commands)' % (name, len(plan[1]))
 
-        self.meta_command_depth = self.meta_command_depth + 1
+        enqueue_code = self.enqueue_code
+        for code, data, pause_after in plan[1]:
+            enqueue_code(code, data, pause_after)
+        
+        return None
 
-        last_command = None
+    def compile_meta_command(self, name, meta_command):
+        '''device_base.compile_meta_command(name, meta_command)
+
+        Expand the meta command out into a flat list of (command number, data,
+        pause_after) tuples, with the data already in microsteps and any nested
+        meta commands and repeats unrolled. The list is cached under name along
+        with the unit_scale() it was compiled for, so it is compiled again if 
+        the scale changes (such as when the microstep resolution is read back).
+
+        Returns the cached (unit_scale, commands) pair.
+
+        A pause after a nested meta command applies to the last command it
+        expands to. Raises LookupError if the meta command contains itself.
+        '''
+        commands = []
+        self.expand_meta_command(meta_command, commands, [name])
         
-        for idx in range(0,len(meta_command)):
+        plan = (self.unit_scale(), commands)
+        self.compiled_meta_commands[name] = plan
+
+        return plan
+
+    def expand_meta_command(self, meta_command, commands, expanding):
+        '''device_base.expand_meta_command(meta_command, commands, expanding)
+
+        Append the commands that meta_command expands to onto the list commands.
+        expanding is the list of the names of the meta commands being expanded, 
+        used to catch a meta command that contains itself.
+        '''
+        # The slice of commands that the last command expanded to, and whether
+        # it was a meta command
+        last_command = None
+        last_was_meta = False
+
+        for idx in xrange(0,len(meta_command)):
             each_command = meta_command[idx]
+            command_name = each_command[0]
             
             if idx+1 < len(meta_command) and meta_command[idx+1][0] == 'pause':
                 next_command_pause = True
             else:
                 next_command_pause = False
 
-            if each_command[0] == 'pause':
+            if command_name == 'pause':
                 # We considered pause on the last loop
                 continue
 
-            elif self.base_commands.has_key(each_command[0]) or \
-                   self.move_commands.has_key(each_command[0][5:]) or \
-                   self.meta_commands.has_key(each_command[0]) or \
-                   self.user_meta_commands.has_key(each_command[0]):
+            elif command_name == 'repeat':
+                # Special case of repeat
+                if last_command == None:
+                    continue
+                
+                if len(each_command) == 1:
+                    # ie, no argument sent
+                    iterations = 1
+                else:
+                    iterations = each_command[1] - 1
+                
+                repeated = commands[last_command[0]:last_command[1]]
+                if not last_was_meta:
+                    # A single command only pauses after its last repeat
+                    repeated = [(code, data, False) for code, data, pause_after in repeated]
 
-                if next_command_pause:
-                    self.meta_command_pause_after = True
+                for n in xrange(iterations):
+                    commands.extend(repeated)
+                
+                if iterations > 0 and next_command_pause:
+                    code, data, pause_after = commands[-1]
+                    commands[-1] = (code, data, True)
+
+            elif self.meta_commands.has_key(command_name) or \
+                    self.user_meta_commands.has_key(command_name):
+                if command_name in expanding:
+                    raise LookupError, 'Meta command %s contains itself' % command_name
+
+                if self.meta_commands.has_key(command_name):
+                    nested_command = self.meta_commands[command_name]
                 else:
-                    self.meta_command_pause_after = False
+                    nested_command = self.user_meta_commands[command_name]
+
+                start = len(commands)
+                self.expand_meta_command(nested_command, commands, \
+                        expanding + [command_name])
                 
-                apply(getattr(self,each_command[0]), each_command[1:])
-                last_command = each_command
-            elif each_command[0] == 'repeat':
-                # Special case of repeat
+                if next_command_pause and len(commands) > start:
+                    code, data, pause_after = commands[-1]
+                    commands[-1] = (code, data, True)
+                
+                last_command = (start, len(commands))
+                last_was_meta = True
 
-                if not last_command == None:
-                    n = 0
-                    if len(each_command) == 1:
-                        # ie, no argument sent
-                        iterations = 1
-                    else:
-                        iterations = each_command[1] - 1
-                    
-                    while n < iterations:
-                        if n == iterations - 1 and next_command_pause == True:
-                            self.meta_command_pause_after = True
+            else:
+                code, data = apply(self.compile_command, each_command)
+                commands.append((code, data, next_command_pause))
+                
+                last_command = (len(commands) - 1, len(commands))
+                last_was_meta = False
 
-                        apply(getattr(self,last_command[0]), last_command[1:])
-                        n = n+1
-        
-        self.meta_command_pause_after = False
-        self.meta_command_depth = self.meta_command_depth - 1
         return None
-                
+
+    def compile_command(self, command, argument = 0):
+        '''device_base.compile_command(command, argument = 0)
+
+        Return the (command number, data) to send for the base command or 
+        move_SOMETHING command named by command. Moves are converted from
+        the move units into microsteps.
+
+        Place holder function that should be overwritten in child classes.
+        '''
+        raise LookupError, 'Command %s can not be compiled' % command
+
+    def unit_scale(self):
+        '''device_base.unit_scale()
+
+        Return something that changes whenever compile_command() would convert
+        a move differently. Compiled meta commands are only reused while it
+        stays the same.
+        '''
+        return None
 
     def new_meta_command(self, name, command_list):
         ''' device_base.new_meta_command(name, command_list)
@@ -479,6 +626,12 @@ class device_base():
                 return None
 
         self.user_meta_commands[name] = command_list
+
+        # Any meta command could include this one, so they all have to be 
+        # compiled again
+        self.compiled_meta_commands.clear()
+        self.compile_meta_command(name, command_list)
+        
         return None
 
     def do_now(self, command, data = None, pause_after = True, 
@@ -521,6 +674,19 @@ class device_base():
         '''
         return self.pending_responses > 0
 
+    def notify_action_complete(self):
+        '''device_base.notify_action_complete()
+
+        Wake any threads waiting in wait_for_action_to_complete() so that they
+        can check the action state again. Should be called whenever the device
+        leaves the action state.
+        '''
+        self.action_condition.acquire()
+        try:
+            self.action_condition.notifyAll()
+        finally:
+            self.action_condition.release()
+
     def handle_device_packet(self, source, command, data):
         '''device_base.handle_device_packets(source, command, data)
 
@@ -596,33 +762,240 @@ class device_base():
 
 
 
-    def wait_for_action_to_complete(self, timeout_secs):
-        '''wait_for_actions_to_complete(devices, timeout_secs)
+    def wait_for_action_to_complete(self, timeout_secs, deadline = None, expected = None):
+        '''wait_for_action_to_complete(timeout_secs, deadline = None, expected = None)
+
+        Block until self.in_action() returns false. The device's action 
+        condition is notified as soon as the device leaves the action state
+        so there is no polling delay.
 
-        Wake up once a second to see if current action has completed
+        deadline is an optional absolute time (as returned by time.time()) at
+        which to give up. It takes precedence over timeout_secs and allows
+        several devices to share a single deadline.
 
-        Raises self.DeviceTimeoutError exception after waiting for timeout_secs
-        seconds without self.in_action() returning false.
+        Raises DeviceTimeoutError exception after waiting for timeout_secs
+        seconds (or until the deadline) without self.in_action() returning false.
+        The error carries the seconds waited and expected, the number of seconds
+        the action was expected to take (if known).
         '''
-            
-        counter = 0
-        while (1):
-            sleep(1)
-            counter += 1
+        start_time = time()
+        if deadline == None:
+            deadline = start_time + timeout_secs
+
+        self.action_condition.acquire()
+        try:
+            while self.in_action():
+                remaining = deadline - time()
+                if remaining <= 0:
+                    if self.verbose: 
+                        print self.id, "timeout after %.1f secs. Raising exception" \
+                                % (time() - start_time)
+                    raise DeviceTimeoutError( self.id, expected, time() - start_time )
+
+                self.action_condition.wait(remaining)
+        finally:
+            self.action_condition.release()
+
+        return None
 
-            if not self.in_action():
-                break
 
-            if counter >= timeout_secs:
-                    if self.verbose: print self.id, "timeout after %d secs. Raising exception" % counter
-                    raise self.DeviceTimeoutError( self.id )
+def wait_for_devices_to_complete_actions(devices, timeout_secs, expected = None):
+    '''wait_for_devices_to_complete_actions(devices, timeout_secs, expected = None)
+
+    Wait until none of the devices are in action, sharing a single deadline
+    of timeout_secs from now between all of them. Waiting on one device
+    does not eat into the time allowed for the others beyond the deadline, 
+    and a device that has already finished is passed over immediately.
+
+    Raises DeviceTimeoutError for the first device still in action at the
+    deadline. expected is the number of seconds the actions were expected to
+    take, if known, which is passed on in the error.
+    '''
+    deadline = time() + timeout_secs
+
+    for device in devices:
+        device.wait_for_action_to_complete(timeout_secs, deadline = deadline, \
+                expected = expected)
+
+    return None
 
 
 class DeviceTimeoutError(Exception):
-    def __init__(self, device_id):
+    def __init__(self, device_id, expected = None, elapsed = None):
+        self.device_id = device_id
+        self.expected = expected
+        self.elapsed = elapsed
+    def __str__(self):
+        if self.elapsed == None:
+            return repr(self.device_id)
+        if self.expected == None:
+            return '%s timed out after %.1f s' % (repr(self.device_id), self.elapsed)
+        return '%s timed out after %.1f s, expected %.1f s' \
+                % (repr(self.device_id), self.elapsed, self.expected)
+
+class DeviceBusyError(Exception):
+    def __init__(self, device_id, command):
+        self.device_id = device_id
+        self.command = command
+    def __str__(self):
+        return '%s busy, command %i' % (repr(self.device_id), self.command)
+
+class DeviceCommandError(Exception):
+    def __init__(self, device_id, command, error_code):
         self.device_id = device_id
+        self.command = command
+        self.error_code = error_code
     def __str__(self):
-        return repr(self.device_id)
+        return '%s error %i, command %i' \
+                % (repr(self.device_id), self.error_code, self.command)
+
+
+class command_future():
+    '''command_future(device, command, data, reply_command, counted)
+
+    The reply to a command sent to a Zaber device, which arrives at some later
+    time. These are returned by zaber_device.send_command() and do_now().
+
+    command and data are what was sent. reply_command is the command that the
+    reply will carry. For most commands this is the command itself, but
+    return_setting is answered with the command of the setting asked for.
+
+    counted says whether the command was counted in the device's
+    pending_responses.
+
+    The future is resolved by zaber_device.handle_device_packet() with the data
+    of the reply, or with a DeviceBusyError or DeviceCommandError. The device
+    only replies once when motion ends, so a move or home that is superseded by
+    a later move or stop resolves with the reply that ends the motion.
+    '''
+    def __init__(self, device, command, data, reply_command, counted):
+        self.device = device
+        self.command = command
+        self.data = data
+        self.reply_command = reply_command
+        self.counted = counted
+
+        self.finished = False
+        self.reply = None
+        self.error = None
+        self.callbacks = []
+
+    def done(self):
+        '''command_future.done()
+
+        Return whether the reply (or an error) has arrived.
+        '''
+        return self.finished
+
+    def set_result(self, reply):
+        '''command_future.set_result(reply)
+        '''
+        self.reply = reply
+        self.finish()
+
+        return None
+
+    def set_exception(self, error):
+        '''command_future.set_exception(error)
+        '''
+        self.error = error
+        self.finish()
+
+        return None
+
+    def finish(self):
+        self.finished = True
+        for callback in self.callbacks:
+            callback(self)
+
+        return None
+
+    def add_done_callback(self, callback):
+        '''command_future.add_done_callback(callback)
+
+        Call callback(future) once the future is resolved. The callback is
+        called from the thread handling the device packets, or straight away if
+        the future is already resolved.
+        '''
+        if self.finished:
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+
+        return None
+
+    def copy_outcome(self, other):
+        '''command_future.copy_outcome(other)
+
+        Resolve this future in the same way as the future other. Used as a
+        done callback to chain a resent command to the original.
+        '''
+        if other.error == None:
+            self.set_result(other.reply)
+        else:
+            self.set_exception(other.error)
+
+        return None
+
+    def wait(self, timeout = None):
+        '''command_future.wait(timeout = None)
+
+        Wait for the future to be resolved, for up to timeout seconds (or
+        forever if timeout is None). Returns whether it was resolved.
+
+        If no other thread is handling the connection, the packets are handled
+        in this thread while waiting.
+        '''
+        return self.device.connection.wait_until(self.done, timeout)
+
+    def result(self, timeout = None):
+        '''command_future.result(timeout = None)
+
+        Wait for the future and return the data of the reply. Raises the error
+        the future was resolved with, or DeviceTimeoutError if it wasn't
+        resolved within timeout seconds.
+        '''
+        if not self.wait(timeout):
+            raise DeviceTimeoutError(self.device.id)
+
+        if not self.error == None:
+            raise self.error
+
+        return self.reply
+
+    def exception(self, timeout = None):
+        '''command_future.exception(timeout = None)
+
+        Wait for the future and return the error it was resolved with, or None
+        if it was resolved with a reply.
+        '''
+        if not self.wait(timeout):
+            raise DeviceTimeoutError(self.device.id)
+
+        return self.error
+
+def wait_for_futures(futures, timeout = None):
+    '''wait_for_futures(futures, timeout = None)
+
+    Wait for all of the command futures in futures and return a list of their
+    replies, in the same order. The futures can be for any devices, and they all
+    share the one timeout.
+
+    Raises the error of the first future (in order) that was resolved with one, or
+    DeviceTimeoutError for the first future not resolved by the deadline.
+    '''
+    if timeout == None:
+        deadline = None
+    else:
+        deadline = time() + timeout
+
+    for future in futures:
+        if deadline == None:
+            future.wait()
+        else:
+            future.wait(max(0, deadline - time()))
+
+    return [future.result(0) for future in futures]
 
 
 
@@ -634,6 +1007,8 @@ class zaber_device(device_base):
                      move_units = 'microsteps',
                      run_mode = CONTINUOUS,
                      action_handler = None,
+                     settings_cache = None,
+                     defer_settings = False,
                      verbose = False)
     
     Class to handle the general Zaber devices. The class talks to the device
@@ -656,6 +1031,13 @@ class zaber_device(device_base):
 
     action_handler: This is the function that is called when the device is ready for its
         next action. 
+
+    settings_cache: An optional instance of settings_cache. If given, the device settings
+        are taken from the cache when it holds an entry that still matches the device,
+        rather than being read one by one. See load_settings().
+
+    defer_settings: If True, the settings are not loaded during initialisation. They
+        should be loaded later with load_settings() or discover_chain().
  
     verbose: A boolean flag to define the verbosity of the output.
     '''
@@ -668,6 +1050,8 @@ class zaber_device(device_base):
                  move_units = 'microsteps',
                  run_mode = CONTINUOUS,
                  action_handler = None,
+                 settings_cache = None,
+                 defer_settings = False,
                  verbose = False):
         
         # These have to be initialised immediately to prevent a potential infinite
@@ -710,12 +1094,37 @@ class zaber_device(device_base):
 
         self.setting_commands = setting_commands
 
-        self.command_queue = []
+        self.command_queue = deque()
         
         self.last_command = None
         self.error_list = []
         self.blocking_retries = 3
 
+        # Seconds a blocking call waits for a reply before giving up
+        self.blocking_timeout = 100.0
+
+        # Futures for the commands sent that haven't been replied to yet, oldest first.
+        # Commands are sent from the calling thread and replies are handled in the
+        # connection's thread, so the futures and pending_responses are only
+        # changed while holding futures_lock. Futures are resolved outside it, as
+        # their callbacks may send commands.
+        self.outstanding_futures = deque()
+        self.futures_lock = Lock()
+
+        # The commands that end with a single reply once the motion stops
+        self.motion_commands = set(self.move_commands.values() + \
+                self.stop_commands.values() + [self.base_commands['home']])
+
+        # The last position the device reported, in microsteps and in move
+        # units, and the time() it arrived. moving is set from when a motion 
+        # is sent until its reply brings the final position. See 
+        # cached_position().
+        self.position_replies = position_replies
+        self.position = None
+        self.position_in_units = None
+        self.position_time = None
+        self.moving = False
+
         # Fill the data structures to store the response lookups
         for each_setting in self.setting_commands:
             self.settings_lookup[self.setting_commands[each_setting]] = each_setting
@@ -736,10 +1145,113 @@ class zaber_device(device_base):
         # Define a safe initialisation value of the usteps/unit
         self.microsteps_per_unit = 0
 
+        # The device ID as reported by the device in reply to return_device_id
+        self.reported_device_id = None
+
         # Initialisation has occurred when we have all the settings returned
         # from the device
         self.settings = {}
-        self.get_all_settings(blocking = True)
+        self.settings_cache = settings_cache
+
+        # Settings sent to the device that it hasn't confirmed yet, so that 
+        # kinematic_model() uses them straight away
+        self.requested_settings = {}
+        if not defer_settings:
+            self.load_settings()
+
+    def load_settings(self):
+        '''zaber_device.load_settings()
+
+        Fill self.settings with the settings of the device.
+
+        Without a settings cache, every setting is read from the device in turn.
+
+        With a settings cache holding an entry for this device, only the device ID,
+        the microstep resolution and any settings missing from the entry are read.
+        The queries are sent back to back so that this costs a single round trip.
+        If the device ID and microstep resolution match the entry, the remaining
+        settings are taken from it. Otherwise the entry is discarded, every setting 
+        is read and the cache is updated.
+
+        This is discover_chain() for a chain of one. See discover_chain() to load
+        the settings of several devices at once.
+        '''
+        discover_chain([self])
+
+        return None
+
+    def cached_settings(self):
+        '''zaber_device.cached_settings()
+
+        Return the settings cache entry for this device, or None if there is no
+        settings cache or it has no entry for this device.
+        '''
+        if self.settings_cache == None:
+            return None
+
+        return self.settings_cache.lookup(self.connection.get_port(), self.device_number)
+
+    def settings_queries(self, cached = None):
+        '''zaber_device.settings_queries(cached = None)
+
+        Return the list of (command, data) queries needed to load the settings.
+
+        With no cached entry, this asks for every setting (and the device ID when 
+        there is a settings cache to store it in). With a cached entry, only the
+        device ID, the microstep resolution and the settings missing from the entry
+        are asked for, which is enough for use_cached_settings() to check the entry.
+        '''
+        queries = []
+
+        if not cached == None or not self.settings_cache == None:
+            queries.append((self.base_commands['return_device_id'], 0))
+
+        for each_setting in self.setting_commands:
+            if cached == None or each_setting == 'microstep_resolution' or \
+                    not cached['settings'].has_key(each_setting):
+                queries.append((self.base_commands['return_setting'], \
+                        self.setting_commands[each_setting]))
+
+        return queries
+
+    def use_cached_settings(self, cached):
+        '''zaber_device.use_cached_settings(cached)
+
+        Check the cached entry against the device ID and microstep resolution 
+        returned by the device and, if they match, take the rest of the settings 
+        from it. Returns whether the entry was used.
+        '''
+        if not self.reported_device_id == cached['device_id'] or \
+                not self.settings.get('microstep_resolution') == \
+                cached['settings'].get('microstep_resolution'):
+            
+            if self.verbose:
+                print 'settings:  %s, cached settings do not match the device' % self.id
+            
+            return False
+                
+        for each_setting in cached['settings']:
+            if not self.settings.has_key(each_setting):
+                self.settings[each_setting] = cached['settings'][each_setting]
+        
+        self.initialised = len(self.settings) == len(self.settings_lookup)
+        
+        if self.verbose:
+            print 'settings:  %s, loaded from cache' % self.id
+
+        return True
+
+    def store_settings(self):
+        '''zaber_device.store_settings()
+
+        Store the settings read from the device in the settings cache, if there
+        is one.
+        '''
+        if not self.settings_cache == None:
+            self.settings_cache.store(self.connection.get_port(), self.device_number, \
+                    self.reported_device_id, self.settings)
+
+        return None
 
     def get(self, setting, blocking = False):
         ''' zaber_device.get(setting, blocking = False)
@@ -752,36 +1264,32 @@ class zaber_device(device_base):
         As with all device commands, this is returned asynchronously and so the return
         case should be handled properly by the device packet handler.
 
+        Unless blocking, a command_future for the reply is returned, which
+        resolves with the setting (see zaber_device.send_command()).
+
         It is possible to call this function with the blocking argument set to
-        true. In this case, responses will be popped off the queue one by one
-        (and dealt with appropriately) until the setting response arrives back,
-        at which point normal execution will resume. In this case, the function will
-        return the setting.
+        true. In this case the function waits for the reply, asking again up to
+        self.blocking_retries times if the device returns an error or doesn't
+        reply within self.blocking_timeout seconds, and returns the setting (or
+        None if every attempt failed).
 
         Any calls to self.get_SOMETHING end up here with the setting string
         SOMETHING.
         '''
         
-        if blocking:
-            # Firstly we need to know how many errors are already on the
-            # error list
-            preexisting_errors = self.error_list.count(setting)
-        
-        attempt = 1
-        while (not blocking and attempt == 1) or \
-                (blocking and attempt < self.blocking_retries):
-            # If we are blocking, keep trying until we don't
-            # receive an error up to self.blocking_retries times
-            self.do_now(self.base_commands['return_setting'],\
-                    self.setting_commands[setting], blocking = blocking,\
-                    release_command = setting)
-
-            # See if we have received a satisfactory response and leave when we do            
-            if self.error_list.count(setting) == preexisting_errors:
+        for attempt in range(self.blocking_retries):
+            future = self.do_now(self.base_commands['return_setting'],\
+                    self.setting_commands[setting])
+
+            if not blocking:
+                return future
+
+            # Keep trying until we don't receive an error
+            try:
+                future.result(self.blocking_timeout)
                 return self.settings[setting]
-            else:
-                self.error_list.remove(command)
-                attempt = attempt + 1
+            except (DeviceBusyError, DeviceCommandError, DeviceTimeoutError):
+                self.error_list.append(setting)
 
         return None
 
@@ -795,8 +1303,15 @@ class zaber_device(device_base):
         
         Any calls to self.set_SOMETHING end up here with the setting string
         SOMETHING.
+
+        Changing a setting drops it from the settings cache entry for this device
+        (if there is one) so that it is read from the device next time.
         '''
+        if not self.settings_cache == None:
+            self.settings_cache.forget(self.connection.get_port(), \
+                    self.device_number, setting)
 
+        self.requested_settings[setting] = value
         self.do_now(self.setting_commands[setting], value)
         return None
 
@@ -835,6 +1350,30 @@ class zaber_device(device_base):
             
         return None
     
+    def compile_command(self, command, argument = 0):
+        '''zaber_device.compile_command(command, argument = 0)
+
+        Return the (command number, data) to send for the base command or 
+        move_SOMETHING command named by command. Moves are converted from
+        the move units into microsteps, as move() does.
+        '''
+        if self.base_commands.has_key(command):
+            return (self.base_commands[command], argument)
+
+        move_command = command[5:]
+        if move_command == 'stored_position':
+            return (self.move_commands[move_command], argument)
+        
+        return (self.move_commands[move_command], \
+                int(float(argument) * self.microsteps_per_unit))
+
+    def unit_scale(self):
+        '''zaber_device.unit_scale()
+
+        Return the microsteps per move unit that moves are converted with.
+        '''
+        return self.microsteps_per_unit
+
     def do_now(self, command, data = None, pause_after = True, 
             blocking = False, release_command = None):
         '''zaber_device.do_now(command, data = None, pause_after = True,
@@ -852,90 +1391,173 @@ class zaber_device(device_base):
         CONTINUOUS mode is equivalent to pause_after always equal to false. By
         default, every command will cause a pause.
 
+        Returns a command_future that resolves with the reply to the command.
+
         If the blocking flag is set to True, then this function will not
-        return until release_command gets put on the queue
-        or we run out of pending responses (probably implying an error occurred).
+        return until the reply (or an error) has arrived for the command, and
+        raises DeviceTimeoutError if it hasn't within self.blocking_timeout
+        seconds.
 
-        If release_command is not passed or is None, then then command is used
-        as the release command (ie an echo is expected)
+        release_command is no longer used, since replies are matched to the
+        command that was sent. It is still accepted so older callers work.
         '''
         if data == None:
             data = 0
 
-        if release_command == None:
-            release_command = command
-
         self.pause_after = pause_after
 
         command_tuple = (self.device_number, command, data)
 
-        apply(self.connection.send_command, command_tuple)
+        # Whether the command adds to the responses we are waiting for
+        counted = True
+
+        kind = self.command_kinds.get(command)
 
-        #
-        if self.stop_lookup.has_key(command):
+        if kind == STOP_COMMAND:
             self.action_state = False
-            # If we are already in a move, the stop response "replaces" the move response
-            if not self.in_action():
-                self.pending_responses = self.pending_responses + 1
+            self.notify_action_complete()
+            # If we are already in a move, the stop response "replaces" the move
+            # response, and resolves the futures for both.
             if self.verbose:
                 print "send:      %s, do %s (%i): %i" \
                             %(self.id, self.stop_lookup[command], command, data)
         
-        elif self.in_action() and self.move_lookup.has_key(command):
+        elif kind == MOVE_COMMAND and self.in_action():
             # This means the current command will preempt a previously sent command,
-            # so we shouldn't do anything.
+            # so only one response comes back for the two of them.
+            counted = False
             if self.verbose:
                 print "send:      %s, move %s (%i): %i" \
                             %(self.id, self.move_lookup[command], command, data)
 
-        elif self.command_lookup.has_key(command):
+        elif kind == BASE_COMMAND:
             # if its not a base command, we trigger the action state
             self.action_state = True
-            self.pending_responses = self.pending_responses + 1
-            self.last_action_sent = self.command_lookup.has_key(command)
+            self.last_action_sent = True
             if self.verbose:
                 print "send:      %s, command %s (%i): %i" \
                         %(self.id, self.command_lookup[command], command, data)
 
-        elif self.move_lookup.has_key(command):
+        elif kind == MOVE_COMMAND:
             # if its not a move command, we trigger the action state
             self.action_state = True
-            self.pending_responses = self.pending_responses + 1
-            self.last_action_sent = self.move_lookup.has_key(command)
+            self.last_action_sent = True
             if self.verbose:
                 print "send:      %s, move %s (%i): %i" \
                         %(self.id, self.move_lookup[command], command, data)
 
-        elif  self.settings_lookup.has_key(command):
+        elif kind == SETTING_COMMAND:
             # Its a settings command
-            self.pending_responses = self.pending_responses + 1
+            pass
 
         else:
             # Don't know what to do with this...
-            pass
+            counted = False
+
+        if command in self.motion_commands and not kind == STOP_COMMAND:
+            self.moving = True
+
+        if command == self.base_commands['return_setting']:
+            reply_command = data
+        else:
+            reply_command = command
         
-        # If the blocking request was made, we take control of the
-        # queue handler until our packet arrives. All other packets
-        # arrive as usual and are handled in the same way. That is, 
-        # the queue handler will do its usual thing, dispatching
-        # packets, only it will be one at a time, initiated by this
-        # loop. We drop out of the loop when a response is received for
-        # the command we sent or no more responses are expected.
-        if blocking:
-            last_packet_sent_temp = self.last_packet_sent
-            self.last_packet_sent = command_tuple
-            while self.last_packet_received == None or \
-                    not self.last_packet_received[1] == release_command:
-                if self.responses_pending():
-                    self.connection.queue_handler(1)
-                else:
-                    self.error_list.append(command)
-                    break
-            
-            self.last_packet_sent = last_packet_sent_temp
+        # The future has to be in place before the command goes out, as the
+        # reply may be handled by another thread as soon as it arrives.
+        future = command_future(self, command, data, reply_command, counted)
+        self.futures_lock.acquire()
+        try:
+            self.outstanding_futures.append(future)
+            if counted:
+                self.pending_responses = self.pending_responses + 1
+        finally:
+            self.futures_lock.release()
+
+        self.last_packet_sent = command_tuple
+
+        if kind == STOP_COMMAND:
+            # Stops go out ahead of anything still waiting to be written, and
+            # any motion for this device still waiting is dropped
+            self.connection.send_command(self.device_number, command, data, \
+                    urgent = True, cancels = self.motion_commands)
         else:
-            self.last_packet_sent = command_tuple
+            apply(self.connection.send_command, command_tuple)
+
+        if blocking and not future.wait(self.blocking_timeout):
+            raise DeviceTimeoutError(self.id)
+        
+        return future
+
+    def send_command(self, command, data = 0):
+        '''zaber_device.send_command(command, data = 0)
+
+        Send the command to the device now and return a command_future that
+        resolves with the data of the reply, or with a DeviceBusyError or
+        DeviceCommandError. command is either a command number or the name of a
+        base or stop command.
+
+        Any number of commands can be in flight at once, across any number of
+        devices, and waited on together. For example:
+
+            futures = [stage.send_command('return_current_position')
+                            for stage in stages]
+            positions = wait_for_futures(futures, timeout = 1.0)
+        '''
+        if self.base_commands.has_key(command):
+            command = self.base_commands[command]
+        elif self.stop_commands.has_key(command):
+            command = self.stop_commands[command]
+
+        return self.do_now(command, data)
+
+    def take_future(self, command):
+        '''zaber_device.take_future(command)
+
+        Remove and return the oldest outstanding future for command, or None if
+        there isn't one. Its pending response is discounted.
+        '''
+        self.futures_lock.acquire()
+        try:
+            for future in self.outstanding_futures:
+                if future.command == command:
+                    self.outstanding_futures.remove(future)
+                    if future.counted:
+                        self.pending_responses = self.pending_responses - 1
+                    return future
+        finally:
+            self.futures_lock.release()
+
+        return None
+
+    def resolve_futures(self, command, data):
+        '''zaber_device.resolve_futures(command, data)
+
+        Resolve the outstanding futures answered by a reply to command. That is
+        the oldest future expecting the reply, or if the reply ends a motion,
+        every future for a motion (since only one reply comes back when a move
+        is preempted or stopped).
+        '''
+        motion = command in self.motion_commands
         
+        answered = []
+        self.futures_lock.acquire()
+        try:
+            for future in list(self.outstanding_futures):
+                if future.reply_command == command or \
+                        (motion and future.command in self.motion_commands):
+                    self.outstanding_futures.remove(future)
+                    if future.counted:
+                        self.pending_responses = self.pending_responses - 1
+                    answered.append(future)
+                    
+                    if not motion:
+                        break
+        finally:
+            self.futures_lock.release()
+
+        for future in answered:
+            future.set_result(data)
+
         return None
 
     def handle_device_packet(self, source, command, data):
@@ -957,86 +1579,232 @@ class zaber_device(device_base):
             # We have received an error            
             if data == 255:
                 # This means the device was busy during the last request
-                self.pending_responses = self.pending_responses - 1
+                future = self.take_future(self.last_packet_sent[1])
                 if not self.responses_pending():
                     self.action_state = False
-                self.on_busy_error()
+                resent = self.on_busy_error()
+
+                if not future == None:
+                    if isinstance(resent, command_future):
+                        resent.add_done_callback(future.copy_outcome)
+                    else:
+                        future.set_exception(DeviceBusyError(self.id, future.command))
             
-            elif  self.command_lookup.has_key(data) \
-                    or self.command_lookup.has_key(int(data/100)):
-                self.pending_responses = self.pending_responses - 1
+            else:
+                # The error code is either the command itself or the command 
+                # followed by two more digits
+                future = self.take_future(data)
+                if future == None:
+                    future = self.take_future(int(data/100))
+                if not future == None:
+                    future.set_exception(DeviceCommandError(self.id, future.command, data))
+
+                    # A setting that was refused keeps its old value
+                    if self.settings_lookup.has_key(future.command):
+                        self.requested_settings.pop(self.settings_lookup[future.command], None)
+
+                    # A motion that was refused never started
+                    if future.command in self.motion_commands:
+                        self.moving = self.motion_outstanding()
+
+                if  self.command_lookup.has_key(data) \
+                        or self.command_lookup.has_key(int(data/100)):
+                    self.on_base_command_error(data)
                 
-                self.on_base_command_error(data)
-            
-            elif self.move_lookup.has_key(data) \
-                    or self.move_lookup.has_key(int(data/100)):
-                self.pending_responses = self.pending_responses - 1
+                elif self.move_lookup.has_key(data) \
+                        or self.move_lookup.has_key(int(data/100)):
+                    self.on_move_error(data)
 
-                self.on_move_error(data)
+                elif self.settings_lookup.has_key(data) \
+                        or self.settings_lookup.has_key(int(data/100)):
+                    self.on_settings_error(data)
 
-            elif self.settings_lookup.has_key(data) \
-                    or self.settings_lookup.has_key(int(data/100)):
-                self.pending_responses = self.pending_responses - 1
-                
-                self.on_settings_error(data)
+            if not self.responses_pending():
+                self.action_state = False
+                self.notify_action_complete()
 
-        elif self.command_lookup.has_key(command):
-            self.pending_responses = self.pending_responses - 1
-            
-            if self.verbose:
-                print 'received:  %s, command %s (%i): %i' \
-                        %(self.id, self.command_lookup[command], command, data)
+            self.last_packet_received = (source, command, data)
+            return None
 
-        elif self.stop_lookup.has_key(command):
-            self.pending_responses = self.pending_responses - 1
-            
-            if self.verbose:
-                print 'received:  %s, command %s (%i): %i' \
-                        %(self.id, self.stop_lookup[command], command, data)
+        kind = self.command_kinds.get(command)
 
-        elif self.move_lookup.has_key(command):
-            self.pending_responses = self.pending_responses - 1
+        if command in self.position_replies:
+            self.update_position(command, data)
 
-            if self.verbose:
-                print 'received:  %s, moved %s (%i): %i' \
-                        %(self.id, self.move_lookup[command], command, data)
+        if kind == SETTING_COMMAND:
+            # The setting (like the position) has to be stored before the 
+            # futures waiting on it are resolved
+            self.settings[self.settings_lookup[command]] = data
+            self.requested_settings.pop(self.settings_lookup[command], None)
 
-        elif self.settings_lookup.has_key(command):
-            self.pending_responses = self.pending_responses - 1
+        self.resolve_futures(command, data)
 
-            if self.verbose:
-                print 'received:  %s, %s set (%i): %i' \
-                        %(self.id, self.settings_lookup[command], command, data)
-             
-            self.settings[self.settings_lookup[command]] = data
-            
-            if self.settings_lookup[command] == 'microstep_resolution':
-                if not self.move_units == 'microsteps':
-                    self.microsteps_per_unit = float(data)/self.units_per_step
-                else:
-                    self.microsteps_per_unit = 1
-            
-            if len(self.settings) == len(self.settings_lookup):
-                self.initialised = True
-        
-        else:
+        reply_handler = self.reply_handlers.get(command)
+        if reply_handler == None:
             # Ignore packets that we don't know how to handle
             # But still print out that we received them...
             if self.verbose:
                 print 'received:  %s, %i: %i' \
                         %(self.id, command, data)
             return None
+        
+        reply_handler(self, command, data)
 
         if not self.responses_pending():
             self.action_state = False
+            self.notify_action_complete()
         
-        if (self.command_lookup.has_key(command) or self.move_lookup.has_key(command)):
+        if kind == BASE_COMMAND or kind == MOVE_COMMAND:
             # If we have an action (rather than a setting) then pass over to the
             # action handler
             self.handle_action(source, command, data, self.pause_after)
 
         self.last_packet_received = (source, command, data)
 
+    def update_position(self, command, data):
+        '''zaber_device.update_position(command, data)
+
+        Store the position carried by a reply to command. Replies that end a 
+        motion also mark the device as no longer moving (they answer every 
+        motion in flight, see resolve_futures()). Positions returned while 
+        moving (by return_current_position, say) are stored, but leave the 
+        device moving.
+
+        This is called before the futures for the reply are resolved, so that
+        whoever waits on them sees the new position.
+        '''
+        self.position = data
+        if self.microsteps_per_unit:
+            self.position_in_units = data/float(self.microsteps_per_unit)
+        else:
+            self.position_in_units = None
+        self.position_time = time()
+
+        if command in self.motion_commands:
+            self.moving = False
+
+        return None
+
+    def motion_outstanding(self):
+        '''zaber_device.motion_outstanding()
+
+        Return whether a motion command is still waiting for its reply.
+        '''
+        self.futures_lock.acquire()
+        try:
+            for future in self.outstanding_futures:
+                if future.command in self.motion_commands:
+                    return True
+        finally:
+            self.futures_lock.release()
+
+        return False
+
+    def cached_position(self, max_age = None, units = True):
+        '''zaber_device.cached_position(max_age = None, units = True)
+
+        Return the last position the device reported, in move units, or in
+        microsteps if units is False. No command is sent: the position comes
+        from the replies to moves, homes, stops and position queries.
+
+        Returns None if the device hasn't reported a position, is moving, or
+        reported it more than max_age seconds ago.
+        '''
+        if self.position_time == None or self.moving:
+            return None
+
+        if not max_age == None and time() - self.position_time > max_age:
+            return None
+
+        if units:
+            return self.position_in_units
+
+        return self.position
+
+    def kinematic_model(self, controller_series = 'T-series'):
+        '''zaber_device.kinematic_model(controller_series = 'T-series')
+
+        Return a move_model of the device built from its target_speed, 
+        acceleration, maximum_range and microstep_resolution settings, for 
+        predicting how long moves take. The settings have to have been loaded.
+        Settings that have been sent but not yet confirmed by the device are
+        taken as set.
+        '''
+        requested = self.requested_settings
+        return move_model(requested.get('target_speed', self.settings['target_speed']),
+                requested.get('acceleration', self.settings['acceleration']),
+                maximum_range = self.settings.get('maximum_range'),
+                microsteps_per_unit = self.microsteps_per_unit,
+                controller_series = controller_series)
+
+    def predict_move_time(self, target, start = None, controller_series = 'T-series'):
+        '''zaber_device.predict_move_time(target, start = None, 
+                controller_series = 'T-series')
+
+        Return the time in seconds that move_absolute(target) would take from 
+        start, both in move units. start defaults to the last position the 
+        device reported. If it has never reported one, the time for the full 
+        travel of the device is returned, as the move can't take longer.
+        '''
+        model = self.kinematic_model(controller_series)
+
+        if start == None:
+            start = self.position_in_units
+
+        if start == None:
+            return model.full_travel_time()
+
+        return model.move_time(start, target)
+
+    def handle_base_command_reply(self, command, data):
+        '''zaber_device.handle_base_command_reply(command, data)
+
+        Handle the reply to a base command.
+        '''
+        if command == self.base_commands['return_device_id']:
+            self.reported_device_id = data
+        
+        if self.verbose:
+            print 'received:  %s, command %s (%i): %i' \
+                    %(self.id, self.command_lookup[command], command, data)
+
+    def handle_stop_reply(self, command, data):
+        '''zaber_device.handle_stop_reply(command, data)
+
+        Handle the reply to a stop command.
+        '''
+        if self.verbose:
+            print 'received:  %s, command %s (%i): %i' \
+                    %(self.id, self.stop_lookup[command], command, data)
+
+    def handle_move_reply(self, command, data):
+        '''zaber_device.handle_move_reply(command, data)
+
+        Handle the reply to a move command.
+        '''
+        if self.verbose:
+            print 'received:  %s, moved %s (%i): %i' \
+                    %(self.id, self.move_lookup[command], command, data)
+
+    def handle_setting_reply(self, command, data):
+        '''zaber_device.handle_setting_reply(command, data)
+
+        Handle a setting returned by the device, which handle_device_packet()
+        has already stored.
+        '''
+        if self.verbose:
+            print 'received:  %s, %s set (%i): %i' \
+                    %(self.id, self.settings_lookup[command], command, data)
+        
+        if self.settings_lookup[command] == 'microstep_resolution':
+            if not self.move_units == 'microsteps':
+                self.microsteps_per_unit = float(data)/self.units_per_step
+            else:
+                self.microsteps_per_unit = 1
+        
+        if len(self.settings) == len(self.settings_lookup):
+            self.initialised = True
+
     def handle_action(self, source, command, data, pause_after):
         if self.run_mode == STEP and \
                 pause_after and \
@@ -1050,6 +1818,183 @@ class zaber_device(device_base):
 
         return None
 
+def base_command_method(command):
+    def base_function(self, data = 0):
+        return self.enqueue_base_command(command, data)
+
+    return base_function
+
+def stop_command_method(command):
+    def stop_function(self, data = 0):
+        return self.do_stop_command(command, data)
+
+    return stop_function
+
+def move_command_method(move_command):
+    def move_function(self, data = 0):
+        return self.move(move_command, data)
+
+    return move_function
+
+def set_setting_method(setting):
+    def set_function(self, data = 0):
+        return self.set(setting, data)
+
+    return set_function
+
+def get_setting_method(setting):
+    def get_function(self, blocking = False):
+        return self.get(setting, blocking = blocking)
+
+    return get_function
+
+def compile_command_methods(device_class, 
+                            base_commands = base_commands,
+                            stop_commands = stop_commands,
+                            move_commands = move_commands,
+                            setting_commands = setting_commands):
+    '''compile_command_methods(device_class, base_commands = base_commands, 
+                               stop_commands = stop_commands, 
+                               move_commands = move_commands,
+                               setting_commands = setting_commands)
+
+    Build the command methods and dispatch tables for device_class once, rather
+    than every time a command is sent or a reply arrives.
+
+    A method is added for every command, so that home(), stop(), 
+    move_absolute(), set_target_speed(), get_target_speed() and so on are 
+    ordinary methods instead of being made by device_base.__getattr__() on each
+    call. Methods that device_class already has are left alone.
+    device_base.__getattr__() still handles the meta commands, which are only
+    known once an instance exists.
+
+    Two tables are set on the class:
+    command_kinds maps command numbers to BASE_COMMAND, STOP_COMMAND, 
+    MOVE_COMMAND or SETTING_COMMAND.
+    reply_handlers maps command numbers to the method that handles the
+    reply, called as reply_handler(self, command, data).
+    '''
+    methods = []
+    for each_command in base_commands:
+        methods.append((each_command, base_command_method(each_command)))
+
+    for each_command in stop_commands:
+        methods.append((each_command, stop_command_method(each_command)))
+
+    for each_movement in move_commands:
+        methods.append(('move_' + each_movement, move_command_method(each_movement)))
+
+    for each_setting in setting_commands:
+        methods.append(('set_' + each_setting, set_setting_method(each_setting)))
+        methods.append(('get_' + each_setting, get_setting_method(each_setting)))
+
+    for name, method in methods:
+        if not hasattr(device_class, name):
+            method.__name__ = name
+            setattr(device_class, name, method)
+
+    command_kinds = {}
+    reply_handlers = {}
+    for commands, kind, reply_handler in \
+            ((base_commands, BASE_COMMAND, device_class.handle_base_command_reply),
+             (stop_commands, STOP_COMMAND, device_class.handle_stop_reply),
+             (move_commands, MOVE_COMMAND, device_class.handle_move_reply),
+             (setting_commands, SETTING_COMMAND, device_class.handle_setting_reply)):
+        for each_command in commands:
+            command_kinds[commands[each_command]] = kind
+            reply_handlers[commands[each_command]] = reply_handler
+
+    device_class.command_kinds = command_kinds
+    device_class.reply_handlers = reply_handlers
+
+    return device_class
+
+compile_command_methods(zaber_device)
+
+def discover_chain(devices, in_flight = 1):
+    '''discover_chain(devices, in_flight = 1)
+
+    Load the settings of every device in devices at once and return the devices.
+
+    devices should be zaber_device instances (such as linear_slide or rotary_stage)
+    on the same connection, normally created with defer_settings = True. Rather
+    than each device reading its settings in turn, queries are kept in flight for
+    every device on the chain at the same time, so the whole chain takes about as
+    many round trips as a single device.
+
+    in_flight is the number of queries that may be outstanding to each device
+    while reading every setting. The few queries used to check a settings cache
+    entry are always sent back to back. See zaber_device.load_settings().
+
+    Replies are matched to their queries by the connection, which sends them to
+    the device registered with the device number of the reply, and by
+    handle_device_packet(), which files them by the command of the reply.
+
+    The connection's queue is handled from this function, so it should be called
+    before the connection is opened.
+    '''
+    # Each device works through its queries and, if it was checking a cached
+    # entry, goes on to read everything if the entry turned out not to match
+    cached = {}
+    queries = {}
+    for device in devices:
+        cached[device] = device.cached_settings()
+        queries[device] = device.settings_queries(cached[device])
+
+    while True:
+        waiting_on = None
+
+        for device in devices:
+            if queries[device] == None:
+                # Finished with this one
+                continue
+
+            if cached[device] == None:
+                max_in_flight = in_flight
+            else:
+                max_in_flight = None
+
+            while queries[device] and (max_in_flight == None or \
+                    device.pending_responses < max_in_flight):
+                command, data = queries[device].pop(0)
+                device.do_now(command, data)
+
+            if device.responses_pending():
+                waiting_on = device
+
+            elif not queries[device] and not cached[device] == None:
+                # All the replies needed to check the cached entry are in
+                if not device.use_cached_settings(cached[device]):
+                    cached[device] = None
+                    queries[device] = device.settings_queries()
+                    waiting_on = device
+                else:
+                    # Fill in whatever the entry was missing, so that it
+                    # isn't read again next time
+                    missing = [ setting for setting in device.settings \
+                            if not cached[device]['settings'].has_key(setting) \
+                            and not setting in volatile_settings ]
+                    if missing and device.initialised:
+                        device.store_settings()
+                    queries[device] = None
+
+            elif queries[device] == []:
+                # Everything has been read from the device
+                if not device.initialised:
+                    warn('Not all settings were returned by %s' % str(device.id))
+                device.store_settings()
+                queries[device] = None
+            
+            elif queries[device]:
+                waiting_on = device
+
+        if waiting_on == None:
+            break
+
+        waiting_on.connection.queue_handler(1)
+
+    return devices
+
 def zaber_device_example(io):
     
     device_1 = zaber_device(io, 1, 'device_1', verbose = True)
@@ -1094,6 +2039,128 @@ def step_example(io):
 
     io.close()
 
+def dispatch_latency_benchmark(iterations = 1000, burst = 3):
+    '''dispatch_latency_benchmark(iterations = 1000, burst = 3)
+
+    Measure the time from a reply's bytes arriving on the serial port to
+    zaber_device.handle_device_packet() being called for it.
+
+    A pseudo-terminal stands in for the serial port. Replies are written to
+    its master end in bursts of burst packets (one per device, as when all 
+    the stages answer at once) with the connection's queue handler running 
+    in its own thread, as it does in bin/scancam.
+    '''
+    import os
+    import thread
+    from time import time
+
+    arrival_times = {}
+    latencies = []
+    all_handled = Event()
+
+    class benchmark_device(zaber_device):
+        # No hardware to ask for settings
+        def get_all_settings(self, blocking = False):
+            return None
+
+        def handle_device_packet(self, source, command, data):
+            latencies.append(time() - arrival_times[data])
+            zaber_device.handle_device_packet(self, source, command, data)
+            if len(latencies) == iterations*burst:
+                all_handled.set()
+
+    master, slave = os.openpty()
+    io = serial_connection(os.ttyname(slave), '<2Bi')
+
+    devices = []
+    for device_number in range(1, burst+1):
+        devices.append(benchmark_device(io, device_number, 'device_%d' % device_number, \
+                defer_settings = True))
+
+    thread.start_new_thread(io.open, ())
+
+    packer = struct.Struct('<2Bi')
+    for n in range(iterations):
+        replies = ''
+        for device_number in range(1, burst+1):
+            data = n*burst + device_number
+            replies = replies + packer.pack(device_number, base_commands['echo_data'], data)
+            arrival_times[data] = time()
+
+        os.write(master, replies)
+        # Let each burst be handled before the next one arrives
+        while len(latencies) < (n+1)*burst and not all_handled.isSet():
+            sleep(0.0005)
+
+    all_handled.wait(5)
+    io.close()
+    os.close(master)
+
+    latencies.sort()
+    print 'Dispatch latency over %d packets in bursts of %d:' % (len(latencies), burst)
+    print '    mean:   %.3f ms' % (1000*sum(latencies)/len(latencies))
+    print '    median: %.3f ms' % (1000*latencies[len(latencies)/2])
+    print '    99%%:    %.3f ms' % (1000*latencies[int(len(latencies)*0.99)])
+    print '    max:    %.3f ms' % (1000*latencies[-1])
+
+    return latencies
+
+def command_overhead_benchmark(iterations = 20000):
+    '''command_overhead_benchmark(iterations = 20000)
+
+    Measure the time spent in this module for each command sent: looking up a
+    command method such as move_absolute, and a whole command from calling
+    the method to handling its reply.
+
+    For comparison, the lookup is also timed through device_base.__getattr__(),
+    which makes a new function for the command every time it is called.
+
+    The device talks to a connection that throws the commands away, so only the
+    time in this module is measured.
+    '''
+    from time import time
+
+    class null_connection():
+        def register(self, handler, handler_id = None, device_id = None):
+            return handler_id
+        def register_device(self, handler_id, device_id):
+            return None
+        def send_command(self, device_id, command, data = 0, urgent = False, cancels = ()):
+            return 0
+
+    device = zaber_device(null_connection(), 1, 'device', defer_settings = True)
+    device.microsteps_per_unit = 1
+
+    def per_call(function):
+        start = time()
+        for n in xrange(iterations):
+            function()
+        return 1e6*(time() - start)/iterations
+
+    def move_round_trip():
+        device.move_absolute(n)
+        device.handle_device_packet(device.id, move_commands['absolute'], n)
+
+    def set_round_trip():
+        device.set_target_speed(n)
+        device.handle_device_packet(device.id, setting_commands['target_speed'], n)
+
+    def home_round_trip():
+        device.home()
+        device.handle_device_packet(device.id, base_commands['home'], 0)
+
+    n = 100
+    print 'Per command overhead over %d calls:' % iterations
+    print '    move_absolute lookup, __getattr__:   %.2f us' \
+            % per_call(lambda: device_base.__getattr__(device, 'move_absolute'))
+    print '    move_absolute lookup, method:        %.2f us' \
+            % per_call(lambda: device.move_absolute)
+    print '    move_absolute and reply:             %.2f us' % per_call(move_round_trip)
+    print '    set_target_speed and reply:          %.2f us' % per_call(set_round_trip)
+    print '    home and reply:                      %.2f us' % per_call(home_round_trip)
+
+    return None
+
 def examples(argv):
     '''A short example program that moves stuff around
     '''
@@ -1103,4 +2170,8 @@ def examples(argv):
 
 if __name__ == "__main__":
     import sys
-    examples(sys.argv)
+    if sys.argv[1:2] == ['benchmark']:
+        dispatch_latency_benchmark()
+        command_overhead_benchmark()
+    else:
+        examples(sys.argv)
@@ -74,7 +74,7 @@ class zaber_multidevice(zaber_device):
         self.meta_commands = {}
         self.user_meta_commands = {}
 
-        self.command_queue = []
+        self.command_queue = deque()
         self.mode = CONTINUOUS
         
         # Set up the empty data case
@@ -92,6 +92,22 @@ class zaber_multidevice(zaber_device):
             action_state = action_state or self.devices[each_device].in_action()
 
         return action_state
+
+    def wait_for_action_to_complete(self, timeout_secs, deadline = None, expected = None):
+        '''zaber_multidevice.wait_for_action_to_complete(timeout_secs, deadline = None, expected = None)
+
+        Wait until none of the individual devices making up this multidevice
+        are in action, sharing one deadline between them. expected is passed
+        on to each device for its DeviceTimeoutError.
+        '''
+        if deadline == None:
+            deadline = time() + timeout_secs
+
+        for each_device in self.devices:
+            self.devices[each_device].wait_for_action_to_complete(timeout_secs, \
+                    deadline = deadline, expected = expected)
+
+        return None
     
     def enqueue_base_command(self, command, argument=None):
         '''device_base.base_command(command, argument)
@@ -160,6 +176,46 @@ class zaber_multidevice(zaber_device):
 
         return None
 
+    def compile_command(self, command, argument = None):
+        '''zaber_multidevice.compile_command(command, argument = None)
+
+        Return the (command number, data) to send for the base command or 
+        move_SOMETHING command named by command. As with move(), the data is a
+        dictionary with an entry per device, and moves are converted from the 
+        move units into each device's microsteps.
+        '''
+        if argument == None:
+            argument = copy(self.zero_data)
+
+        if not type(argument) == dict:
+            temp = copy(self.zero_data)
+            for each_device in temp:
+                temp[each_device] = argument
+
+            argument = temp
+
+        if self.base_commands.has_key(command):
+            return (self.base_commands[command], argument)
+
+        move_command = command[5:]
+        if move_command == 'stored_position':
+            return (self.move_commands[move_command], argument)
+
+        microstep_movements = copy(argument)
+        for each_device in argument:
+            microstep_movements[each_device] = int(float(argument[each_device])\
+                                                    * self.devices[each_device].microsteps_per_unit)
+        
+        return (self.move_commands[move_command], microstep_movements)
+
+    def unit_scale(self):
+        '''zaber_multidevice.unit_scale()
+
+        Return the microsteps per move unit of each device.
+        '''
+        return tuple([(each_device, self.devices[each_device].microsteps_per_unit) \
+                for each_device in sorted(self.devices)])
+
     def get(self, setting, blocking = False):
         '''zaber_multidevice.get(setting, blocking = False)
 
@@ -202,6 +258,8 @@ class zaber_multidevice(zaber_device):
 
         If release_command is not passed or is None, then then command is used
         as the release command (ie an echo is expected)
+
+        Returns a dictionary of the command futures for each device called.
         '''
 
         if data == None or data == 0:
@@ -212,13 +270,25 @@ class zaber_multidevice(zaber_device):
                         (self.id, command, \
                         str(data))
 
-        for each_device in data:
-            try:
-                self.devices[each_device].do_now(command, data[each_device], \
-                        pause_after, blocking, release_command)
-            except KeyError:
-                # ignore invalid keys
-                pass
+        # Unless we are waiting on each device in turn, the commands for all of
+        # the devices go out in a single write
+        if not blocking:
+            self.connection.hold_writes()
+
+        futures = {}
+        try:
+            for each_device in data:
+                try:
+                    futures[each_device] = self.devices[each_device].do_now(command, \
+                            data[each_device], pause_after, blocking, release_command)
+                except KeyError:
+                    # ignore invalid keys
+                    pass
+        finally:
+            if not blocking:
+                self.connection.release_writes()
+
+        return futures
 
 def zaber_multidevice_example(io):
     devices = {'1':1, '2':2, '3':3}
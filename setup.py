@@ -9,7 +9,7 @@ setup(name='scancam',
       packages = ['scancam', 'bst_camera', 'zaber'],
       scripts = ['bin/scancam', 'bin/micro5-scan-builder', \
              'bin/proto-scan-builder', 'bin/scancam-tester',\
-             'bin/scancam-prepare-to-stow', ],
+             'bin/scancam-prepare-to-stow', 'bin/scancam-convert-scans', ],
       data_files=[('/etc', ['etc/scancam.conf'])],
 )
      